@@ -1,13 +1,59 @@
 # -*- coding: utf-8 -*-
 
+import time
+
+import logging
+
 from pyramid.config import Configurator
 
 from pyramid.authorization import ACLAuthorizationPolicy
 
-from sqlalchemy import engine_from_config
+from pyramid.settings import asbool, aslist
+
+from pyramid.tweens import EXCVIEW, MAIN
 
 from .authentication import OAuth2AuthenticationPolicy
 
+from .audit import audit_log_from_config
+
+from .cache import token_cache_from_config
+
+from .signing import token_signer_from_config
+
+from .ratelimit import rate_limiter_from_config
+
+from .passwords import password_verifier_from_config
+
+from .batching import token_writer_from_config
+
+from .bloom import token_filter_from_config, TokenFilterRebuilder
+
+from .clients import client_registry_from_config
+
+from .reaper import token_reaper_from_config
+
+from .scopes import check_scope_bits, scope_registry
+
+from .credentials import configure_client_secret_hasher
+
+from .routing import primary_engine_from_config, replica_set_from_config
+
+from .metrics import metrics_from_config, instrument_engine, metrics_view
+
+from .warmup import warm_up
+
+from .interfaces import (
+    IAuditLog,
+    IClientRegistry,
+    IMetrics,
+    IPasswordVerifier,
+    IRateLimiter,
+    ITokenCache,
+    ITokenFilter,
+    ITokenSigner,
+    ITokenWriter,
+    )
+
 from .models import (
     DBSession,
     Base,
@@ -15,6 +61,8 @@ from .models import (
 
 from .views import OAuth2Context, APIContext
 
+logger = logging.getLogger('oauth2_sample')
+
 
 class RootContext(object):
 
@@ -37,18 +85,115 @@ def root_factory(request):
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
+    started = time.perf_counter()
     config = Configurator(settings=settings, root_factory=root_factory)
 
     # Configure database.
-    engine = engine_from_config(settings, 'sqlalchemy.')
-    DBSession.configure(bind=engine)
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
+    replicas = replica_set_from_config(settings, 'sqlalchemy.replicas.')
+    if replicas is not None:
+        replicas.start()
+    DBSession.configure(bind=engine, replicas=replicas)
     Base.metadata.bind = engine
 
+    # Optionally record per-request timings and SQL statistics.
+    metrics = metrics_from_config(settings, 'oauth2.metrics.')
+    if metrics is not None:
+        config.registry.registerUtility(metrics, IMetrics)
+        instrument_engine(engine)
+        config.add_tween('oauth2_sample.metrics.metrics_tween_factory')
+        config.add_view(metrics_view, context=RootContext, name='metrics',
+                        request_method='GET')
+
+    # Register the known scopes. Append new scopes only, their bits are
+    # stored in oauth2_tokens.scope_mask; a changed order fails here.
+    for scope in aslist(settings.get('oauth2.scopes', 'api1 api2 api3')):
+        scope_registry.register(scope)
+    check_scope_bits(engine, scope_registry)
+
+    # Configure the hashing of client secrets.
+    configure_client_secret_hasher(settings, 'oauth2.client_secret.')
+
+    # Optionally keep the clients in memory, reloaded when they change.
+    client_registry = client_registry_from_config(
+        engine, settings, 'oauth2.client_registry.')
+    if client_registry is not None:
+        config.registry.registerUtility(client_registry, IClientRegistry)
+        client_registry.start()
+
+    # Configure the access token cache.
+    token_cache = token_cache_from_config(settings, 'oauth2.token_cache.')
+    if token_cache is not None:
+        config.registry.registerUtility(token_cache, ITokenCache)
+
+    # Optionally reap expired tokens, and expired cache entries, in the
+    # background.
+    token_reaper = token_reaper_from_config(
+        engine, settings, 'oauth2.reaper.', token_cache)
+    if token_reaper is not None:
+        token_reaper.start()
+
+    # Optionally skip the lookup of access tokens that were never issued.
+    token_filter = token_filter_from_config(settings, 'oauth2.token_filter.')
+    if token_filter is not None:
+        config.registry.registerUtility(token_filter, ITokenFilter)
+        TokenFilterRebuilder(token_filter, engine, float(settings.get(
+            'oauth2.token_filter.rebuild_interval', 600))).start()
+
+    # Optionally limit the token requests of every client.
+    rate_limiter = rate_limiter_from_config(settings, 'oauth2.rate_limit.')
+    if rate_limiter is not None:
+        config.registry.registerUtility(rate_limiter, IRateLimiter)
+
+    # Optionally verify the passwords of the password grant in a process
+    # pool.
+    password_verifier = password_verifier_from_config(
+        settings, metrics, 'oauth2.password_verifier.')
+    if password_verifier is not None:
+        config.registry.registerUtility(password_verifier, IPasswordVerifier)
+
+    # Optionally write the issued tokens in batches, outside of the request
+    # transaction.
+    token_writer = token_writer_from_config(
+        engine, settings, 'oauth2.token_writer.')
+    if token_writer is not None:
+        config.registry.registerUtility(token_writer, ITokenWriter)
+        token_writer.start()
+
+    # Optionally audit the issued and validated tokens, written to files
+    # by a background thread.
+    audit_log = audit_log_from_config(settings, 'oauth2.audit.')
+    if audit_log is not None:
+        config.registry.registerUtility(audit_log, IAuditLog)
+        audit_log.start()
+
+    # Configure the access token format.
+    token_signer = None
+    if settings.get('oauth2.token_format', 'opaque') == 'signed':
+        token_signer = token_signer_from_config(settings, 'oauth2.signing.')
+        config.registry.registerUtility(token_signer, ITokenSigner)
+
     # Pyramid requires an authentication policy to be active.
-    config.set_authentication_policy(OAuth2AuthenticationPolicy())
+    config.set_authentication_policy(
+        OAuth2AuthenticationPolicy(
+            token_cache=token_cache, token_signer=token_signer,
+            token_filter=token_filter, audit_log=audit_log))
     # Pyramid requires an authorization policy to be active.
     config.set_authorization_policy(ACLAuthorizationPolicy())
 
-    config.scan()
+    # Only the views are decorated, do not import the tests and scripts.
+    config.scan('.views')
+
+    # Optionally authorize the API requests from a precompiled table.
+    if asbool(settings.get('oauth2.api_fastpath.enabled', False)):
+        config.add_tween('oauth2_sample.fastpath.api_fastpath_tween_factory',
+                         under=EXCVIEW, over=MAIN)
+
+    app = config.make_wsgi_app()
+
+    # Optionally open the connections and load the queries before the
+    # server starts to accept requests.
+    warm_up(app, engine, settings, replicas, 'oauth2.warmup.')
+    logger.info('Ready in %.3fs', time.perf_counter() - started)
 
-    return config.make_wsgi_app()
+    return app
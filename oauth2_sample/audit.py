@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import json
+
+import atexit
+
+import time
+
+import logging
+
+import threading
+
+from datetime import datetime
+
+from zope.interface import implementer
+
+from pyramid.settings import asbool
+
+from .interfaces import IAuditLog
+
+__all__ = (
+    'AuditLog',
+    'audit_log_from_config',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(repr(value))
+
+
+def _format(entry):
+    timestamp, event, fields = entry
+    record = {'time': round(timestamp, 6), 'event': event}
+    record.update(fields)
+    return json.dumps(
+        record, default=_default, separators=(',', ':')).encode('utf-8') \
+        + b'\n'
+
+
+@implementer(IAuditLog)
+class AuditLog(threading.Thread):
+    """Append audit records to ``path`` as JSON lines, from a ring buffer of
+    ``capacity`` records drained by a background thread.
+
+    :meth:`record` only stores a tuple in the buffer; the records are
+    formatted and written in one ``write`` every ``flush_interval``
+    seconds, or once ``batch_size`` records are waiting. When the buffer
+    is full a record is dropped and counted, or with ``when_full =
+    'block'`` the request waits up to ``block_timeout`` seconds for the
+    thread to make room before it is dropped.
+
+    The file is rotated to ``path.1`` ... ``path.<backups>`` when it would
+    grow past ``max_bytes``. ``{pid}`` in ``path`` is replaced by the id of
+    the process, so the workers of a pre-fork server write their own
+    files. The waiting records are written at exit, and lost if the
+    process is killed.
+    """
+
+    DROP = 'drop'
+    BLOCK = 'block'
+
+    def __init__(self, path, capacity=65536, when_full=DROP,
+                 block_timeout=1.0, batch_size=4096, flush_interval=0.5,
+                 max_bytes=64 * 1024 * 1024, backups=10, clock=time.time):
+        super(AuditLog, self).__init__(name='AuditLog')
+        if when_full not in (self.DROP, self.BLOCK):
+            raise ValueError('when_full must be %r or %r, not %r' % (
+                self.DROP, self.BLOCK, when_full))
+        self.daemon = True
+        self.path = path
+        self.capacity = capacity
+        self.when_full = when_full
+        self.block_timeout = block_timeout
+        self.batch_size = min(batch_size, capacity)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._clock = clock
+        self._slots = [None] * capacity
+        self._head = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._file = None
+        self._size = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.blocked_seconds = 0.0
+
+    def record(self, event, **fields):
+        """Queue a record of ``event`` with ``fields``.
+
+        :return: ``False`` if the record was dropped
+        """
+        entry = (self._clock(), event, fields)
+        with self._lock:
+            if self._count == self.capacity and not self._wait_not_full():
+                self.dropped += 1
+                return False
+            self._slots[(self._head + self._count) % self.capacity] = entry
+            self._count += 1
+            self.recorded += 1
+            if self._count == self.batch_size:
+                self._wakeup.set()
+        return True
+
+    def _wait_not_full(self):
+        if self.when_full != self.BLOCK:
+            return False
+        self._wakeup.set()
+        start = time.perf_counter()
+        room = self._not_full.wait_for(
+            lambda: self._count < self.capacity, self.block_timeout)
+        self.blocked_seconds += time.perf_counter() - start
+        return room
+
+    def _take(self):
+        with self._lock:
+            head, count = self._head, self._count
+            end = min(head + count, self.capacity)
+            entries = self._slots[head:end]
+            self._slots[head:end] = [None] * (end - head)
+            wrapped = count - (end - head)
+            if wrapped:
+                entries.extend(self._slots[:wrapped])
+                self._slots[:wrapped] = [None] * wrapped
+            self._head = (head + count) % self.capacity
+            self._count = 0
+            self._not_full.notify_all()
+        return entries
+
+    def flush(self):
+        """Write the records waiting in the buffer.
+
+        :return: The number of records written
+        """
+        entries = self._take()
+        if not entries:
+            return 0
+        try:
+            self._write(b''.join(_format(entry) for entry in entries))
+        except Exception:
+            logger.exception('Failed to write %d audit records',
+                             len(entries))
+            with self._lock:
+                self.dropped += len(entries)
+            return 0
+        self.written += len(entries)
+        return len(entries)
+
+    def _open(self):
+        path = self.path.replace('{pid}', str(os.getpid()))
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        path = self._file.name
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (path, i)):
+                os.replace('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+        if self.backups:
+            os.replace(path, path + '.1')
+        else:
+            os.unlink(path)
+        self._open()
+
+    def _write(self, data):
+        if self._file is None:
+            self._open()
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            stopped = self._stopped
+            self.flush()
+            if stopped:
+                break
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def start(self):
+        super(AuditLog, self).start()
+        atexit.register(self.close)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def close(self, timeout=10):
+        """Stop the thread once the waiting records are written."""
+        self.stop()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'pending': self._count,
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'written': self.written,
+            'blocked_seconds': self.blocked_seconds,
+            }
+
+
+def audit_log_from_config(settings, prefix='oauth2.audit.'):
+    """Create an :class:`AuditLog` from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.audit.enabled = true
+        oauth2.audit.path = %(here)s/audit-{pid}.log
+        # Records held in memory until they are written.
+        oauth2.audit.capacity = 65536
+        # drop or block
+        oauth2.audit.when_full = drop
+        oauth2.audit.block_timeout = 1
+        oauth2.audit.batch_size = 4096
+        oauth2.audit.flush_interval = 0.5
+        oauth2.audit.max_bytes = 67108864
+        oauth2.audit.backups = 10
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    return AuditLog(
+        settings[prefix + 'path'],
+        capacity=int(settings.get(prefix + 'capacity', 65536)),
+        when_full=settings.get(prefix + 'when_full', AuditLog.DROP),
+        block_timeout=float(settings.get(prefix + 'block_timeout', 1)),
+        batch_size=int(settings.get(prefix + 'batch_size', 4096)),
+        flush_interval=float(settings.get(prefix + 'flush_interval', 0.5)),
+        max_bytes=int(settings.get(prefix + 'max_bytes', 64 * 1024 * 1024)),
+        backups=int(settings.get(prefix + 'backups', 10)),
+        )
@@ -2,13 +2,25 @@
 
 import logging
 
+from datetime import datetime
+
 from zope.interface import implementer
 
 from pyramid.interfaces import IAuthenticationPolicy
 
 from pyramid.authentication import CallbackAuthenticationPolicy
 
-from .models import OAuth2Token
+from .models import DBSession, OAuth2Token, token_digest
+
+from .routing import replica_then_primary
+
+from .cache import CachedToken
+
+from .interfaces import IMetrics
+
+from .tokens import REFRESH_TOKEN, InvalidToken, token_issued_at, token_type
+
+from .scopes import scope_registry
 
 __all__ = (
     'OAuth2AuthenticationPolicy',
@@ -20,8 +32,15 @@ logger = logging.getLogger('oauth2_sample')
 @implementer(IAuthenticationPolicy)
 class OAuth2AuthenticationPolicy(CallbackAuthenticationPolicy):
 
-    def __init__(self, realm='Realm'):
+    def __init__(self, realm='Realm', token_cache=None, token_signer=None,
+                 scope_registry=scope_registry, token_filter=None,
+                 audit_log=None):
         self.realm = realm
+        self.audit_log = audit_log
+        self.token_cache = token_cache
+        self.token_signer = token_signer
+        self.token_filter = token_filter
+        self.scope_registry = scope_registry
 
     def _get_access_token_from_request_header(self, request):
         authorization = request.headers.get('Authorization')
@@ -47,14 +66,110 @@ class OAuth2AuthenticationPolicy(CallbackAuthenticationPolicy):
     def forget(self, request):
         return [('WWW-Authenticate', 'Bearer realm="%s"' % self.realm)]
 
+    def _reject(self, request, reason):
+        logger.debug('Rejected a %s access token', reason)
+        metrics = request.registry.queryUtility(IMetrics)
+        if metrics is not None:
+            metrics.incr('rejected_tokens_total', reason=reason)
+
+    def _lookup_token(self, access_token, request):
+        signer = self.token_signer
+        if signer is not None and signer.is_signed(access_token):
+            return signer.verify(access_token)
+        # Reject the tokens that were not issued here before any lookup.
+        try:
+            type_ = token_type(access_token)
+        except InvalidToken as e:
+            self._reject(request, e.reason)
+            return None
+        if type_ == REFRESH_TOKEN:
+            self._reject(request, 'wrong_type')
+            return None
+        # Cache entries are keyed by the digest that is stored, so they can
+        # be invalidated without the token.
+        key = token_digest(access_token)
+        cache = self.token_cache
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                return entry
+        token_filter = self.token_filter
+        if token_filter is not None and not token_filter.might_contain(key):
+            self._reject(request, 'unknown')
+            return None
+        token = replica_then_primary(
+            DBSession, OAuth2Token.query.get_by_access_token, access_token,
+            created=token_issued_at(access_token))
+        if token is None:
+            return None
+        # The row outlives its access token until its refresh token expires.
+        if token.expires is None or token.expires <= datetime.utcnow():
+            return None
+        scopes = tuple(token.scopes or ())
+        scope_mask = token.scope_mask
+        if scope_mask is None:
+            scope_mask = self.scope_registry.mask(scopes)
+        entry = CachedToken(
+            scopes, token.expires, token.user_id, token.client_id,
+            scope_mask)
+        if cache is not None:
+            cache.set(key, entry)
+        return entry
+
+    def _token(self, access_token, request):
+        """Look up and audit the token of ``request`` once, the fast path
+        hands the request to the callback when it cannot authorize it.
+        """
+        resolved = request.__dict__.get('_oauth2_token')
+        if resolved is not None and resolved[0] == access_token:
+            return resolved[1]
+        token = self._lookup_token(access_token, request)
+        if self.audit_log is not None:
+            self._audit(request, token)
+        request.__dict__['_oauth2_token'] = (access_token, token)
+        return token
+
+    def _audit(self, request, token):
+        if token is None:
+            self.audit_log.record(
+                'token_validated', path=request.path_info, valid=False)
+        else:
+            self.audit_log.record(
+                'token_validated', path=request.path_info, valid=True,
+                client_id=token.client_id, user_id=token.user_id,
+                scope_mask=token.scope_mask)
+
+    def _scope_mask(self, token):
+        scope_mask = token.scope_mask
+        if scope_mask is None:
+            scope_mask = self.scope_registry.mask(token.scopes)
+        return scope_mask
+
+    def scope_mask(self, request):
+        """Return the scope mask of the access token of ``request``, 0
+        without a valid token, or ``None`` if the token has a scope that is
+        not registered.
+        """
+        access_token = self.unauthenticated_userid(request)
+        if not access_token:
+            return 0
+        token = self._token(access_token, request)
+        if token is None:
+            return 0
+        return self._scope_mask(token)
+
     def callback(self, access_token, request):
-        token = OAuth2Token.query.get_by_access_token(access_token)
-        principals = []
+        token = self._token(access_token, request)
+        principals = ()
         if token:
-            for scope in token.scopes:
-                principals.append('s:' + scope)
+            scope_mask = self._scope_mask(token)
+            if scope_mask is not None:
+                principals = self.scope_registry.principals(scope_mask)
+            else:
+                principals = tuple('s:' + scope for scope in token.scopes)
         context = request.context
         if hasattr(context, 'group_finder'):
+            principals = list(principals)
             principals.extend(context.group_finder(request))
         logger.debug(principals)
         return principals
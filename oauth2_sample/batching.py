@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import queue
+
+import logging
+
+import threading
+
+from concurrent.futures import Future
+
+from zope.interface import implementer
+
+from pyramid.settings import asbool
+
+from .interfaces import ITokenWriter
+
+from .models import OAuth2Token
+
+__all__ = (
+    'TokenAlreadyUsed',
+    'TokenBatchWriter',
+    'token_writer_from_config',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+
+class TokenAlreadyUsed(Exception):
+    """The token a write was to replace was deleted by another write."""
+
+
+class _Write(object):
+
+    __slots__ = ('row', 'delete_id', 'future')
+
+    def __init__(self, row, delete_id):
+        self.row = row
+        self.delete_id = delete_id
+        self.future = Future()
+
+
+@implementer(ITokenWriter)
+class TokenBatchWriter(threading.Thread):
+    """Write new ``oauth2_tokens`` rows, and delete the rows they replace,
+    in batches committed by a single thread.
+
+    A batch is written as soon as the previous one is committed, after
+    waiting at most ``max_delay`` seconds for ``max_batch`` writes, in one
+    transaction with a ``DELETE`` per replaced row and one multi-row
+    ``INSERT``. The future of a write is resolved once its batch is
+    committed; a write whose future was cancelled before its batch started
+    is skipped.
+
+    A write whose ``DELETE`` deletes nothing, because another write of
+    this or an earlier batch, or of another process, deleted the row,
+    fails with :class:`TokenAlreadyUsed` and its row is not inserted, so
+    a refresh token is used once.
+    """
+
+    # Rows per INSERT statement, 8 columns stay below the 999 bind
+    # parameters SQLite allows.
+    INSERT_CHUNK = 100
+
+    def __init__(self, engine, max_batch=100, max_delay=0.002, timeout=10):
+        super(TokenBatchWriter, self).__init__(name='TokenBatchWriter')
+        self.daemon = True
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._stopped = False
+
+    def submit(self, row, delete_id=None):
+        """Queue the insert of ``row``, a dict of ``oauth2_tokens``
+        columns, and the delete of the row with the id ``delete_id``.
+
+        :return: A :class:`concurrent.futures.Future` resolved with
+            ``None`` once both are committed
+        """
+        write = _Write(row, delete_id)
+        self._queue.put(write)
+        return write.future
+
+    def stop(self):
+        self._stopped = True
+        self._queue.put(None)
+
+    def _next_batch(self):
+        write = self._queue.get()
+        if write is None:
+            return None
+        batch = [write]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                write = self._queue.get(timeout=timeout) if timeout > 0 \
+                    else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if write is None:
+                self._stopped = True
+                break
+            batch.append(write)
+        return batch
+
+    def run(self):
+        while not self._stopped:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            self.write(batch)
+
+    def write(self, batch):
+        """Write ``batch`` in one transaction and resolve its futures."""
+        batch = [write for write in batch
+                 if write.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            failed = self._write(batch)
+        except Exception as e:
+            logger.exception('Failed to write a batch of %d tokens',
+                             len(batch))
+            for write in batch:
+                write.future.set_exception(e)
+            return
+        for write in batch:
+            if write in failed:
+                write.future.set_exception(TokenAlreadyUsed())
+            else:
+                write.future.set_result(None)
+
+    def _write(self, batch):
+        table = OAuth2Token.__table__
+        failed = set()
+        with self.engine.begin() as conn:
+            for write in batch:
+                if write.delete_id is None:
+                    continue
+                # Only the DELETE that removes the row wins, a concurrent
+                # one waits for its lock and deletes nothing.
+                if not conn.execute(table.delete().where(
+                        table.c.id == write.delete_id)).rowcount:
+                    failed.add(write)
+            rows = [write.row for write in batch if write not in failed]
+            for i in range(0, len(rows), self.INSERT_CHUNK):
+                conn.execute(
+                    table.insert().values(rows[i:i + self.INSERT_CHUNK]))
+        return failed
+
+
+def token_writer_from_config(engine, settings, prefix='oauth2.token_writer.'):
+    """Create a :class:`TokenBatchWriter` from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.token_writer.enabled = true
+        oauth2.token_writer.max_batch = 100
+        oauth2.token_writer.max_delay = 0.002
+        oauth2.token_writer.timeout = 10
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    return TokenBatchWriter(
+        engine,
+        max_batch=int(settings.get(prefix + 'max_batch', 100)),
+        max_delay=float(settings.get(prefix + 'max_delay', 0.002)),
+        timeout=float(settings.get(prefix + 'timeout', 10)),
+        )
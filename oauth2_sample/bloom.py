@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import math
+
+import mmap
+
+import time
+
+import fcntl
+
+import struct
+
+import logging
+
+import threading
+
+from datetime import datetime
+
+from zope.interface import implementer
+
+from sqlalchemy import select
+
+from pyramid.exceptions import ConfigurationError
+
+from pyramid.settings import asbool
+
+from .interfaces import ITokenFilter
+
+from .models import OAuth2Token
+
+__all__ = (
+    'TokenFilter',
+    'TokenFilterRebuilder',
+    'load_access_token_digests',
+    'rebuild_token_filter_from_config',
+    'token_filter_from_config',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+_MAGIC = b'O2BLM001'
+
+# magic, bits, hashes, active generation (0 or 1, 2 until the first
+# build), rebuilt at.
+_HEADER = struct.Struct('<8sQIId')
+_HEADER_SIZE = 64
+
+_NOT_BUILT = 2
+
+
+def _optimal_size(capacity, error_rate):
+    """Return the number of bits and hashes of a Bloom filter holding
+    ``capacity`` items with a false positive rate of ``error_rate``.
+    """
+    bits = int(math.ceil(
+        -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    bits = (bits + 63) & ~63
+    hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+    return bits, hashes
+
+
+@implementer(ITokenFilter)
+class TokenFilter(object):
+    """A Bloom filter of the digests of the valid access tokens.
+
+    :meth:`might_contain` never answers ``False`` for a digest that was
+    added, so a ``False`` answer lets a lookup skip the database. Tokens
+    cannot be removed from a Bloom filter; revoked and expired tokens are
+    dropped by :meth:`rebuild`, until then they only cost a lookup.
+
+    The filter holds two generations of bits. :meth:`add` sets the bits
+    in both, :meth:`rebuild` clears and refills the inactive generation
+    and then makes it the active one, so tokens issued during a rebuild
+    are kept. Until the first rebuild every digest might be contained.
+
+    With a ``path``, the bits live in a memory-mapped file shared by every
+    process that maps it, and writers are serialized by an exclusive
+    ``flock`` on the file. Otherwise they are private to the process.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001, path=None,
+                 clock=time.time):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+        self.bits, self.hashes = _optimal_size(capacity, error_rate)
+        self._nbytes = self.bits // 8
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+        size = _HEADER_SIZE + 2 * self._nbytes
+        if path is None:
+            self._fd = None
+            self._map = mmap.mmap(-1, size)
+            self._init_header()
+            return
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                created = True
+            else:
+                created = False
+            self._map = mmap.mmap(self._fd, size)
+            if created:
+                self._init_header()
+            magic, bits, hashes = _HEADER.unpack_from(self._map, 0)[:3]
+            if (magic, bits, hashes) != (_MAGIC, self.bits, self.hashes):
+                raise ValueError(
+                    '%s was created with a different layout, remove it to '
+                    'recreate the filter' % path)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _init_header(self):
+        _HEADER.pack_into(
+            self._map, 0, _MAGIC, self.bits, self.hashes, _NOT_BUILT, 0.0)
+
+    def close(self):
+        self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+
+    def _header(self):
+        return _HEADER.unpack_from(self._map, 0)
+
+    @property
+    def rebuilt_at(self):
+        """When the filter was last rebuilt, ``None`` before the first
+        rebuild.
+        """
+        active, rebuilt_at = self._header()[3:]
+        return None if active == _NOT_BUILT else rebuilt_at
+
+    def _positions(self, digest):
+        # The digest is already uniformly distributed, derive the
+        # positions from two halves of it by double hashing.
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def _locked(self):
+        return _FilterLock(self._lock, self._fd)
+
+    def add(self, digest):
+        buf = self._map
+        offsets = (_HEADER_SIZE, _HEADER_SIZE + self._nbytes)
+        with self._locked():
+            for position in self._positions(digest):
+                index, mask = position >> 3, 1 << (position & 7)
+                for offset in offsets:
+                    buf[offset + index] |= mask
+
+    def might_contain(self, digest):
+        buf = self._map
+        active = self._header()[3]
+        if active == _NOT_BUILT:
+            return True
+        offset = _HEADER_SIZE + active * self._nbytes
+        for position in self._positions(digest):
+            if not buf[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def rebuild(self, digests):
+        """Replace the contents of the filter with ``digests``, an iterable
+        of the digests of every valid access token, plus the digests added
+        while it is consumed.
+
+        :return: The number of digests loaded
+        """
+        with self._rebuild_lock:
+            with self._locked():
+                active = self._header()[3]
+                target = 0 if active == _NOT_BUILT else 1 - active
+                start = _HEADER_SIZE + target * self._nbytes
+                self._map[start:start + self._nbytes] = \
+                    b'\0' * self._nbytes
+
+            # Set the bits in a private buffer, and merge it with the bits
+            # added to the target meanwhile.
+            bits = bytearray(self._nbytes)
+            count = 0
+            for digest in digests:
+                for position in self._positions(digest):
+                    bits[position >> 3] |= 1 << (position & 7)
+                count += 1
+
+            with self._locked():
+                merged = int.from_bytes(
+                    self._map[start:start + self._nbytes], 'little') | \
+                    int.from_bytes(bits, 'little')
+                self._map[start:start + self._nbytes] = \
+                    merged.to_bytes(self._nbytes, 'little')
+                header = self._header()
+                _HEADER.pack_into(
+                    self._map, 0, header[0], header[1], header[2], target,
+                    self._clock())
+        return count
+
+
+class _FilterLock(object):
+
+    def __init__(self, lock, fd):
+        self._lock = lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+def load_access_token_digests(engine, now=None, batch_size=10000):
+    """Yield the digests of the access tokens on ``engine`` that have not
+    expired, reading ``batch_size`` rows at a time.
+    """
+    table = OAuth2Token.__table__
+    now = now or datetime.utcnow()
+    last_id = 0
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select([table.c.id, table.c.access_token_hash])
+                .where(table.c.id > last_id)
+                .where(table.c.expires > now)
+                .where(table.c.access_token_hash.isnot(None))
+                .order_by(table.c.id)
+                .limit(batch_size)).fetchall()
+        for row in rows:
+            yield row[1]
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
+
+
+class TokenFilterRebuilder(threading.Thread):
+    """A background thread that rebuilds a :class:`TokenFilter` from the
+    tokens on ``engine`` when it starts and every ``interval`` seconds.
+
+    When several processes share the filter, a process skips the rebuild
+    if another one rebuilt it less than half an ``interval`` ago.
+    """
+
+    def __init__(self, token_filter, engine, interval=600, clock=time.time):
+        super(TokenFilterRebuilder, self).__init__(name='TokenFilterRebuilder')
+        self.daemon = True
+        self.token_filter = token_filter
+        self.engine = engine
+        self.interval = interval
+        self._clock = clock
+        self._stopped = threading.Event()
+
+    def run(self):
+        self.rebuild()
+        while not self._stopped.wait(self.interval):
+            self.rebuild()
+
+    def rebuild(self):
+        rebuilt_at = self.token_filter.rebuilt_at
+        if rebuilt_at is not None and \
+                self._clock() - rebuilt_at < self.interval / 2.0:
+            return None
+        start = time.time()
+        try:
+            count = self.token_filter.rebuild(
+                load_access_token_digests(self.engine))
+        except Exception:
+            logger.exception('Failed to rebuild the token filter')
+            return None
+        logger.info('Rebuilt the token filter with %d tokens in %.3fs',
+                    count, time.time() - start)
+        return count
+
+    def stop(self):
+        self._stopped.set()
+
+
+def token_filter_from_config(settings, prefix='oauth2.token_filter.'):
+    """Create a :class:`TokenFilter` from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.token_filter.enabled = true
+        oauth2.token_filter.capacity = 1000000
+        oauth2.token_filter.error_rate = 0.001
+        oauth2.token_filter.rebuild_interval = 600
+        # Shared by the worker processes of the host.
+        oauth2.token_filter.path = /dev/shm/oauth2_sample.filter
+
+    Every process that issues tokens must share the filter, a token
+    issued by a process with another filter is rejected by this one until
+    the next rebuild. The path is required, and the filter must stay
+    disabled when several hosts issue tokens.
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    path = settings.get(prefix + 'path')
+    if not path:
+        raise ConfigurationError(
+            '%spath is required, the filter must be shared by every '
+            'process that issues tokens' % prefix)
+    return TokenFilter(
+        capacity=int(settings.get(prefix + 'capacity', 1000000)),
+        error_rate=float(settings.get(prefix + 'error_rate', 0.001)),
+        path=path,
+        )
+
+
+def rebuild_token_filter_from_config(engine, settings,
+                                     prefix='oauth2.token_filter.'):
+    """Rebuild the shared :class:`TokenFilter` of ``settings`` from the
+    tokens on ``engine``, if it is enabled.
+
+    Commands that write tokens without the token endpoint call this when
+    they are done, otherwise the running processes reject those tokens
+    until their next rebuild.
+
+    :return: The number of digests loaded, or ``None`` when the filter is
+             disabled
+    """
+    token_filter = token_filter_from_config(settings, prefix)
+    if token_filter is None:
+        return None
+    try:
+        return token_filter.rebuild(load_access_token_digests(engine))
+    finally:
+        token_filter.close()
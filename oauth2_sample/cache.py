@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import struct
+
+import hashlib
+
+import threading
+
+from collections import OrderedDict, namedtuple
+
+from datetime import datetime
+
+from zope.interface import implementer
+
+from pyramid.exceptions import ConfigurationError
+
+from pyramid.settings import asbool
+
+from .interfaces import ITokenCache
+
+from .scopes import scope_registry
+
+from .shm import SharedTable
+
+__all__ = (
+    'CachedToken',
+    'SharedTokenCache',
+    'TokenCache',
+    'token_cache_from_config',
+    )
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+CachedToken = namedtuple(
+    'CachedToken',
+    ('scopes', 'expires', 'user_id', 'client_id', 'scope_mask'))
+CachedToken.__new__.__defaults__ = (None,)
+
+
+def _timestamp(dt):
+    """Convert a naive UTC datetime to a POSIX timestamp."""
+    return (dt - _EPOCH).total_seconds()
+
+
+@implementer(ITokenCache)
+class TokenCache(object):
+    """A bounded, thread safe LRU cache of validated access tokens.
+
+    An entry lives for at most ``ttl`` seconds, and never past the
+    ``expires`` of the token it describes.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = self._clock()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            deadline, value = item
+            if deadline <= now:
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        now = self._clock()
+        deadline = now + self.ttl
+        if value.expires is not None:
+            deadline = min(deadline, _timestamp(value.expires))
+        if deadline <= now:
+            return
+        with self._lock:
+            self._entries[key] = (deadline, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            }
+
+
+@implementer(ITokenCache)
+class SharedTokenCache(object):
+    """A cache of validated access tokens shared by every worker process
+    on a host through a memory-mapped file.
+
+    Entries are keyed by a digest of the token and hold its expiry, user
+    id, client id and scope mask; the scopes are restored from
+    ``scope_registry``, so tokens with unregistered scopes are not cached.
+    An invalidation in one process is seen by all of them. Lookups do not
+    take a lock. Expired entries are reused by new entries, and swept with
+    :meth:`evict_expired` by the token reaper.
+    """
+
+    # expires, user id, scope mask, client id.
+    _VALUE = struct.Struct('<dqq40s')
+
+    def __init__(self, path, slots=65536, ttl=300, clock=time.time,
+                 scope_registry=scope_registry):
+        self.ttl = ttl
+        self.scope_registry = scope_registry
+        self._clock = clock
+        self._table = SharedTable(
+            path, slots, self._VALUE.size, clock=clock)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._table)
+
+    def _key(self, key):
+        # Token digests are used as they are.
+        if not isinstance(key, bytes) or len(key) != 32:
+            if not isinstance(key, bytes):
+                key = key.encode('utf-8')
+            key = hashlib.sha256(key).digest()
+        return key[:16]
+
+    def get(self, key):
+        value = self._table.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        expires, user_id, scope_mask, client_id = self._VALUE.unpack(value)
+        return CachedToken(
+            self.scope_registry.scopes(scope_mask),
+            datetime.utcfromtimestamp(expires),
+            user_id, client_id.rstrip(b'\0').decode('utf-8'), scope_mask)
+
+    def set(self, key, value):
+        if value.scope_mask is None or value.expires is None:
+            return
+        now = self._clock()
+        expires = _timestamp(value.expires)
+        deadline = min(now + self.ttl, expires)
+        if deadline <= now:
+            return
+        if self._table.set(self._key(key), self._VALUE.pack(
+                expires, value.user_id, value.scope_mask,
+                value.client_id.encode('utf-8')), deadline):
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._table.delete(self._key(key))
+
+    def clear(self):
+        self._table.clear()
+
+    def evict_expired(self):
+        evicted = self._table.evict_expired()
+        self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._table),
+            }
+
+
+def token_cache_from_config(settings, prefix='oauth2.token_cache.'):
+    """Create a :class:`TokenCache`, or a :class:`SharedTokenCache` when
+    ``<prefix>backend`` is ``shared``, from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.token_cache.enabled = true
+        oauth2.token_cache.ttl = 300
+        # memory
+        oauth2.token_cache.backend = memory
+        oauth2.token_cache.max_size = 10000
+        # shared
+        oauth2.token_cache.backend = shared
+        oauth2.token_cache.path = /dev/shm/oauth2_sample.tokens
+        oauth2.token_cache.slots = 65536
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    backend = settings.get(prefix + 'backend', 'memory')
+    if backend == 'shared':
+        return SharedTokenCache(
+            settings[prefix + 'path'],
+            slots=int(settings.get(prefix + 'slots', 65536)),
+            ttl=float(settings.get(prefix + 'ttl', 300)),
+            )
+    if backend != 'memory':
+        raise ConfigurationError(
+            'Unknown %sbackend %r' % (prefix, backend))
+    return TokenCache(
+        max_size=int(settings.get(prefix + 'max_size', 10000)),
+        ttl=float(settings.get(prefix + 'ttl', 300)),
+        )
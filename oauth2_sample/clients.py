@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import logging
+
+import threading
+
+from collections import namedtuple, OrderedDict
+
+from zope.interface import implementer
+
+from sqlalchemy import select, func
+
+from pyramid.settings import asbool
+
+from .credentials import client_secret_hasher
+
+from .interfaces import IClientRegistry
+
+from .models import Client
+
+__all__ = (
+    'ClientRegistry',
+    'ClientSnapshot',
+    'client_registry_from_config',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+
+def _code(choice):
+    return getattr(choice, 'code', choice)
+
+
+class ClientSnapshot(namedtuple('ClientSnapshot', (
+        'client_id', 'client_secret', 'client_type', 'grant_type',
+        'redirect_urls', 'default_scopes', 'user_id', 'rate_limit',
+        'rate_burst'))):
+    """An immutable copy of a ``clients`` row, used in place of a
+    :class:`oauth2_sample.models.Client` by the token endpoint.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row['client_id'], row['client_secret'],
+            _code(row['client_type']), _code(row['grant_type']),
+            tuple(row['redirect_urls'] or ()),
+            tuple(row['default_scopes'] or ()),
+            row['user_id'], row['rate_limit'], row['rate_burst'])
+
+    def verify_client_secret(self, raw_secret):
+        return client_secret_hasher.verify(
+            self.client_id, raw_secret, self.client_secret)
+
+
+@implementer(IClientRegistry)
+class ClientRegistry(threading.Thread):
+    """The clients of ``engine`` as :class:`ClientSnapshot` instances,
+    kept in memory and reloaded by a background thread.
+
+    Every ``interval`` seconds the thread reads the number of clients and
+    the greatest ``clients.updated``, and reloads every client when either
+    changed, or when the snapshots are older than ``max_age`` seconds, so
+    changes that do not touch ``updated`` are seen too. A client that is
+    not in the registry yet is loaded on its first :meth:`get`.
+
+    Up to ``miss_cache_size`` unknown client ids are remembered until the
+    next :meth:`refresh`, so they do not reach the database every time.
+    """
+
+    def __init__(self, engine, interval=30, max_age=600,
+                 miss_cache_size=1024, clock=time.time):
+        super(ClientRegistry, self).__init__(name='ClientRegistry')
+        self.daemon = True
+        self.engine = engine
+        self.interval = interval
+        self.max_age = max_age
+        self._clock = clock
+        self._clients = {}
+        self._misses = OrderedDict()
+        self._misses_lock = threading.Lock()
+        self.miss_cache_size = miss_cache_size
+        self._version = None
+        self._loaded_at = None
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _select(self):
+        table = Client.__table__
+        return select([table.c[name] for name in ClientSnapshot._fields])
+
+    def get(self, client_id):
+        client = self._clients.get(client_id)
+        if client is not None or client_id in self._misses:
+            return client
+        with self.engine.connect() as conn:
+            row = conn.execute(self._select().where(
+                Client.__table__.c.client_id == client_id)).first()
+        if row is None:
+            if self.miss_cache_size > 0:
+                with self._misses_lock:
+                    self._misses[client_id] = None
+                    while len(self._misses) > self.miss_cache_size:
+                        self._misses.popitem(last=False)
+            return None
+        client = self._clients[client_id] = ClientSnapshot.from_row(row)
+        return client
+
+    def _read_version(self, conn):
+        table = Client.__table__
+        return tuple(conn.execute(
+            select([func.count(), func.max(table.c.updated)])).first())
+
+    def refresh(self):
+        """Reload the clients if they changed, or are too old, and forget
+        the unknown client ids.
+
+        :return: ``True`` if the clients were reloaded
+        """
+        with self._misses_lock:
+            self._misses.clear()
+        now = self._clock()
+        with self.engine.connect() as conn:
+            version = self._read_version(conn)
+            if version == self._version and \
+                    now - self._loaded_at < self.max_age:
+                return False
+            clients = dict(
+                (row['client_id'], ClientSnapshot.from_row(row))
+                for row in conn.execute(self._select()))
+        self._clients = clients
+        self._version = version
+        self._loaded_at = now
+        logger.info('Loaded %d clients', len(clients))
+        return True
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Failed to refresh the clients')
+
+    def stop(self):
+        self._stopped.set()
+
+
+def client_registry_from_config(engine, settings,
+                                prefix='oauth2.client_registry.'):
+    """Create a :class:`ClientRegistry` from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.client_registry.enabled = true
+        # Seconds between the checks for changed clients.
+        oauth2.client_registry.interval = 30
+        # Seconds after which every client is reloaded anyway.
+        oauth2.client_registry.max_age = 600
+        # Unknown client ids remembered until the next check.
+        oauth2.client_registry.miss_cache_size = 1024
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    return ClientRegistry(
+        engine,
+        interval=float(settings.get(prefix + 'interval', 30)),
+        max_age=float(settings.get(prefix + 'max_age', 600)),
+        miss_cache_size=int(settings.get(prefix + 'miss_cache_size', 1024)),
+        )
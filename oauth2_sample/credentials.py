@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+
+import logging
+
+import hashlib
+
+__all__ = (
+    'ClientSecretHasher',
+    'client_secret_hasher',
+    'configure_client_secret_hasher',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+
+class ClientSecretHasher(object):
+    """Store client secrets as HMAC-SHA256 digests keyed by a server side
+    key, and verify them in constant time.
+
+    Secrets stored before hashing was introduced are plain text and are
+    still accepted until ``hash_oauth2_sample_client_secrets`` converts
+    them.
+    """
+
+    PREFIX = 'hmac-sha256$'
+
+    def __init__(self, key=b''):
+        self.configure(key)
+
+    def configure(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        self.key = key
+
+    def hash(self, raw_secret):
+        return self.PREFIX + hmac.new(
+            self.key, raw_secret.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def is_hashed(self, secret):
+        return secret.startswith(self.PREFIX)
+
+    def verify(self, client_id, raw_secret, secret):
+        """Return ``True`` if ``raw_secret`` matches the stored ``secret``
+        of ``client_id``.
+        """
+        if raw_secret is None or secret is None:
+            return False
+        candidate = self.hash(raw_secret) if self.is_hashed(secret) \
+            else raw_secret
+        return hmac.compare_digest(
+            candidate.encode('utf-8'), secret.encode('utf-8'))
+
+
+#: Configured from the ``oauth2.client_secret.*`` settings by ``main()``.
+client_secret_hasher = ClientSecretHasher()
+
+
+def configure_client_secret_hasher(settings, prefix='oauth2.client_secret.'):
+    """Configure :data:`client_secret_hasher` from ``settings``::
+
+        oauth2.client_secret.key = a-long-random-server-side-key
+    """
+    key = settings.get(prefix + 'key')
+    if not key:
+        logger.warning('%skey is not set, client secrets are hashed '
+                       'without a server side key', prefix)
+    client_secret_hasher.configure(key or b'')
+    return client_secret_hasher
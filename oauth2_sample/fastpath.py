@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from collections import namedtuple
+
+from pyramid.httpexceptions import HTTPForbidden, HTTPNotFound
+
+from pyramid.interfaces import IAuthenticationPolicy, IRootFactory
+
+from pyramid.security import Allow, ALL_PERMISSIONS
+
+from pyramid.view import render_view_to_response
+
+from .scopes import scope_registry as default_scope_registry
+
+__all__ = (
+    'PermissionEntry',
+    'api_fastpath_tween_factory',
+    'compile_permission_table',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+#: A compiled view: the token needs one of the scopes of ``scope_mask``.
+PermissionEntry = namedtuple(
+    'PermissionEntry', ('view_name', 'scope_mask', 'message'))
+
+# The view predicates a compiled view may not use.
+_PREDICATES = (
+    'containment', 'request_param', 'route_name', 'xhr', 'accept', 'header',
+    'path_info', 'match_param', 'check_csrf', 'custom_predicates')
+
+
+def _allowed_mask(acl, permission, scope_registry):
+    """Return the mask of the scopes an ACL of ``Allow`` entries for
+    ``s:<scope>`` principals allows ``permission`` to, or ``None`` if the
+    ACL has any other kind of entry.
+    """
+    mask = 0
+    for action, principal, permissions in acl:
+        if action != Allow or not principal.startswith('s:'):
+            return None
+        scope_mask = scope_registry.mask([principal[2:]])
+        if scope_mask is None:
+            return None
+        if permissions is not ALL_PERMISSIONS and \
+                not isinstance(permissions, (list, tuple)):
+            permissions = [permissions]
+        if permissions is ALL_PERMISSIONS or permission in permissions:
+            mask |= scope_mask
+    return mask
+
+
+def compile_permission_table(registry, context_class, prefix, lineage=(),
+                             scope_registry=default_scope_registry):
+    """Compile the ``GET`` views of ``context_class``, the resource at
+    ``prefix``, into a table of ``path -> PermissionEntry``.
+
+    Only the views whose permission is decided by the static ACL of
+    ``context_class`` alone are compiled: the ACL holds ``Allow`` entries
+    for scope principals only, none of the classes of ``lineage`` above it
+    has an ACL, the context has no ``group_finder`` and the views have no
+    predicate other than the request method.
+    """
+    acl = context_class.__dict__.get('__acl__')
+    if not isinstance(acl, (list, tuple)) or \
+            hasattr(context_class, 'group_finder') or \
+            any(hasattr(cls, '__acl__') for cls in lineage):
+        return {}
+
+    table = {}
+    for item in registry.introspector.get_category('views'):
+        view = item['introspectable']
+        if view['context'] is not context_class or \
+                any(view.get(key) for key in _PREDICATES):
+            continue
+        methods = view['request_methods']
+        if isinstance(methods, str):
+            methods = (methods,)
+        if methods is None or 'GET' not in methods:
+            continue
+        permissions = [related['value'] for related in item['related']
+                       if related.category_name == 'permissions']
+        if len(permissions) != 1:
+            continue
+        scope_mask = _allowed_mask(acl, permissions[0], scope_registry)
+        if scope_mask is None:
+            continue
+        table[prefix + view['name']] = PermissionEntry(
+            view['name'], scope_mask,
+            'Unauthorized: %s failed permission check' %
+            getattr(view['callable'], '__name__', view['callable']))
+    return table
+
+
+def api_fastpath_tween_factory(handler, registry):
+    """Serve the ``GET /api/<view>`` requests from a permission table
+    compiled at startup: the scope mask of the bearer token is checked
+    against the mask the ACL of :class:`APIContext` allows, and the view
+    is called without traversal and without the ACL walk.
+
+    Denied requests raise the same ``HTTPForbidden`` as the view would.
+    Anything that is not in the table, or a token with a scope that is not
+    registered, goes the usual way, without a second lookup of the token;
+    so does every request while subscribers are registered, since
+    ``NewRequest`` and ``ContextFound`` are not sent on the fast path.
+    """
+    from . import RootContext
+    from .views import APIContext
+
+    policy = registry.queryUtility(IAuthenticationPolicy)
+    if not hasattr(policy, 'scope_mask') or registry.has_listeners:
+        return handler
+    table = compile_permission_table(
+        registry, APIContext, '/api/', lineage=(RootContext,),
+        scope_registry=policy.scope_registry)
+    if not table:
+        return handler
+    logger.debug('Serving %s from the API fast path', ', '.join(table))
+    root_factory = registry.getUtility(IRootFactory)
+
+    def api_fastpath_tween(request):
+        entry = table.get(request.path_info) \
+            if request.method == 'GET' else None
+        if entry is None:
+            return handler(request)
+        scope_mask = policy.scope_mask(request)
+        if scope_mask is None:
+            return handler(request)
+
+        root = root_factory(request)
+        context = root['api']
+        request.__dict__.update(
+            root=root, context=context, view_name=entry.view_name,
+            subpath=(), traversed=('api', entry.view_name),
+            virtual_root=root, virtual_root_path=())
+        if not scope_mask & entry.scope_mask:
+            raise HTTPForbidden(entry.message)
+        response = render_view_to_response(
+            context, request, entry.view_name, secure=False)
+        if response is None:
+            raise HTTPNotFound(request.path_info)
+        return response
+
+    return api_fastpath_tween
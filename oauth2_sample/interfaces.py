@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from zope.interface import Attribute, Interface
+
+__all__ = (
+    'IAuditLog',
+    'IClientRegistry',
+    'IMetrics',
+    'IPasswordVerifier',
+    'IRateLimiter',
+    'ITokenCache',
+    'ITokenFilter',
+    'ITokenSigner',
+    'ITokenWriter',
+    )
+
+
+class IAuditLog(Interface):
+    """Records the tokens issued and the tokens validated."""
+
+    def record(event, **fields):
+        """Queue a record of ``event`` without waiting for it to be
+        written, and return ``False`` if it was dropped.
+        """
+
+    def stats():
+        """Return a dict of the number of records recorded, dropped and
+        written.
+        """
+
+
+class IClientRegistry(Interface):
+    """The clients, kept in memory."""
+
+    def get(client_id):
+        """Return a :class:`oauth2_sample.clients.ClientSnapshot` of the
+        client ``client_id``, or ``None`` if there is no such client.
+        """
+
+    def refresh():
+        """Reload the clients if they changed."""
+
+
+class ITokenCache(Interface):
+    """A cache of validated access tokens.
+
+    Values are :class:`oauth2_sample.cache.CachedToken` instances.
+    """
+
+    def get(key):
+        """Return the cached value for ``key``, or ``None``."""
+
+    def set(key, value):
+        """Cache ``value`` under ``key``."""
+
+    def invalidate(key):
+        """Drop ``key`` from the cache."""
+
+    def clear():
+        """Drop every entry from the cache."""
+
+    def stats():
+        """Return a dict of the hit, miss and eviction counters."""
+
+
+class ITokenFilter(Interface):
+    """A probabilistic set of the digests of the valid access tokens."""
+
+    def add(digest):
+        """Add the digest of a newly issued access token."""
+
+    def might_contain(digest):
+        """Return ``False`` if ``digest`` is certainly not a valid access
+        token, ``True`` if it may be.
+        """
+
+    def rebuild(digests):
+        """Replace the contents of the filter with ``digests``."""
+
+
+class ITokenSigner(Interface):
+    """Issues and verifies self-contained signed access tokens."""
+
+    def sign(scopes, expires, client_id, user_id):
+        """Return a signed access token carrying the given claims."""
+
+    def is_signed(token):
+        """Return ``True`` if ``token`` looks like a signed token."""
+
+    def verify(token):
+        """Return the claims of ``token`` as a
+        :class:`oauth2_sample.cache.CachedToken`, or ``None`` if the
+        signature is invalid or the token has expired.
+        """
+
+
+class ITokenWriter(Interface):
+    """Writes issued tokens outside of the request transaction."""
+
+    timeout = Attribute("""Seconds a request waits for its write.""")
+
+    def submit(row, delete_id=None):
+        """Queue the insert of the token ``row`` and the delete of the token
+        with the id ``delete_id``, and return a future resolved once both
+        are committed.
+        """
+
+
+class IMetrics(Interface):
+    """Application metrics."""
+
+    def incr(name, value=1, **labels):
+        """Add ``value`` to the counter ``name``."""
+
+    def observe(name, value, buckets=None, **labels):
+        """Record ``value`` in the histogram ``name``."""
+
+    def render(gauges=()):
+        """Return every metric in the Prometheus text format."""
+
+
+class IPasswordVerifier(Interface):
+    """Verifies the passwords of the users out of the request thread."""
+
+    def verify(raw_password, password):
+        """Return ``True`` if ``raw_password`` matches the digest
+        ``password``, or raise
+        :class:`oauth2_sample.passwords.PasswordVerifierOverloaded`.
+        """
+
+    def stats():
+        """Return a dict of the number of processes and of the pending
+        verifications.
+        """
+
+
+class IRateLimiter(Interface):
+    """Token buckets keyed by client."""
+
+    def acquire(key, rate=None, burst=None):
+        """Take a token from the bucket of ``key``, refilled at ``rate``
+        tokens per second up to ``burst`` tokens, or the defaults of the
+        limiter when they are ``None``.
+
+        Return 0 if a token was taken, otherwise the number of seconds
+        until one is available.
+        """
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import random
+
+import bisect
+
+import threading
+
+from zope.interface import implementer
+
+from sqlalchemy import event
+
+from pyramid.response import Response
+
+from pyramid.settings import asbool
+
+from .interfaces import IAuditLog, IMetrics, IPasswordVerifier, ITokenCache
+
+__all__ = (
+    'Histogram',
+    'Metrics',
+    'instrument_engine',
+    'metrics_from_config',
+    'metrics_tween_factory',
+    'metrics_view',
+    )
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0)
+
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """A Prometheus style histogram with fixed upper bounds."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in items)
+
+
+@implementer(IMetrics)
+class Metrics(object):
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Metrics are keyed by name and a sorted tuple of ``(label, value)``
+    pairs; every update takes one lock.
+    """
+
+    def __init__(self, namespace='oauth2_sample'):
+        self.namespace = namespace
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help):
+        self._help[name] = help
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def _header(self, lines, name, type_):
+        help = self._help.get(name)
+        if help:
+            lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type_))
+
+    def render(self, gauges=()):
+        """Render every metric, plus ``gauges``, an iterable of
+        ``(name, labels, value)``.
+        """
+        prefix = self.namespace + '_'
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.cumulative()), h.sum, h.count))
+                for key, h in self._histograms.items())
+
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                self._header(lines, prefix + name, 'counter')
+                last = name
+            lines.append('%s%s %s' % (
+                prefix + name, _format_labels(labels), value))
+
+        for (name, labels), (buckets, sum_, count) in histograms:
+            if name != last:
+                self._header(lines, prefix + name, 'histogram')
+                last = name
+            for bound, total in buckets:
+                lines.append('%s_bucket%s %d' % (
+                    prefix + name, _format_labels(labels, [('le', bound)]),
+                    total))
+            lines.append('%s_bucket%s %d' % (
+                prefix + name, _format_labels(labels, [('le', '+Inf')]),
+                count))
+            lines.append('%s_sum%s %r' % (
+                prefix + name, _format_labels(labels), sum_))
+            lines.append('%s_count%s %d' % (
+                prefix + name, _format_labels(labels), count))
+
+        for name, labels, value in gauges:
+            if name != last:
+                self._header(lines, prefix + name, 'gauge')
+                last = name
+            lines.append('%s%s %s' % (
+                prefix + name, _format_labels(sorted(labels.items())), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+class _RequestStats(object):
+
+    __slots__ = ('statements', 'db_time', 'started')
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.started = None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None and stats.started is not None:
+        stats.statements += 1
+        stats.db_time += time.perf_counter() - stats.started
+        stats.started = None
+
+
+def instrument_engine(engine):
+    """Count the statements and measure the database time of the sampled
+    requests on ``engine``.
+    """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _view_label(request, status):
+    if status == 404:
+        return 'notfound'
+    context = getattr(request, 'context', None)
+    name = getattr(context, '__name__', None) or ''
+    return '%s/%s' % (name, getattr(request, 'view_name', ''))
+
+
+def metrics_tween_factory(handler, registry):
+    """Record the latency, status, SQL statements and database time of a
+    ``oauth2.metrics.sample_rate`` fraction of the requests.
+    """
+    metrics = registry.getUtility(IMetrics)
+    sample_rate = float(
+        registry.settings.get('oauth2.metrics.sample_rate', 1.0))
+
+    def metrics_tween(request):
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return handler(request)
+        stats = _local.stats = _RequestStats()
+        status = 500
+        start = time.perf_counter()
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            _local.stats = None
+            view = _view_label(request, status)
+            metrics.incr('requests_total', view=view, status=status)
+            metrics.observe('request_duration_seconds', elapsed, view=view)
+            metrics.observe('sql_statements_per_request', stats.statements,
+                            buckets=COUNT_BUCKETS, view=view)
+            metrics.observe('sql_duration_seconds', stats.db_time,
+                            view=view)
+
+    return metrics_tween
+
+
+def metrics_view(request):
+    """Expose the metrics in the Prometheus text format::
+
+        curl http://0.0.0.0:6543/metrics
+    """
+    metrics = request.registry.getUtility(IMetrics)
+    gauges = []
+    token_cache = request.registry.queryUtility(ITokenCache)
+    if token_cache is not None:
+        for key, value in sorted(token_cache.stats().items()):
+            gauges.append(('token_cache_%s' % key, {}, value))
+    password_verifier = request.registry.queryUtility(IPasswordVerifier)
+    if password_verifier is not None:
+        for key, value in sorted(password_verifier.stats().items()):
+            gauges.append(('password_verifier_%s' % key, {}, value))
+    audit_log = request.registry.queryUtility(IAuditLog)
+    if audit_log is not None:
+        for key, value in sorted(audit_log.stats().items()):
+            gauges.append(('audit_%s' % key, {}, value))
+    response = Response(metrics.render(gauges).encode('utf-8'))
+    response.headers['Content-Type'] = \
+        'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+def metrics_from_config(settings, prefix='oauth2.metrics.'):
+    """Create a :class:`Metrics` from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.metrics.enabled = true
+        oauth2.metrics.sample_rate = 0.1
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    metrics = Metrics()
+    metrics.describe('oauth2_sample_requests_total',
+                     'Sampled requests by view and status.')
+    metrics.describe('oauth2_sample_request_duration_seconds',
+                     'Latency of the sampled requests.')
+    metrics.describe('oauth2_sample_sql_statements_per_request',
+                     'SQL statements executed by the sampled requests.')
+    metrics.describe('oauth2_sample_sql_duration_seconds',
+                     'Time spent in SQL by the sampled requests.')
+    metrics.describe('oauth2_sample_rejected_tokens_total',
+                     'Access tokens rejected without a lookup, by reason.')
+    metrics.describe('oauth2_sample_rate_limited_total',
+                     'Token requests rejected by the rate limiter.')
+    metrics.describe('oauth2_sample_password_verification_seconds',
+                     'Latency of the password verifications, queue included.')
+    metrics.describe('oauth2_sample_password_verifications_shed_total',
+                     'Password grants refused with 503, the pool was full.')
+    return metrics
@@ -2,6 +2,8 @@
 
 import random
 
+import hashlib
+
 import datetime
 
 import arrow
@@ -15,23 +17,36 @@ from zope.sqlalchemy import ZopeTransactionExtension
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
+    Float,
     Boolean,
     Unicode,
     String,
+    LargeBinary,
     DateTime,
     ForeignKey,
     )
 
+from sqlalchemy.dialects import mysql
+
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship, Query
 
 from sqlalchemy.ext.declarative import declarative_base
 
 from sqlalchemy_utils import ArrowType, ChoiceType, ScalarListType
 
+from .scopes import scope_registry
+
+from .credentials import client_secret_hasher
+
+from .routing import RoutingSession
+
 __all__ = (
     'DBSession',
     'IDeclarativeBase',
     'Base',
+    'REFRESH_TOKEN_LIFETIME',
+    'token_digest',
     )
 
 
@@ -40,7 +55,8 @@ class IDeclarativeBase(zope.interface.Interface):
     """
 
 
-DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+DBSession = scoped_session(sessionmaker(
+    class_=RoutingSession, extension=ZopeTransactionExtension()))
 Base = declarative_base()
 zope.interface.classImplements(Base, IDeclarativeBase)
 
@@ -71,6 +87,27 @@ def _client_secret_generator():
     return ''.join(rand.choice(charset) for x in range(40))
 
 
+def token_digest(token):
+    """Return the SHA-256 digest of a token, the form in which access and
+    refresh tokens are stored and looked up.
+
+        >>> len(token_digest('a token'))
+        32
+    """
+    if not isinstance(token, bytes):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()
+
+
+#: A fixed width column holding a :func:`token_digest`.
+TokenDigest = LargeBinary(32).with_variant(mysql.BINARY(32), 'mysql')
+
+#: How long a refresh token stays valid after it is issued. The refresh
+#: token of a row without ``refresh_expires`` expires this long after its
+#: access token.
+REFRESH_TOKEN_LIFETIME = datetime.timedelta(days=30)
+
+
 class User(Base):
     """User"""
 
@@ -145,8 +182,10 @@ class Client(Base):
         default=_client_id_generator,
         )
 
+    #: The digest of the client secret, see :meth:`set_client_secret`.
     client_secret = Column(
-        String(128), nullable=False, default=_client_secret_generator,
+        String(128), nullable=False,
+        default=lambda: client_secret_hasher.hash(_client_secret_generator()),
         index=True,
         )
 
@@ -166,6 +205,17 @@ class Client(Base):
 
     user = relationship('User')
 
+    #: Token requests per second and burst of this client, ``NULL`` for the
+    #: ``oauth2.rate_limit.*`` defaults.
+    rate_limit = Column(Float)
+
+    rate_burst = Column(Integer)
+
+    #: When the client was last changed, polled by
+    #: :class:`oauth2_sample.clients.ClientRegistry`.
+    updated = Column(
+        ArrowType, default=arrow.utcnow, onupdate=arrow.utcnow, index=True)
+
     query = DBSession.query_property()
 
     @property
@@ -196,21 +246,50 @@ class Client(Base):
     def grant_type_is_client_credentials(self):
         return self.grant_type == Client.GRANT_TYPE_CLIENT_CREDENTIALS
 
+    def set_client_secret(self, raw_secret=None):
+        """Store the digest of ``raw_secret``, or of a new random secret.
+
+        :return: The raw secret
+        """
+        if raw_secret is None:
+            raw_secret = _client_secret_generator()
+        self.client_secret = client_secret_hasher.hash(raw_secret)
+        return raw_secret
+
+    def verify_client_secret(self, raw_secret):
+        return client_secret_hasher.verify(
+            self.client_id, raw_secret, self.client_secret)
+
     def is_allowed_redirect_uri(self, uri):
         return uri in self.redirect_uris
 
     def is_allowed_scopes(self, scopes):
-        return set(scopes).issubset(set(self.default_scopes)) \
-            if self.default_scopes and scopes else False
+        if not self.default_scopes or not scopes:
+            return False
+        mask = scope_registry.mask(scopes)
+        allowed = scope_registry.mask(self.default_scopes)
+        if mask is not None and allowed is not None:
+            return scope_registry.is_subset(mask, allowed)
+        return set(scopes).issubset(set(self.default_scopes))
 
 
 class OAuth2TokenQuery(Query):
 
     def get_by_access_token(self, access_token):
-        return self.filter_by(access_token=access_token).first()
+        return self.filter_by(
+            access_token_hash=token_digest(access_token)).first()
 
     def get_by_refresh_token(self, refresh_token):
-        return self.filter_by(refresh_token=refresh_token).first()
+        return self.filter_by(
+            refresh_token_hash=token_digest(refresh_token)).first()
+
+    def get_by_access_tokens(self, access_tokens):
+        return self.filter(OAuth2Token.access_token_hash.in_(
+            [token_digest(x) for x in access_tokens]))
+
+    def get_by_refresh_tokens(self, refresh_tokens):
+        return self.filter(OAuth2Token.refresh_token_hash.in_(
+            [token_digest(x) for x in refresh_tokens]))
 
 
 class OAuth2Token(Base):
@@ -235,22 +314,65 @@ class OAuth2Token(Base):
 
     client = relationship('Client')
 
-    access_token = Column(String(255), unique=True)
+    #: The :func:`token_digest` of the access token, the token itself is
+    #: only known to the client.
+    access_token_hash = Column(TokenDigest, index=True, unique=True)
+
+    #: The :func:`token_digest` of the refresh token.
+    refresh_token_hash = Column(TokenDigest, index=True, unique=True)
 
-    refresh_token = Column(String(255), unique=True)
+    #: When the access token expires.
+    expires = Column(DateTime, index=True)
 
-    expires = Column(DateTime)
+    #: When the refresh token expires, see :attr:`refresh_token_expires`.
+    refresh_expires = Column(DateTime, index=True)
 
     scopes = Column(ScalarListType())
 
+    #: The mask of ``scopes`` in :data:`oauth2_sample.scopes.scope_registry`,
+    #: ``NULL`` if any of the scopes is not registered.
+    scope_mask = Column(BigInteger)
+
     query = DBSession.query_property(query_cls=OAuth2TokenQuery)
 
     @property
     def is_expired(self):
         return datetime.datetime.utcnow() >= self.expires
 
+    @property
+    def refresh_token_expires(self):
+        if self.refresh_expires is not None:
+            return self.refresh_expires
+        if self.expires is not None:
+            return self.expires + REFRESH_TOKEN_LIFETIME
+        return None
+
+    @property
+    def is_refresh_expired(self):
+        expires = self.refresh_token_expires
+        return expires is not None and datetime.datetime.utcnow() >= expires
+
     def is_allowed_scopes(self, scopes):
         if not scopes:
             return True
-        return set(scopes).issubset(set(self.scopes)) \
-            if self.scopes else False
+        if not self.scopes:
+            return False
+        mask = scope_registry.mask(scopes)
+        if mask is not None and self.scope_mask is not None:
+            return scope_registry.is_subset(mask, self.scope_mask)
+        return set(scopes).issubset(set(self.scopes))
+
+
+class Scope(Base):
+    """The bit of a scope in ``oauth2_tokens.scope_mask``, recorded so a
+    change of the order of ``oauth2.scopes`` is detected, see
+    :func:`oauth2_sample.scopes.check_scope_bits`.
+    """
+
+    __tablename__ = 'oauth2_scopes'
+    __table_args__ = ({'mysql_engine': 'InnoDB'})
+
+    #: The index of the bit, ``1 << bit`` in a mask.
+    bit = Column(Integer(), primary_key=True, autoincrement=False)
+
+    name = Column(String(100), unique=True, nullable=False)
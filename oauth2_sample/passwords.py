@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import sys
+
+import time
+
+import threading
+
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from zope.interface import implementer
+
+from passlib.hash import bcrypt
+
+from pyramid.settings import asbool
+
+from .interfaces import IPasswordVerifier
+
+__all__ = (
+    'DUMMY_PASSWORD',
+    'PasswordVerifier',
+    'PasswordVerifierOverloaded',
+    'password_verifier_from_config',
+    )
+
+
+#: A bcrypt digest of 12 rounds, like the digests of the users, verified
+#: when a user does not exist so the request takes as long as a wrong
+#: password.
+DUMMY_PASSWORD = \
+    '$2b$12$LrmaIX5x4TRtAwEfwJZa1eZc6ZNlHwS0Z7Xq6M8yLgWcbfGJ8nGuu'
+
+
+class PasswordVerifierOverloaded(Exception):
+    """Too many password verifications are pending."""
+
+
+def _bcrypt_verify(raw_password, password):
+    return bcrypt.verify(raw_password, password)
+
+
+@implementer(IPasswordVerifier)
+class PasswordVerifier(object):
+    """Verify passwords in a pool of ``processes`` processes, so the bcrypt
+    rounds neither hold the GIL nor a thread of the server.
+
+    At most ``max_pending`` verifications run or wait in the pool; beyond
+    that, and when a verification takes more than ``timeout`` seconds,
+    :meth:`verify` raises :class:`PasswordVerifierOverloaded`. The time of
+    every verification, waiting included, is observed in ``metrics``.
+    """
+
+    def __init__(self, processes=None, max_pending=None, timeout=10,
+                 metrics=None, function=_bcrypt_verify):
+        self.processes = processes or os.cpu_count() or 1
+        self.max_pending = max_pending or self.processes * 2
+        self.timeout = timeout
+        self.metrics = metrics
+        self._function = function
+        self._pending = 0
+        self._lock = threading.Lock()
+        # forkserver, the server has started threads by now. Python < 3.7
+        # can only fork the workers.
+        kw = {}
+        if sys.version_info >= (3, 7):
+            kw['mp_context'] = multiprocessing.get_context('forkserver')
+        self._executor = ProcessPoolExecutor(self.processes, **kw)
+
+    def close(self):
+        """Shut the pool down once the pending verifications finish; the
+        workers must be joined, or the process hangs at exit.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def verify(self, raw_password, password):
+        """Return ``True`` if ``raw_password`` matches the digest
+        ``password``.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                if self.metrics is not None:
+                    self.metrics.incr('password_verifications_shed_total')
+                raise PasswordVerifierOverloaded()
+            self._pending += 1
+        start = time.perf_counter()
+        try:
+            future = self._executor.submit(
+                self._function, raw_password, password)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            if self.metrics is not None:
+                self.metrics.incr('password_verifications_shed_total')
+            raise PasswordVerifierOverloaded()
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('password_verification_seconds',
+                                     time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            'processes': self.processes,
+            'pending': self._pending,
+            'max_pending': self.max_pending,
+            }
+
+
+def password_verifier_from_config(settings, metrics=None,
+                                  prefix='oauth2.password_verifier.'):
+    """Create a :class:`PasswordVerifier` from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.password_verifier.enabled = true
+        # Defaults to the number of CPUs.
+        oauth2.password_verifier.processes = 4
+        # Defaults to twice the number of processes.
+        oauth2.password_verifier.max_pending = 8
+        oauth2.password_verifier.timeout = 10
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    return PasswordVerifier(
+        processes=int(settings.get(prefix + 'processes', 0)) or None,
+        max_pending=int(settings.get(prefix + 'max_pending', 0)) or None,
+        timeout=float(settings.get(prefix + 'timeout', 10)),
+        metrics=metrics,
+        )
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import struct
+
+import hashlib
+
+import threading
+
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from pyramid.exceptions import ConfigurationError
+
+from pyramid.settings import asbool
+
+from .interfaces import IRateLimiter
+
+from .shm import SharedTable
+
+__all__ = (
+    'RateLimiter',
+    'SharedRateLimiter',
+    'rate_limiter_from_config',
+    )
+
+
+def _take(tokens, updated, now, rate, burst):
+    """Refill a token bucket holding ``tokens`` at ``updated`` up to
+    ``now`` and take one token from it.
+
+    :return: ``(tokens, retry_after)``, ``retry_after`` is 0 if a token was
+        taken, otherwise the seconds until one is available
+    """
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+@implementer(IRateLimiter)
+class RateLimiter(object):
+    """Token buckets of the clients of a process.
+
+    A bucket is a ``[tokens, updated]`` pair; a bucket that has not been
+    used for the time it takes to fill up is the same as a full bucket,
+    and the least recently used buckets are dropped beyond ``max_size``.
+    """
+
+    def __init__(self, rate=1.0, burst=10, max_size=100000,
+                 clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key, rate=None, burst=None):
+        rate = rate or self.rate
+        burst = burst or self.burst
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [burst, now]
+                if len(self._buckets) > self.max_size:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            bucket[0], retry_after = _take(bucket[0], bucket[1], now, rate,
+                                           burst)
+            bucket[1] = now
+        return retry_after
+
+
+@implementer(IRateLimiter)
+class SharedRateLimiter(object):
+    """Token buckets shared by every worker process on a host through a
+    memory-mapped file, see :class:`oauth2_sample.shm.SharedTable`.
+
+    A bucket lives until it is full again; when the table is full, the
+    bucket closest to that is dropped, which only forgets a nearly full
+    bucket.
+    """
+
+    # tokens, updated.
+    _VALUE = struct.Struct('<dd')
+
+    def __init__(self, path, slots=65536, rate=1.0, burst=10,
+                 clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._table = SharedTable(path, slots, self._VALUE.size, clock=clock)
+
+    def close(self):
+        self._table.close()
+
+    def acquire(self, key, rate=None, burst=None):
+        rate = rate or self.rate
+        burst = burst or self.burst
+        now = self._clock()
+        result = []
+
+        def update(value):
+            if value is None:
+                tokens, updated = burst, now
+            else:
+                tokens, updated = self._VALUE.unpack(value)
+            tokens, retry_after = _take(tokens, updated, now, rate, burst)
+            result.append(retry_after)
+            return (self._VALUE.pack(tokens, now),
+                    now + (burst - tokens) / rate)
+
+        self._table.update(
+            hashlib.sha256(key.encode('utf-8')).digest()[:16], update)
+        return result[0]
+
+
+def rate_limiter_from_config(settings, prefix='oauth2.rate_limit.'):
+    """Create a :class:`RateLimiter`, or a :class:`SharedRateLimiter` when
+    ``<prefix>backend`` is ``shared``, from ``settings``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.rate_limit.enabled = true
+        # Tokens per second and bucket size, per client.
+        oauth2.rate_limit.rate = 1
+        oauth2.rate_limit.burst = 10
+        # memory
+        oauth2.rate_limit.backend = memory
+        oauth2.rate_limit.max_size = 100000
+        # shared
+        oauth2.rate_limit.backend = shared
+        oauth2.rate_limit.path = /dev/shm/oauth2_sample.ratelimit
+        oauth2.rate_limit.slots = 65536
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    rate = float(settings.get(prefix + 'rate', 1.0))
+    burst = float(settings.get(prefix + 'burst', 10))
+    if rate <= 0 or burst < 1:
+        raise ConfigurationError(
+            '%srate must be positive and %sburst at least 1' % (
+                prefix, prefix))
+    backend = settings.get(prefix + 'backend', 'memory')
+    if backend == 'shared':
+        return SharedRateLimiter(
+            settings[prefix + 'path'],
+            slots=int(settings.get(prefix + 'slots', 65536)),
+            rate=rate, burst=burst,
+            )
+    if backend != 'memory':
+        raise ConfigurationError(
+            'Unknown %sbackend %r' % (prefix, backend))
+    return RateLimiter(
+        rate=rate, burst=burst,
+        max_size=int(settings.get(prefix + 'max_size', 100000)),
+        )
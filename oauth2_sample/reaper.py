@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import logging
+
+import threading
+
+from collections import namedtuple
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, inspect, or_, and_
+
+from pyramid.settings import asbool
+
+from .models import OAuth2Token, REFRESH_TOKEN_LIFETIME
+
+__all__ = (
+    'ReapedBatch',
+    'TokenReaper',
+    'ensure_expires_index',
+    'reap_expired_tokens',
+    'token_reaper_from_config',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+
+ReapedBatch = namedtuple('ReapedBatch', ('rows', 'elapsed'))
+
+
+def ensure_expires_index(engine):
+    """Create the indexes on ``oauth2_tokens.expires`` and
+    ``refresh_expires`` if they are missing.
+
+    ``Base.metadata.create_all()`` does not add indexes to existing tables.
+    """
+    table = OAuth2Token.__table__
+    existing = set(
+        index['name'] for index in inspect(engine).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing and [c.name for c in index.columns] \
+                in (['expires'], ['refresh_expires']):
+            index.create(engine)
+            logger.info('Created index %s', index.name)
+
+
+def reap_expired_tokens(engine, batch_size=1000, grace=0, now=None):
+    """Delete expired tokens in batches of at most ``batch_size`` rows.
+
+    Every batch runs in its own short transaction, so no lock is held for
+    longer than one batch. A row holds a refresh token too, so it is
+    deleted ``grace`` seconds after its refresh token expires, at
+    ``refresh_expires`` or, for a row without one,
+    :data:`oauth2_sample.models.REFRESH_TOKEN_LIFETIME` after ``expires``.
+
+    Yields a :class:`ReapedBatch` per batch.
+    """
+    table = OAuth2Token.__table__
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=grace)
+    select_ids = select([table.c.id])\
+        .where(or_(
+            table.c.refresh_expires < cutoff,
+            and_(table.c.refresh_expires == None,  # noqa
+                 table.c.expires < cutoff - REFRESH_TOKEN_LIFETIME)))\
+        .limit(batch_size)
+
+    while True:
+        start = time.time()
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(select_ids)]
+            if not ids:
+                return
+            rows = conn.execute(
+                table.delete().where(table.c.id.in_(ids))).rowcount
+        elapsed = time.time() - start
+        logger.info('Reaped %d expired tokens in %.3fs', rows, elapsed)
+        yield ReapedBatch(rows, elapsed)
+        if len(ids) < batch_size:
+            return
+
+
+class TokenReaper(threading.Thread):
+    """A background thread that reaps expired tokens every ``interval``
+    seconds, sleeping ``pause`` seconds between batches.
+
+    The expired entries of a ``token_cache`` with an ``evict_expired``
+    method are evicted on every run too.
+    """
+
+    def __init__(self, engine, interval=300, batch_size=1000, grace=0,
+                 pause=0.0, token_cache=None):
+        super(TokenReaper, self).__init__(name='TokenReaper')
+        self.daemon = True
+        self.engine = engine
+        self.interval = interval
+        self.batch_size = batch_size
+        self.grace = grace
+        self.pause = pause
+        self.token_cache = token_cache
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.reap()
+
+    def reap(self):
+        total = 0
+        try:
+            for batch in reap_expired_tokens(
+                    self.engine, self.batch_size, self.grace):
+                total += batch.rows
+                if self._stopped.wait(self.pause):
+                    break
+        except Exception:
+            logger.exception('Failed to reap expired tokens')
+        evict_expired = getattr(self.token_cache, 'evict_expired', None)
+        if evict_expired is not None:
+            logger.debug('Evicted %d expired cache entries', evict_expired())
+        return total
+
+    def stop(self):
+        self._stopped.set()
+
+
+def token_reaper_from_config(engine, settings, prefix='oauth2.reaper.',
+                             token_cache=None):
+    """Create a :class:`TokenReaper` from ``settings``, evicting the
+    expired entries of ``token_cache``.
+
+    Returns ``None`` unless ``<prefix>enabled`` is true::
+
+        oauth2.reaper.enabled = true
+        oauth2.reaper.interval = 300
+        oauth2.reaper.batch_size = 1000
+        oauth2.reaper.grace = 0
+        oauth2.reaper.pause = 0.1
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return None
+    return TokenReaper(
+        engine,
+        interval=float(settings.get(prefix + 'interval', 300)),
+        batch_size=int(settings.get(prefix + 'batch_size', 1000)),
+        grace=float(settings.get(prefix + 'grace', 0)),
+        pause=float(settings.get(prefix + 'pause', 0.0)),
+        token_cache=token_cache,
+        )
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import logging
+
+import itertools
+
+import threading
+
+from contextlib import contextmanager
+
+from sqlalchemy import engine_from_config, text
+
+from sqlalchemy.exc import DBAPIError
+
+from sqlalchemy.orm import Session
+
+__all__ = (
+    'ReplicaSet',
+    'RoutingSession',
+    'primary_engine_from_config',
+    'replica_reads',
+    'replica_set_from_config',
+    'replica_then_primary',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+
+class ReplicaSet(object):
+    """Round-robin over the healthy engines of a set of read replicas.
+
+    A replica is marked down when :meth:`check` fails to ping it, or when
+    :meth:`mark_down` is called, and is skipped until a later :meth:`check`
+    succeeds. :meth:`start` runs the checks in a background thread.
+
+    ``max_lag`` is the number of seconds a row may take to reach the
+    replicas.
+    """
+
+    def __init__(self, engines, check_interval=10, max_lag=5):
+        self.engines = list(engines)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._down = set()
+        self._counter = itertools.count()
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return len(self.engines)
+
+    def next(self):
+        """Return the next healthy replica, or ``None`` if all are down."""
+        engines = self.engines
+        for i in range(len(engines)):
+            engine = engines[next(self._counter) % len(engines)]
+            if engine not in self._down:
+                return engine
+        return None
+
+    def mark_down(self, engine):
+        if engine not in self._down:
+            logger.warning('Replica %s is down', engine.url)
+            self._down.add(engine)
+
+    def mark_up(self, engine):
+        if engine in self._down:
+            logger.info('Replica %s is up', engine.url)
+            self._down.discard(engine)
+
+    def check(self):
+        for engine in self.engines:
+            try:
+                with engine.connect() as conn:
+                    conn.execute(text('SELECT 1'))
+            except Exception:
+                self.mark_down(engine)
+            else:
+                self.mark_up(engine)
+
+    def start(self):
+        def run():
+            while not self._stopped.wait(self.check_interval):
+                self.check()
+        thread = threading.Thread(target=run, name='ReplicaHealthCheck')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class RoutingSession(Session):
+    """A session that sends the reads made inside :func:`replica_reads` to
+    a read replica, and everything else to the primary bind.
+
+    Once the session has flushed or executed a statement that is not a
+    ``SELECT``, its reads stay on the primary until it is closed, so a
+    request reads its own writes. ``replica`` is the replica of the last
+    read routed to one.
+    """
+
+    def __init__(self, replicas=None, **kw):
+        super(RoutingSession, self).__init__(**kw)
+        self.replicas = replicas
+        self.use_replica = False
+        self.wrote = False
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        self.replica = None
+        if self._flushing or (
+                clause is not None and not clause.is_selectable):
+            self.wrote = True
+        elif self.use_replica and not self.wrote and self.replicas:
+            engine = self.replicas.next()
+            if engine is not None:
+                self.replica = engine
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def discard_replica(self, engine):
+        """Roll back and release the connection to the replica ``engine``
+        after a read failed on it, so the transaction of the session can
+        still commit on the primary.
+        """
+        # The session has no public API to drop one of its connections.
+        transaction = self.transaction
+        while transaction is not None:
+            connections = transaction._connections or {}
+            entry = connections.pop(engine, None)
+            if entry is not None:
+                conn, trans, autoclose = entry
+                connections.pop(conn, None)
+                try:
+                    trans.rollback()
+                finally:
+                    if autoclose:
+                        conn.close()
+            transaction = transaction._parent
+
+    def close(self):
+        super(RoutingSession, self).close()
+        self.wrote = False
+
+
+@contextmanager
+def replica_reads(scoped_session):
+    """Route the reads of ``scoped_session`` to a replica in this block."""
+    session = scoped_session()
+    previous = getattr(session, 'use_replica', None)
+    if previous is None:
+        yield
+        return
+    session.use_replica = True
+    try:
+        yield
+    finally:
+        session.use_replica = previous
+
+
+def replica_then_primary(scoped_session, query, *args, **kw):
+    """Return ``query(*args)`` read from a replica, or from the primary if
+    the replica fails; a replica that fails is marked down.
+
+    A miss is read again from the primary only if the row was written at
+    ``created``, a POSIX time passed as a keyword, less than ``max_lag``
+    seconds of the replicas ago, so rows that do not exist are not looked
+    up twice.
+    """
+    created = kw.pop('created', None)
+    session = scoped_session()
+    with replica_reads(scoped_session):
+        try:
+            result = query(*args)
+        except DBAPIError:
+            replica = getattr(session, 'replica', None)
+            if replica is None:
+                raise
+            session.replicas.mark_down(replica)
+            session.discard_replica(replica)
+            return query(*args)
+    replicas = getattr(session, 'replicas', None)
+    if result is None and replicas and created is not None and \
+            0 <= time.time() - created <= replicas.max_lag:
+        result = query(*args)
+    return result
+
+
+def primary_engine_from_config(settings, prefix='sqlalchemy.'):
+    """Create the primary engine, ignoring the ``<prefix>replicas.``
+    settings.
+    """
+    replicas = prefix + 'replicas.'
+    return engine_from_config(
+        dict((k, v) for k, v in settings.items()
+             if not k.startswith(replicas)),
+        prefix)
+
+
+def replica_set_from_config(settings, prefix='sqlalchemy.replicas.'):
+    """Create a :class:`ReplicaSet` from ``settings``.
+
+    Returns ``None`` unless a replica is configured::
+
+        sqlalchemy.replicas.check_interval = 10
+        # Seconds a new row may be missing on the replicas.
+        sqlalchemy.replicas.max_lag = 5
+        sqlalchemy.replicas.r1.url = postgresql://replica1/oauth2_sample
+        sqlalchemy.replicas.r2.url = postgresql://replica2/oauth2_sample
+    """
+    names = sorted(set(
+        key[len(prefix):-len('.url')] for key in settings
+        if key.startswith(prefix) and key.endswith('.url') and
+        '.' not in key[len(prefix):-len('.url')]))
+    if not names:
+        return None
+    return ReplicaSet(
+        [engine_from_config(settings, '%s%s.' % (prefix, name))
+         for name in names],
+        check_interval=float(settings.get(prefix + 'check_interval', 10)),
+        max_lag=float(settings.get(prefix + 'max_lag', 5)))
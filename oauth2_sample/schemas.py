@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
-from .models import Client, OAuth2Token
+from sqlalchemy.orm import joinedload
+
+from pyramid.threadlocal import get_current_registry
+
+from .interfaces import IClientRegistry
+
+from .models import DBSession, User, Client, OAuth2Token
+
+from .routing import replica_then_primary
+
+from .tokens import REFRESH_TOKEN, InvalidToken, token_type
 
 from colander import (
-    Schema, SchemaType, SchemaNode, String, Invalid, null, OneOf, )
+    Schema, SchemaType, SchemaNode, String, Invalid, null, OneOf, Length, )
 
 
 class StringSet(SchemaType):
@@ -23,25 +33,99 @@ class StringSet(SchemaType):
         if isinstance(cstruct, (str, bytes)):
             return set(cstruct.split())
         if hasattr(cstruct, '__iter__'):
-            return set(cstruct)
+            items = list(cstruct)
+            if all(isinstance(x, str) for x in items):
+                return set(items)
         raise Invalid(
-            node, '%r is not a string, or iteratable object' % cstruct)
+            node, '%r is not a string, or iteratable of strings' % cstruct)
 
 
 def _grant_type_validator(node, cstruct):
     grant_types = [
         Client.GRANT_TYPE_CLIENT_CREDENTIALS,
+        Client.GRANT_TYPE_PASSWORD,
         'refresh_token',
         ]
-    return OneOf([x for x in grant_types])
+    OneOf(grant_types)(node, cstruct)
+
+
+class StringList(SchemaType):
+    """A list of strings, a single string is a list of one."""
+
+    def serialize(self, node, appstruct):
+        if appstruct is null:
+            return null
+        return list(appstruct)
+
+    def deserialize(self, node, cstruct):
+        if cstruct is null:
+            return null
+        if isinstance(cstruct, str):
+            return [cstruct]
+        if isinstance(cstruct, (list, tuple)) and \
+                all(isinstance(x, str) for x in cstruct):
+            return list(cstruct)
+        raise Invalid(node, '%r is not a string, or list of strings' % cstruct)
+
+
+class ClientAuthenticationSchema(Schema):
+    """Base of the schemas of the requests made by a confidential client.
 
+    The client loaded during validation is kept in :attr:`client`, a
+    :class:`oauth2_sample.clients.ClientSnapshot` when a client registry
+    is configured.
+    """
 
-class OAuth2TokenSchema(Schema):
+    client = None
 
     client_id = SchemaNode(String(),)
 
     client_secret = SchemaNode(String(),)
 
+    def _get_client(self, client_id):
+        if not client_id:
+            return None
+        client_registry = get_current_registry().queryUtility(
+            IClientRegistry)
+        if client_registry is not None:
+            return client_registry.get(client_id)
+        return replica_then_primary(
+            DBSession, Client.query.options(joinedload(Client.user)).get,
+            client_id)
+
+    def _verify_client(self, node, client_id, client_secret):
+        if not client_id:
+            return None
+        client = self._get_client(client_id)
+        if client is None:
+            raise Invalid(node, 'Client not exists')
+        if not client.verify_client_secret(client_secret):
+            raise Invalid(node, 'A client secret is invalid')
+        return client
+
+    def _authenticate_client(self, node, cstruct):
+        client = self._verify_client(
+            node, cstruct['client_id'], cstruct['client_secret'])
+        if client is not None:
+            self.client = client
+
+    def validator(self, node, cstruct):
+        self._authenticate_client(node, cstruct)
+
+
+class OAuth2TokenSchema(ClientAuthenticationSchema):
+    """Validates a token request.
+
+    The client, the refresh token and the user of a password grant loaded
+    during validation are kept in :attr:`client`, :attr:`token` and
+    :attr:`user`, so the view does not load them again. The password is
+    verified by the view.
+    """
+
+    token = None
+
+    user = None
+
     grant_type = SchemaNode(
         String(),
         validator=_grant_type_validator
@@ -51,32 +135,160 @@ class OAuth2TokenSchema(Schema):
 
     refresh_token = SchemaNode(String(), missing=None,)
 
-    def _get_client(self, client_id):
-        if not client_id:
+    username = SchemaNode(String(), missing=None,)
+
+    password = SchemaNode(String(), missing=None,)
+
+    def _get_user(self, username):
+        if not username:
+            return None
+        return replica_then_primary(
+            DBSession, User.query.filter_by(username=username).first)
+
+    def _verify_user(self, node, client, username):
+        """Return the active user ``username``, or ``None``.
+
+        An unknown or inactive user is rejected by the view, after it
+        verified the password against a dummy digest.
+        """
+        if client is None or \
+                client.grant_type != Client.GRANT_TYPE_PASSWORD:
+            raise Invalid(node, 'The client may not use the password grant')
+        user = self._get_user(username)
+        if user is None or not user.is_active:
             return None
-        return Client.query.get(client_id)
+        return user
 
     def _get_refresh_token(self, refresh_token):
         if not refresh_token:
             return None
-        return OAuth2Token.query.get_by_refresh_token(refresh_token)
+        try:
+            if token_type(refresh_token) not in (REFRESH_TOKEN, None):
+                return None
+        except InvalidToken:
+            return None
+        token = OAuth2Token.query.get_by_refresh_token(refresh_token)
+        if token is None or token.is_refresh_expired:
+            return None
+        return token
+
+    def _verify_refresh_token(self, node, refresh_token):
+        token = self._get_refresh_token(refresh_token)
+        if token is None:
+            raise Invalid(node, 'A refresh token is invalid')
+        return token
+
+    def validator(self, node, cstruct):
+        self._authenticate_client(node, cstruct)
+
+        if cstruct['grant_type'] == 'refresh_token':
+            self.token = self._verify_refresh_token(
+                node, cstruct['refresh_token'])
+        elif cstruct['grant_type'] == Client.GRANT_TYPE_PASSWORD:
+            self.user = self._verify_user(
+                node, self.client, cstruct['username'])
+
+
+def _deserialize_string(cstruct):
+    return cstruct or null
+
+
+def _deserialize_string_set(cstruct):
+    return set(cstruct.split())
+
+
+class TokenRequestParser(object):
+    """A validator of token requests compiled once from an
+    :class:`OAuth2TokenSchema`, the reference implementation.
+
+    The ``String`` and ``StringSet`` parameters given as a ``str`` are
+    converted inline; any other value, a missing parameter and the errors
+    are handed to the nodes of the schema, so :meth:`parse` returns and
+    raises what ``deserialize`` would, without creating a schema for every
+    request.
+    """
+
+    _FAST_TYPES = {
+        String: _deserialize_string,
+        StringSet: _deserialize_string_set,
+        }
+
+    def __init__(self, schema=None):
+        self.schema = schema or OAuth2TokenSchema()
+        self._fields = tuple(
+            (num, node.name, node, self._compile(node))
+            for num, node in enumerate(self.schema.children))
+
+    def _compile(self, node):
+        if node.preparer is not None or \
+                getattr(node.typ, 'encoding', None) is not None:
+            return None
+        return self._FAST_TYPES.get(type(node.typ))
+
+    def parse(self, params):
+        """Validate the parameters of a token request.
+
+        :return: ``(cstruct, client, token, user)``, ``token`` is the
+            refresh token of a ``refresh_token`` grant and ``user`` the
+            user of a ``password`` grant
+        :raises colander.Invalid: The same error as the schema
+        """
+        schema = self.schema
+        if not hasattr(params, 'items'):
+            # Raises the "is not a mapping type" error.
+            schema.deserialize(params)
+
+        cstruct = {}
+        errors = None
+        for num, name, node, deserialize in self._fields:
+            cstruct_value = params.get(name, null)
+            try:
+                if deserialize is None or type(cstruct_value) is not str:
+                    cstruct[name] = node.deserialize(cstruct_value)
+                    continue
+                appstruct = deserialize(cstruct_value)
+                if appstruct is null:
+                    appstruct = node.deserialize(null)
+                elif node.validator is not None:
+                    node.validator(node, appstruct)
+                cstruct[name] = appstruct
+            except Invalid as e:
+                if errors is None:
+                    errors = Invalid(schema)
+                errors.add(e, num)
+        if errors is not None:
+            raise errors
+
+        client = schema._verify_client(
+            schema, cstruct['client_id'], cstruct['client_secret'])
+        token = user = None
+        if cstruct['grant_type'] == 'refresh_token':
+            token = schema._verify_refresh_token(
+                schema, cstruct['refresh_token'])
+        elif cstruct['grant_type'] == Client.GRANT_TYPE_PASSWORD:
+            user = schema._verify_user(schema, client, cstruct['username'])
+        return cstruct, client, token, user
+
+
+class OAuth2IntrospectSchema(ClientAuthenticationSchema):
+    """Validates a token introspection request.
+
+    Either ``token`` or, for a batch request, ``tokens`` is required.
+    """
+
+    MAX_TOKENS = 100
+
+    token = SchemaNode(String(), missing=None,)
+
+    tokens = SchemaNode(
+        StringList(), missing=None, validator=Length(1, MAX_TOKENS),)
+
+    token_type_hint = SchemaNode(
+        String(), missing=None,
+        validator=OneOf(['access_token', 'refresh_token']),)
 
     def validator(self, node, cstruct):
-        client_id = cstruct['client_id']
-        client_secret = cstruct['client_secret']
-        grant_type = cstruct['grant_type']
-        refresh_token = cstruct['refresh_token']
-
-        if client_id:
-            client = self._get_client(client_id)
-            if client is None:
-                raise Invalid(node, 'Client not exists')
-            if client.client_secret != client_secret:
-                raise Invalid(
-                    node, 'A client secret is invalid, %r : %r' % (
-                        client.client_secret, client_secret))
-
-        if grant_type == 'refresh_token':
-            token = self._get_refresh_token(refresh_token)
-            if token is None:
-                raise Invalid(node, 'A refresh token is invalid')
+        self._authenticate_client(node, cstruct)
+
+        if (cstruct['token'] is None) == (cstruct['tokens'] is None):
+            raise Invalid(node, 'Either token or tokens is required')
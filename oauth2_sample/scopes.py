@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from sqlalchemy import select
+
+from sqlalchemy.exc import DBAPIError
+
+from pyramid.exceptions import ConfigurationError
+
+__all__ = (
+    'ScopeRegistry',
+    'check_scope_bits',
+    'scope_registry',
+    )
+
+
+class ScopeRegistry(object):
+    """Assigns each known scope a bit, so a set of scopes is an integer
+    mask and a subset check is a single bitwise operation.
+
+    Bits are assigned in registration order and masks are stored in
+    ``oauth2_tokens.scope_mask``, so new scopes must only ever be appended;
+    :func:`check_scope_bits` enforces it. Masks of scope lists and
+    principals of masks are memoized.
+    """
+
+    #: ``oauth2_tokens.scope_mask`` is a signed 64 bit integer.
+    MAX_SCOPES = 63
+
+    #: Upper bound of the number of memoized masks and principals.
+    MAX_MEMOIZED = 4096
+
+    def __init__(self, scopes=()):
+        self._bits = {}
+        self._names = []
+        self._masks = {}
+        self._principals = {}
+        self._lock = threading.Lock()
+        for scope in scopes:
+            self.register(scope)
+
+    def __contains__(self, scope):
+        return scope in self._bits
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def register(self, scope):
+        """Assign ``scope`` the next free bit and return it."""
+        with self._lock:
+            bit = self._bits.get(scope)
+            if bit is not None:
+                return bit
+            if len(self._names) >= self.MAX_SCOPES:
+                raise ValueError(
+                    'Can not register more than %d scopes' % self.MAX_SCOPES)
+            bit = self._bits[scope] = 1 << len(self._names)
+            self._names.append(scope)
+            self._masks.clear()
+            return bit
+
+    def mask(self, scopes):
+        """Return the mask of ``scopes``, or ``None`` if any of them is not
+        registered.
+        """
+        if scopes is None:
+            return 0
+        key = frozenset(scopes) if isinstance(scopes, (set, frozenset)) \
+            else tuple(scopes)
+        try:
+            return self._masks[key]
+        except KeyError:
+            pass
+        mask = 0
+        bits = self._bits
+        for scope in key:
+            bit = bits.get(scope)
+            if bit is None:
+                mask = None
+                break
+            mask |= bit
+        if len(self._masks) < self.MAX_MEMOIZED:
+            self._masks[key] = mask
+        return mask
+
+    def scopes(self, mask):
+        """Return the scopes of ``mask`` in registration order."""
+        return tuple(name for i, name in enumerate(self._names)
+                     if mask & (1 << i))
+
+    def principals(self, mask):
+        """Return the ``s:<scope>`` principals of ``mask`` as a tuple."""
+        try:
+            return self._principals[mask]
+        except KeyError:
+            pass
+        principals = tuple('s:' + scope for scope in self.scopes(mask))
+        if len(self._principals) < self.MAX_MEMOIZED:
+            self._principals[mask] = principals
+        return principals
+
+    @staticmethod
+    def is_subset(mask, allowed):
+        return mask & allowed == mask
+
+
+#: The scopes known to this application, configured from ``oauth2.scopes``.
+scope_registry = ScopeRegistry()
+
+
+def check_scope_bits(engine, registry=scope_registry):
+    """Compare the bits of ``registry`` with the bits recorded in
+    ``oauth2_scopes`` on ``engine``, and record the bits of new scopes.
+
+    :raises pyramid.exceptions.ConfigurationError: A recorded scope has
+        another bit, or is not registered, as the stored masks would grant
+        other scopes
+    """
+    from .models import Scope
+
+    table = Scope.__table__
+    names = list(registry)
+    # Another process may create the table or record the bits first.
+    for attempt in range(2):
+        try:
+            table.create(engine, checkfirst=True)
+            with engine.begin() as conn:
+                stored = dict(conn.execute(
+                    select([table.c.bit, table.c.name])).fetchall())
+                for bit, name in sorted(stored.items()):
+                    if bit >= len(names) or names[bit] != name:
+                        raise ConfigurationError(
+                            'Scope %r has bit %d in the stored token '
+                            'masks, but the scopes are %r; oauth2.scopes '
+                            'may only be appended to' % (name, bit, names))
+                new = [{'bit': bit, 'name': name}
+                       for bit, name in enumerate(names) if bit not in stored]
+                if new:
+                    conn.execute(table.insert(), new)
+            return
+        except DBAPIError:
+            if attempt:
+                raise
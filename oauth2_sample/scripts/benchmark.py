@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import itertools
+import threading
+
+import arrow
+
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from webob import Request
+
+from pyramid.paster import get_appsettings
+
+from .. import main as make_app
+
+from ..credentials import client_secret_hasher
+
+from ..models import (
+    DBSession,
+    Base,
+    User,
+    Client,
+    )
+
+CLIENT_ID = 'benchmark-client'
+CLIENT_SECRET = 'benchmark-secret'
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, int(round(percent / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+class Benchmark(object):
+    """Drives an application built by :func:`oauth2_sample.main` against a
+    seeded SQLite file, in process.
+    """
+
+    def __init__(self, settings, db_path):
+        self.db_path = db_path
+        settings = dict(settings)
+        settings['sqlalchemy.url'] = 'sqlite:///%s' % db_path
+        settings.setdefault('pyramid.includes', 'pyramid_tm')
+        self.settings = settings
+        self.app = make_app({}, **settings)
+        self.engine = Base.metadata.bind
+        self.seed()
+        self._statements = itertools.count()
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._count_statement)
+
+    def _count_statement(self, *args):
+        next(self._statements)
+
+    def seed(self):
+        Base.metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            if conn.execute(Client.__table__.select().where(
+                    Client.client_id == CLIENT_ID)).first():
+                return
+            user_id = conn.execute(User.__table__.insert().values(
+                username='benchmark', email='benchmark@example.com',
+                password='!', name='benchmark', is_superuser=False,
+                is_staff=False, is_active=True,
+                created=arrow.utcnow(), updated=arrow.utcnow(),
+                )).inserted_primary_key[0]
+            conn.execute(Client.__table__.insert().values(
+                client_id=CLIENT_ID,
+                client_secret=client_secret_hasher.hash(CLIENT_SECRET),
+                client_type=Client.CLIENT_TYPE_CONFIDENTIAL,
+                grant_type=Client.GRANT_TYPE_CLIENT_CREDENTIALS,
+                default_scopes=['api1', 'api2', 'api3'],
+                user_id=user_id,
+                ))
+        DBSession.remove()
+
+    def request(self, method, path, params=None, headers=None):
+        request = Request.blank(
+            path, method=method, POST=params, headers=headers)
+        return request.get_response(self.app)
+
+    def issue_token(self, scope='api1 api2'):
+        response = self.request('POST', '/oauth2/token', {
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET,
+            'grant_type': 'client_credentials',
+            'scope': scope,
+            })
+        return response.json
+
+    def run(self, name, requests, concurrency, expected_status=None):
+        """Send ``requests``, a list of :meth:`request` arguments, from
+        ``concurrency`` threads and return the statistics.
+
+        Responses other than ``expected_status``, or any error status if
+        it is ``None``, are counted as errors.
+        """
+        latencies = []
+        errors = itertools.count()
+        lock = threading.Lock()
+
+        def send(args):
+            start = time.perf_counter()
+            response = self.request(*args)
+            elapsed = time.perf_counter() - start
+            status = response.status_int
+            if status != expected_status if expected_status \
+                    else status >= 400:
+                next(errors)
+            with lock:
+                latencies.append(elapsed)
+
+        statements_before = next(self._statements)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(send, requests))
+        duration = time.perf_counter() - start
+        # Both next() calls are counted, discount them.
+        statements = next(self._statements) - statements_before - 1
+
+        latencies.sort()
+        count = len(latencies)
+        return OrderedDict([
+            ('scenario', name),
+            ('requests', count),
+            ('errors', next(errors)),
+            ('concurrency', concurrency),
+            ('duration', round(duration, 4)),
+            ('requests_per_second', round(count / duration, 1)),
+            ('p50_ms', round(_percentile(latencies, 50) * 1000, 3)),
+            ('p95_ms', round(_percentile(latencies, 95) * 1000, 3)),
+            ('p99_ms', round(_percentile(latencies, 99) * 1000, 3)),
+            ('statements_per_request', round(statements / count, 2)),
+            ])
+
+
+def token_scenario(benchmark, n):
+    """Issue access tokens with the client credentials grant."""
+    params = {
+        'client_id': CLIENT_ID,
+        'client_secret': CLIENT_SECRET,
+        'grant_type': 'client_credentials',
+        'scope': 'api1 api2',
+        }
+    return [('POST', '/oauth2/token', params)] * n
+
+
+def refresh_scenario(benchmark, n):
+    """Refresh access tokens, every refresh token is used once."""
+    return [('POST', '/oauth2/token', {
+        'client_id': CLIENT_ID,
+        'client_secret': CLIENT_SECRET,
+        'grant_type': 'refresh_token',
+        'refresh_token': benchmark.issue_token()['refresh_token'],
+        }) for x in range(n)]
+
+
+def api_scenario(benchmark, n):
+    """Call an API with a valid access token."""
+    headers = {
+        'Authorization': 'Bearer %s' % benchmark.issue_token()['access_token'],
+        }
+    return [('GET', '/api/api1', None, headers)] * n
+
+
+def api_forbidden_scenario(benchmark, n):
+    """Call an API the access token has no scope for."""
+    headers = {
+        'Authorization': 'Bearer %s' % benchmark.issue_token(
+            scope='api1')['access_token'],
+        }
+    return [('GET', '/api/api3', None, headers)] * n
+
+
+SCENARIOS = OrderedDict([
+    ('token', token_scenario),
+    ('refresh', refresh_scenario),
+    ('api', api_scenario),
+    ('api_forbidden', api_forbidden_scenario),
+    ])
+
+#: The status of every response of a scenario, if not a success.
+EXPECTED_STATUS = {
+    'api_forbidden': 403,
+    }
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Benchmark the token and API endpoints in process.')
+    parser.add_argument(
+        'config_uri', nargs='?',
+        help='read the application settings from this file')
+    parser.add_argument(
+        '-n', '--requests', type=int, default=1000,
+        help='requests per scenario (default: 1000)')
+    parser.add_argument(
+        '-c', '--concurrency', type=int, action='append',
+        help='concurrent clients, may be repeated (default: 1)')
+    parser.add_argument(
+        '-s', '--scenario', action='append', choices=list(SCENARIOS),
+        help='scenario to run, may be repeated (default: all)')
+    parser.add_argument(
+        '--set', action='append', default=[], metavar='KEY=VALUE',
+        help='override an application setting, may be repeated')
+    parser.add_argument(
+        '--db', help='SQLite file to seed and use (default: a temporary '
+        'file, removed afterwards)')
+    parser.add_argument(
+        '-o', '--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv[1:])
+
+    settings = get_appsettings(args.config_uri) if args.config_uri else {}
+    settings = dict(settings)
+    for item in args.set:
+        key, sep, value = item.partition('=')
+        if not sep:
+            parser.error('--set expects KEY=VALUE, got %r' % item)
+        settings[key] = value
+
+    db_path = args.db
+    if db_path is None:
+        fd, db_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+    try:
+        benchmark = Benchmark(settings, db_path)
+        results = []
+        for name in args.scenario or list(SCENARIOS):
+            for concurrency in args.concurrency or [1]:
+                requests = SCENARIOS[name](benchmark, args.requests)
+                result = benchmark.run(
+                    name, requests, concurrency, EXPECTED_STATUS.get(name))
+                results.append(result)
+                print('%(scenario)-10s c=%(concurrency)-3d '
+                      '%(requests_per_second)9.1f req/s  '
+                      'p50 %(p50_ms)8.3fms  p95 %(p95_ms)8.3fms  '
+                      'p99 %(p99_ms)8.3fms  '
+                      '%(statements_per_request)5.2f stmt/req  '
+                      '%(errors)d errors' % result)
+    finally:
+        if args.db is None:
+            os.unlink(db_path)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([
+                ('created', time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                          time.gmtime())),
+                ('python', platform.python_version()),
+                ('settings', OrderedDict(
+                    (key, settings[key]) for key in sorted(settings)
+                    if key.startswith('oauth2.'))),
+                ('results', results),
+                ]), f, indent=2)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+from sqlalchemy import select
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.scripts.common import parse_vars
+
+from ..routing import primary_engine_from_config
+
+from ..credentials import configure_client_secret_hasher
+
+from ..models import Client
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def hash_client_secrets(engine, hasher, batch_size=1000):
+    """Replace the plain text client secrets with their digests, in
+    batches of ``batch_size`` clients.
+
+    :return: The number of clients converted
+    """
+    table = Client.__table__
+    converted = 0
+    last_client_id = ''
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select([table.c.client_id, table.c.client_secret])
+                .where(table.c.client_id > last_client_id)
+                .order_by(table.c.client_id)
+                .limit(batch_size)).fetchall()
+            if not rows:
+                return converted
+            for client_id, client_secret in rows:
+                if hasher.is_hashed(client_secret):
+                    continue
+                conn.execute(
+                    table.update()
+                    .where(table.c.client_id == client_id)
+                    .values(client_secret=hasher.hash(client_secret)))
+                converted += 1
+        last_client_id = rows[-1][0]
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    hasher = configure_client_secret_hasher(settings, 'oauth2.client_secret.')
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
+
+    print('hashed %d client secrets' % hash_client_secrets(engine, hasher))
@@ -4,8 +4,6 @@ import os
 import sys
 import transaction
 
-from sqlalchemy import engine_from_config
-
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
@@ -13,6 +11,10 @@ from pyramid.paster import (
 
 from pyramid.scripts.common import parse_vars
 
+from ..routing import primary_engine_from_config
+
+from ..credentials import configure_client_secret_hasher
+
 from ..models import (
     DBSession,
     Base,
@@ -36,7 +38,8 @@ def main(argv=sys.argv):
     options = parse_vars(argv[2:])
     setup_logging(config_uri)
     settings = get_appsettings(config_uri, options=options)
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    configure_client_secret_hasher(settings, 'oauth2.client_secret.')
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
     Base.metadata.create_all(engine)
 
@@ -53,4 +56,8 @@ def main(argv=sys.argv):
         client.grant_type = Client.GRANT_TYPE_CLIENT_CREDENTIALS
         client.default_scopes = ['api1', 'api2']
         client.user = user
+        client_secret = client.set_client_secret()
         DBSession.add(client)
+        DBSession.flush()
+        print('client_id: %s\nclient_secret: %s' % (
+            client.client_id, client_secret))
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import struct
+import logging
+import argparse
+import threading
+import configparser
+
+from pyramid.paster import (
+    get_app,
+    setup_logging,
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+
+class WorkerStats(object):
+    """The request counts of the worker slots, in an anonymous shared
+    mapping created by the master before it forks.
+
+    A slot is written by its worker, and reset by the master before it
+    forks the worker.
+    """
+
+    _SLOT = struct.Struct('<Q')
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._map = mmap.mmap(-1, self._SLOT.size * slots)
+
+    def get(self, slot):
+        return self._SLOT.unpack_from(self._map, slot * self._SLOT.size)[0]
+
+    def set(self, slot, requests):
+        self._SLOT.pack_into(self._map, slot * self._SLOT.size, requests)
+
+
+def count_requests(app, stats, slot):
+    """Wrap ``app`` to count its requests in ``slot`` of ``stats``."""
+    lock = threading.Lock()
+    count = [0]
+
+    def counting_app(environ, start_response):
+        with lock:
+            count[0] += 1
+            stats.set(slot, count[0])
+        return app(environ, start_response)
+
+    return counting_app
+
+
+def listen(host, port, backlog=1024):
+    """Return a socket listening on ``host:port`` with ``SO_REUSEPORT``, so
+    every worker has its own and the kernel balances the connections.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def _busy(server):
+    return any(channel.requests or channel.total_outbufs_len
+               for channel in list(server.active_channels.values()))
+
+
+def serve(app, sock, stopping, threads=4, graceful_timeout=30):
+    """Serve ``app`` on ``sock`` with waitress until ``stopping`` is set,
+    then stop accepting connections and finish the requests in progress
+    for at most ``graceful_timeout`` seconds.
+    """
+    from waitress import wasyncore
+    from waitress.server import create_server
+
+    socket_map = {}
+    server = create_server(app, map=socket_map, sockets=[sock],
+                           threads=threads)
+    while not stopping.is_set():
+        wasyncore.loop(timeout=1.0, map=socket_map, count=1)
+
+    server.del_channel()
+    sock.close()
+    deadline = time.monotonic() + graceful_timeout
+    while _busy(server) and time.monotonic() < deadline:
+        wasyncore.loop(timeout=0.1, map=socket_map, count=1)
+    server.task_dispatcher.shutdown(cancel_pending=True, timeout=1)
+    wasyncore.close_all(socket_map)
+
+
+class _Worker(object):
+
+    __slots__ = ('slot', 'started', 'ready', 'retiring')
+
+    def __init__(self, slot, started, ready):
+        self.slot = slot
+        self.started = started
+        self.ready = ready
+        self.retiring = False
+
+
+class PreforkServer(object):
+    """Fork ``workers`` processes that each load the application of
+    ``config_uri`` and serve it on ``host:port`` through ``SO_REUSEPORT``.
+
+    The application, and so its database engine, is created in every
+    worker after the fork. The master restarts a worker that exits, and
+    handles these signals:
+
+    ``HUP``
+        Replace the workers one by one with workers that load
+        ``config_uri`` again; a worker is stopped once its replacement is
+        ready. Only the configuration is reloaded: the master imports the
+        ``oauth2_sample`` package with this module, and the workers run the
+        code it imported, so new code needs a restart. The workers stopped
+        by the previous reload must exit before their slots are used
+        again.
+    ``TERM``, ``INT``
+        Stop the workers gracefully and exit.
+    ``USR1``
+        Print the request counts of the workers.
+    """
+
+    # A worker that exits sooner than this after it started is restarted
+    # after this delay, so a broken configuration does not fork in a loop.
+    RESTART_DELAY = 1.0
+
+    def __init__(self, config_uri, host, port, workers=2, threads=4,
+                 graceful_timeout=30, out=sys.stdout):
+        self.config_uri = config_uri
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.out = out
+        # Two slots per worker, old and new workers overlap in a reload.
+        self.stats = WorkerStats(workers * 2)
+        self.restarts = 0
+        self.exited_requests = 0
+        self._children = {}
+        self._restart_at = {}
+        self._signals = []
+        self._stopping = False
+        self._started = time.monotonic()
+
+    def _free_slot(self):
+        """Return a slot of no worker, or ``None``."""
+        used = set(w.slot for w in self._children.values())
+        used.update(self._restart_at)
+        free = set(range(self.stats.slots)) - used
+        return min(free) if free else None
+
+    def _wait_free_slot(self):
+        """Return a free slot, once a retiring worker of a previous reload
+        exited; it is killed after ``graceful_timeout``.
+        """
+        deadline = time.monotonic() + self.graceful_timeout + 1
+        while True:
+            self._reap()
+            slot = self._free_slot()
+            if slot is not None:
+                return slot
+            if time.monotonic() >= deadline:
+                for pid, worker in list(self._children.items()):
+                    if worker.retiring:
+                        self._kill(pid, signal.SIGKILL)
+            time.sleep(0.05)
+
+    def spawn(self, slot):
+        self.stats.set(slot, 0)
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            code = 1
+            try:
+                code = self._run_worker(slot, ready_w)
+            except BaseException:
+                logger.exception('Worker %d failed', os.getpid())
+            finally:
+                os._exit(code)
+        os.close(ready_w)
+        self._children[pid] = _Worker(slot, time.monotonic(), ready_r)
+        return pid
+
+    def _run_worker(self, slot, ready):
+        from ..interfaces import IAuditLog
+
+        stopping = threading.Event()
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGUSR1):
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+        # Listen once the application is loaded and warmed up.
+        app = get_app(self.config_uri)
+        sock = listen(self.host, self.port)
+        os.write(ready, b'1')
+        os.close(ready)
+        serve(count_requests(app, self.stats, slot), sock, stopping,
+              self.threads, self.graceful_timeout)
+        # The worker exits with os._exit, without the atexit handlers.
+        registry = getattr(app, 'registry', None)
+        audit_log = registry and registry.queryUtility(IAuditLog)
+        if audit_log is not None:
+            audit_log.close()
+        return 0
+
+    def _wait_ready(self, pid, timeout):
+        """Return ``True`` once the worker ``pid`` serves requests."""
+        worker = self._children[pid]
+        readable, _, _ = select.select([worker.ready], [], [], timeout)
+        return bool(readable) and os.read(worker.ready, 1) == b'1'
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self._children.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.ready)
+            self.exited_requests += self.stats.get(worker.slot)
+            if worker.retiring or self._stopping:
+                continue
+            logger.error('Worker %d exited with status %d, restarting',
+                         pid, status)
+            self.restarts += 1
+            delay = 0.0
+            if time.monotonic() - worker.started < self.RESTART_DELAY:
+                delay = self.RESTART_DELAY
+            self._restart_at[worker.slot] = time.monotonic() + delay
+
+    def _restart(self):
+        now = time.monotonic()
+        for slot, restart_at in list(self._restart_at.items()):
+            if restart_at <= now:
+                del self._restart_at[slot]
+                self.spawn(slot)
+
+    def reload(self):
+        """Replace every worker with a new one."""
+        for pid, worker in list(self._children.items()):
+            if worker.retiring:
+                continue
+            slot = self._wait_free_slot()
+            if pid not in self._children:
+                # Exited while waiting, it is restarted instead.
+                continue
+            new_pid = self.spawn(slot)
+            if not self._wait_ready(new_pid, self.graceful_timeout):
+                logger.error('Worker %d did not start, reload aborted',
+                             new_pid)
+                self._children[new_pid].retiring = True
+                self._kill(new_pid, signal.SIGKILL)
+                return False
+            worker.retiring = True
+            self._kill(pid, signal.SIGTERM)
+        logger.info('Reloaded %d workers', self.workers)
+        return True
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def stop(self):
+        self._stopping = True
+        for pid in list(self._children):
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 1
+        while self._children and time.monotonic() < deadline:
+            time.sleep(0.05)
+            self._reap()
+        for pid in list(self._children):
+            self._kill(pid, signal.SIGKILL)
+        while self._children:
+            time.sleep(0.05)
+            self._reap()
+
+    def status(self):
+        """Return the lines of the status of the workers."""
+        now = time.monotonic()
+        lines = []
+        total = self.exited_requests
+        for pid, worker in sorted(self._children.items()):
+            requests = self.stats.get(worker.slot)
+            total += requests
+            lines.append('worker %d: %d requests, up %ds%s' % (
+                pid, requests, now - worker.started,
+                ', stopping' if worker.retiring else ''))
+        lines.append(
+            'total: %d requests, %d workers, %d restarts, up %ds' % (
+                total, len(self._children), self.restarts,
+                now - self._started))
+        return lines
+
+    def print_status(self):
+        for line in self.status():
+            print(line, file=self.out)
+        self.out.flush()
+
+    def _handle(self, signum, frame):
+        self._signals.append(signum)
+
+    def run(self):
+        wakeup_r, wakeup_w = os.pipe()
+        for fd in (wakeup_r, wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(wakeup_w)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGUSR1, signal.SIGCHLD):
+            signal.signal(signum, self._handle)
+
+        for i in range(self.workers):
+            self.spawn(i)
+        logger.info('Serving %s on %s:%d with %d workers',
+                    self.config_uri, self.host, self.port, self.workers)
+
+        while True:
+            try:
+                select.select([wakeup_r], [], [], 1.0)
+                os.read(wakeup_r, 1024)
+            except (BlockingIOError, InterruptedError):
+                pass
+            signals, self._signals[:] = list(self._signals), []
+            if signal.SIGTERM in signals or signal.SIGINT in signals:
+                break
+            self._reap()
+            if signal.SIGHUP in signals:
+                try:
+                    self.reload()
+                except Exception:
+                    logger.exception('Reload failed')
+            if signal.SIGUSR1 in signals:
+                self.print_status()
+            self._restart()
+
+        self.stop()
+        self.print_status()
+
+
+def _server_address(config_uri):
+    """Return the ``host`` and ``port`` of ``[server:main]``."""
+    path = config_uri.split('#')[0]
+    parser = configparser.ConfigParser(defaults={
+        'here': os.path.dirname(os.path.abspath(path))})
+    parser.read(path)
+    return (parser.get('server:main', 'host', fallback='0.0.0.0'),
+            parser.getint('server:main', 'port', fallback=6543))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Serve the application with pre-forked worker '
+                    'processes sharing a port through SO_REUSEPORT.')
+    parser.add_argument('config_uri', help='e.g. "production.ini"')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=os.cpu_count() or 1,
+        help='worker processes (default: the number of CPUs)')
+    parser.add_argument(
+        '--threads', type=int, default=4,
+        help='waitress threads per worker (default: 4)')
+    parser.add_argument('--host', help='default: [server:main] host')
+    parser.add_argument(
+        '--port', type=int, help='default: [server:main] port')
+    parser.add_argument(
+        '--graceful-timeout', type=float, default=30,
+        help='seconds a stopping worker finishes its requests '
+             '(default: 30)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    host, port = _server_address(args.config_uri)
+    PreforkServer(
+        args.config_uri, args.host or host, args.port or port,
+        workers=args.workers, threads=args.threads,
+        graceful_timeout=args.graceful_timeout).run()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..routing import primary_engine_from_config
+
+from ..reaper import ensure_expires_index, reap_expired_tokens
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Delete expired OAuth2 tokens in batches.')
+    parser.add_argument('config_uri', help='e.g. "development.ini"')
+    parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='rows deleted per transaction (default: 1000)')
+    parser.add_argument(
+        '--grace', type=float, default=0,
+        help='seconds to keep a token after its refresh token expires '
+             '(default: 0)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
+    ensure_expires_index(engine)
+
+    total = 0
+    for batch in reap_expired_tokens(engine, args.batch_size, args.grace):
+        total += batch.rows
+        print('deleted %d rows in %.3fs' % (batch.rows, batch.elapsed))
+    print('deleted %d expired tokens' % total)
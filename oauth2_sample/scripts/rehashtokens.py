@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+
+from sqlalchemy import MetaData, Table, inspect, select
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..routing import primary_engine_from_config
+
+from ..bloom import rebuild_token_filter_from_config
+
+from ..models import OAuth2Token, token_digest
+
+#: The columns that held the tokens before they were stored as digests,
+#: and the digest column of each.
+LEGACY_COLUMNS = (
+    ('access_token', 'access_token_hash'),
+    ('refresh_token', 'refresh_token_hash'),
+    )
+
+
+def ensure_token_digest_columns(engine):
+    """Add the digest columns and their unique indexes to an existing
+    ``oauth2_tokens`` table.
+
+    :return: The names of the columns that were added
+    """
+    table = OAuth2Token.__table__
+    existing = set(c['name'] for c in inspect(engine).get_columns(table.name))
+    added = []
+    for legacy, name in LEGACY_COLUMNS:
+        if name in existing:
+            continue
+        column_type = table.c[name].type.compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, name, column_type))
+        for index in table.indexes:
+            if [c.name for c in index.columns] == [name]:
+                index.create(engine)
+        added.append(name)
+    return added
+
+
+def rehash_tokens(engine, batch_size=1000):
+    """Store the digests of the tokens still held in the legacy
+    ``access_token`` and ``refresh_token`` columns, and clear those, in
+    batches of ``batch_size`` rows.
+
+    :return: The number of rows rehashed
+    """
+    table = Table(OAuth2Token.__tablename__, MetaData(), autoload=True,
+                  autoload_with=engine)
+    legacy = [(table.c[old], table.c[new]) for old, new in LEGACY_COLUMNS
+              if old in table.c]
+    if not legacy:
+        return 0
+
+    rehashed = 0
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select([table.c.id] + [old for old, new in legacy])
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)).fetchall()
+            if not rows:
+                return rehashed
+            for row in rows:
+                values = {}
+                for (old, new), value in zip(legacy, row[1:]):
+                    if value is not None:
+                        values[new.name] = token_digest(value)
+                        values[old.name] = None
+                if values:
+                    conn.execute(table.update()
+                                 .where(table.c.id == row[0])
+                                 .values(**values))
+                    rehashed += 1
+        last_id = rows[-1][0]
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Replace the stored OAuth2 tokens with their digests.')
+    parser.add_argument('config_uri', help='e.g. "development.ini"')
+    parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='rows updated per transaction (default: 1000)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
+
+    for name in ensure_token_digest_columns(engine):
+        print('added column %s' % name)
+    print('rehashed %d tokens' % rehash_tokens(engine, args.batch_size))
+
+    count = rebuild_token_filter_from_config(engine, settings)
+    if count is not None:
+        print('rebuilt the token filter with %d tokens' % count)
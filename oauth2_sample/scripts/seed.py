@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import random
+import argparse
+import itertools
+
+from collections import namedtuple
+
+from datetime import datetime, timedelta
+
+import arrow
+
+from passlib.hash import bcrypt
+
+from sqlalchemy import select, func
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.settings import aslist
+
+from ..routing import primary_engine_from_config
+
+from ..bloom import rebuild_token_filter_from_config
+
+from ..credentials import client_secret_hasher, configure_client_secret_hasher
+
+from ..scopes import scope_registry
+
+from ..models import (
+    Base,
+    User,
+    Client,
+    OAuth2Token,
+    REFRESH_TOKEN_LIFETIME,
+    )
+
+#: The secret of every seeded client.
+CLIENT_SECRET = 'seed-secret'
+
+SeededBatch = namedtuple('SeededBatch', ('table', 'rows', 'elapsed'))
+
+
+def _chunks(rows, chunk_size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _insert(engine, table, rows, chunk_size):
+    for chunk in _chunks(rows, chunk_size):
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            conn.execute(table.insert(), chunk)
+        yield SeededBatch(table.name, len(chunk), time.perf_counter() - start)
+
+
+def _subset(rng, scopes):
+    """A non-empty subset of ``scopes``, mostly of one or two scopes."""
+    k = min(len(scopes), 1 + int(len(scopes) * rng.random() ** 2))
+    return sorted(rng.sample(scopes, k), key=scopes.index)
+
+
+def seed(engine, users, clients, tokens, password_hash, chunk_size=10000,
+         expired_ratio=0.3, expires_in=3600, expired_age=30 * 86400,
+         scopes=None, rng=None, now=None):
+    """Insert ``users`` users, ``clients`` clients and ``tokens`` tokens
+    with Core ``executemany`` statements of ``chunk_size`` rows, one
+    transaction each, generating the rows as they are inserted.
+
+    Every user has the password digest ``password_hash`` and every client
+    the secret :data:`CLIENT_SECRET`. A client has a random non-empty subset
+    of ``scopes`` and belongs to a random user. Tokens are spread over the
+    clients with a long tail, a few clients hold most of them, and request
+    a subset of the scopes of their client. ``expired_ratio`` of the tokens
+    expired up to ``expired_age`` seconds ago, the others expire within
+    ``expires_in`` seconds; a refresh token expires
+    :data:`oauth2_sample.models.REFRESH_TOKEN_LIFETIME` after it was
+    issued. The tokens themselves are never known, their digests are
+    random.
+
+    Yields a :class:`SeededBatch` per chunk.
+    """
+    rng = rng or random.Random()
+    now = now or datetime.utcnow()
+    scopes = list(scope_registry if scopes is None else scopes)
+    timestamp = arrow.get(now)
+
+    with engine.connect() as conn:
+        first_user_id = (conn.execute(
+            select([func.max(User.__table__.c.id)])).scalar() or 0) + 1
+    user_ids = range(first_user_id, first_user_id + users)
+
+    def user_rows():
+        for user_id in user_ids:
+            yield {
+                'id': user_id,
+                'username': 'seed%d' % user_id,
+                'email': 'seed%d@example.com' % user_id,
+                'password': password_hash,
+                'name': 'seed%d' % user_id,
+                'is_superuser': False,
+                'is_staff': rng.random() < 0.01,
+                'is_active': rng.random() < 0.98,
+                'created': timestamp,
+                'updated': timestamp,
+                }
+
+    for batch in _insert(engine, User.__table__, user_rows(), chunk_size):
+        yield batch
+
+    # (client_id, grant_type, default_scopes, user_id) of every client.
+    client_secret = client_secret_hasher.hash(CLIENT_SECRET)
+    seeded = []
+    for i in range(clients):
+        seeded.append((
+            'seed-%032x' % rng.getrandbits(128),
+            Client.GRANT_TYPE_PASSWORD if rng.random() < 0.2
+            else Client.GRANT_TYPE_CLIENT_CREDENTIALS,
+            _subset(rng, scopes),
+            rng.choice(user_ids)))
+
+    def client_rows():
+        for client_id, grant_type, default_scopes, user_id in seeded:
+            yield {
+                'client_id': client_id,
+                'client_secret': client_secret,
+                'client_type': Client.CLIENT_TYPE_CONFIDENTIAL,
+                'grant_type': grant_type,
+                'default_scopes': default_scopes,
+                'user_id': user_id,
+                'updated': timestamp,
+                }
+
+    for batch in _insert(engine, Client.__table__, client_rows(), chunk_size):
+        yield batch
+
+    def token_rows():
+        for i in range(tokens):
+            client_id, grant_type, default_scopes, user_id = \
+                seeded[int(len(seeded) * rng.random() ** 3)]
+            if grant_type == Client.GRANT_TYPE_PASSWORD:
+                user_id = rng.choice(user_ids)
+            if rng.random() < expired_ratio:
+                expires = now - timedelta(
+                    seconds=rng.uniform(0, expired_age))
+            else:
+                expires = now + timedelta(seconds=rng.uniform(1, expires_in))
+            token_scopes = _subset(rng, default_scopes)
+            yield {
+                'user_id': user_id,
+                'client_id': client_id,
+                'access_token_hash': rng.getrandbits(256).to_bytes(32, 'big'),
+                'refresh_token_hash': rng.getrandbits(256).to_bytes(
+                    32, 'big'),
+                'expires': expires,
+                'refresh_expires': expires - timedelta(seconds=expires_in)
+                + REFRESH_TOKEN_LIFETIME,
+                'scopes': token_scopes,
+                'scope_mask': scope_registry.mask(token_scopes),
+                }
+
+    if seeded:
+        for batch in _insert(
+                engine, OAuth2Token.__table__, token_rows(), chunk_size):
+            yield batch
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Fill the database with generated users, clients and '
+                    'tokens.')
+    parser.add_argument('config_uri', help='e.g. "development.ini"')
+    parser.add_argument(
+        '--users', type=int, default=100000,
+        help='users to insert (default: 100000)')
+    parser.add_argument(
+        '--clients', type=int, default=1000,
+        help='clients to insert (default: 1000)')
+    parser.add_argument(
+        '--tokens', type=int, default=1000000,
+        help='tokens to insert (default: 1000000)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='rows inserted per transaction (default: 10000)')
+    parser.add_argument(
+        '--expired-ratio', type=float, default=0.3,
+        help='share of expired tokens (default: 0.3)')
+    parser.add_argument(
+        '--password', default='password',
+        help='password of every user (default: "password")')
+    parser.add_argument(
+        '--seed', type=int, help='seed of the random generator')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    for scope in aslist(settings.get('oauth2.scopes', 'api1 api2 api3')):
+        scope_registry.register(scope)
+    configure_client_secret_hasher(settings, 'oauth2.client_secret.')
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
+    Base.metadata.create_all(engine)
+
+    # One bcrypt digest for every user, instead of 12 rounds per user.
+    password_hash = bcrypt.encrypt(args.password, rounds=12)
+    totals = {}
+    started = time.perf_counter()
+    for batch in seed(engine, args.users, args.clients, args.tokens,
+                      password_hash, args.chunk_size, args.expired_ratio,
+                      rng=random.Random(args.seed)):
+        totals[batch.table] = totals.get(batch.table, 0) + batch.rows
+        print('%s: inserted %d rows in %.3fs (%d rows/s)' % (
+            batch.table, batch.rows, batch.elapsed,
+            batch.rows / batch.elapsed if batch.elapsed else 0))
+    print('inserted %s in %.1fs, client secret: %s' % (
+        ', '.join('%d %s' % (rows, table) for table, rows in totals.items()),
+        time.perf_counter() - started, CLIENT_SECRET))
+
+    count = rebuild_token_filter_from_config(engine, settings)
+    if count is not None:
+        print('rebuilt the token filter with %d tokens' % count)
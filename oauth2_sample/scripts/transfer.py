@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import zlib
+import base64
+import argparse
+
+from collections import namedtuple
+
+from datetime import datetime
+
+import arrow
+
+from sqlalchemy import DateTime, LargeBinary, select, and_, or_, func
+
+from sqlalchemy_utils import ArrowType
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..routing import primary_engine_from_config
+
+from ..bloom import rebuild_token_filter_from_config
+
+from ..models import (
+    Base,
+    User,
+    Client,
+    OAuth2Token,
+    REFRESH_TOKEN_LIFETIME,
+    )
+
+#: The tables in the order they are exported and imported.
+TABLES = (User.__table__, Client.__table__, OAuth2Token.__table__)
+
+#: A chunk of ``rows`` rows of ``table``; ``offset`` is the offset of the
+#: next chunk in the file.
+TransferredChunk = namedtuple(
+    'TransferredChunk', ('table', 'rows', 'offset', 'elapsed'))
+
+
+def _encode(value):
+    if isinstance(value, arrow.Arrow):
+        return value.to('UTC').naive.isoformat()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, list):
+        return value
+    return getattr(value, 'code', value)
+
+
+def _parse_datetime(value):
+    """Parse the ``isoformat()`` of a naive datetime."""
+    return datetime.strptime(
+        value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def _decoder(column):
+    column_type = getattr(column.type, 'impl', column.type)
+    if isinstance(column.type, ArrowType):
+        # Exported in UTC.
+        return lambda value: arrow.get(_parse_datetime(value))
+    if isinstance(column_type, DateTime):
+        return _parse_datetime
+    if isinstance(column_type, LargeBinary):
+        return base64.b64decode
+    return None
+
+
+def _compress(lines):
+    compressor = zlib.compressobj(wbits=31)
+    return compressor.compress(b''.join(lines)) + compressor.flush()
+
+
+def export_tables(engine, fileobj, chunk_size=1000, now=None):
+    """Write the users, clients and the tokens whose refresh token has not
+    expired of ``engine`` to ``fileobj``, paging through every table by its
+    primary key.
+
+    Every chunk of at most ``chunk_size`` rows is a gzip member of JSON
+    lines, a header with the table and its columns followed by a list of
+    values per row, so the file can be read with ``zcat`` and a chunk can
+    be imported without the chunks before it.
+
+    Yields a :class:`TransferredChunk` per chunk.
+    """
+    now = now or datetime.utcnow()
+    offset = fileobj.tell()
+    for table in TABLES:
+        key = table.primary_key.columns.values()[0]
+        columns = list(table.c)
+        header = json.dumps({
+            'table': table.name, 'columns': [c.name for c in columns]})
+        query = select(columns).order_by(key).limit(chunk_size)
+        if table is OAuth2Token.__table__:
+            # Skip the rows whose refresh token expired, see
+            # OAuth2Token.refresh_token_expires.
+            query = query.where(or_(
+                table.c.refresh_expires > now,
+                and_(table.c.refresh_expires == None,  # noqa
+                     or_(table.c.expires == None,  # noqa
+                         table.c.expires > now - REFRESH_TOKEN_LIFETIME))))
+        last = None
+        while True:
+            start = time.perf_counter()
+            with engine.connect() as conn:
+                rows = conn.execute(
+                    query if last is None else query.where(key > last)
+                    ).fetchall()
+            if not rows:
+                break
+            lines = [header.encode('utf-8') + b'\n']
+            for row in rows:
+                lines.append(json.dumps(
+                    [_encode(value) for value in row]).encode('utf-8') + b'\n')
+            offset += fileobj.write(_compress(lines))
+            last = rows[-1][key.name]
+            yield TransferredChunk(
+                table.name, len(rows), offset, time.perf_counter() - start)
+
+
+def read_chunks(fileobj, offset=0, read_size=65536):
+    """Read the chunks of an export from ``offset`` on.
+
+    Yields the offset of the next chunk, the header and the rows of every
+    chunk.
+    """
+    fileobj.seek(offset)
+    data = b''
+    while True:
+        decompressor = zlib.decompressobj(wbits=31)
+        fed = 0
+        parts = []
+        while not decompressor.eof:
+            if not data:
+                data = fileobj.read(read_size)
+                if not data:
+                    if fed:
+                        raise ValueError(
+                            'Truncated chunk at offset %d' % offset)
+                    return
+            fed += len(data)
+            parts.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+        offset += fed - len(data)
+        lines = b''.join(parts).splitlines()
+        yield offset, json.loads(lines[0].decode('utf-8')), \
+            [json.loads(line.decode('utf-8')) for line in lines[1:]]
+
+
+def import_tables(engine, fileobj, offset=0):
+    """Insert the chunks of an export read from ``offset`` on into
+    ``engine``, one transaction per chunk.
+
+    When resuming, at an ``offset`` after the first chunk, the chunk at
+    ``offset`` is skipped if the row of its first primary key exists, as
+    it was committed by an import that stopped before it recorded the
+    chunk.
+
+    Yields a :class:`TransferredChunk` per chunk inserted.
+    """
+    tables = dict((table.name, table) for table in TABLES)
+    resuming = offset > 0
+    for next_offset, header, rows in read_chunks(fileobj, offset):
+        start = time.perf_counter()
+        table = tables[header['table']]
+        columns = [table.c[name] for name in header['columns']]
+        decoders = [(c.name, _decoder(c)) for c in columns]
+        values = []
+        for row in rows:
+            values.append(dict(
+                (name, value if decoder is None or value is None
+                 else decoder(value))
+                for (name, decoder), value in zip(decoders, row)))
+        with engine.begin() as conn:
+            if resuming:
+                key = table.primary_key.columns.values()[0]
+                resuming = False
+                if conn.execute(select([func.count()]).where(
+                        key == values[0][key.name])).scalar():
+                    continue
+            conn.execute(table.insert(), values)
+        yield TransferredChunk(
+            table.name, len(values), next_offset, time.perf_counter() - start)
+
+
+def _reset_sequences(engine):
+    """Move the sequences of the ``SERIAL`` columns of PostgreSQL past the
+    imported ids.
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+    with engine.begin() as conn:
+        for table in (User.__table__, OAuth2Token.__table__):
+            conn.execute(
+                "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                "COALESCE(MAX(id), 0) + 1, false) FROM %s" % (
+                    table.name, table.name))
+
+
+def _print_chunk(verb, chunk):
+    print('%s: %s %d rows in %.3fs, offset %d' % (
+        chunk.table, verb, chunk.rows, chunk.elapsed, chunk.offset))
+
+
+def export_main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Export the users, clients and the tokens that can '
+                    'still be used or refreshed to a file of gzip '
+                    'compressed JSON lines.')
+    parser.add_argument('config_uri', help='e.g. "development.ini"')
+    parser.add_argument('path', help='e.g. "tokens.jsonl.gz"')
+    parser.add_argument(
+        '--chunk-size', type=int, default=1000,
+        help='rows read per query and compressed per chunk '
+             '(default: 1000)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
+
+    totals = {}
+    with open(args.path, 'wb') as f:
+        for chunk in export_tables(engine, f, args.chunk_size):
+            totals[chunk.table] = totals.get(chunk.table, 0) + chunk.rows
+            _print_chunk('exported', chunk)
+    print('exported %s' % ', '.join(
+        '%d %s' % (rows, table) for table, rows in totals.items()))
+
+
+def import_main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Import a file written by export_oauth2_sample_db, '
+                    'resuming from the last chunk imported.')
+    parser.add_argument('config_uri', help='e.g. "production.ini"')
+    parser.add_argument('path', help='e.g. "tokens.jsonl.gz"')
+    parser.add_argument(
+        '--checkpoint',
+        help='file holding the offset of the next chunk '
+             '(default: <path>.checkpoint)')
+    args = parser.parse_args(argv[1:])
+    checkpoint = args.checkpoint or args.path + '.checkpoint'
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = primary_engine_from_config(settings, 'sqlalchemy.')
+    Base.metadata.create_all(engine)
+
+    offset = 0
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            offset = json.load(f)['offset']
+        print('resuming at offset %d' % offset)
+
+    totals = {}
+    with open(args.path, 'rb') as f:
+        for chunk in import_tables(engine, f, offset):
+            totals[chunk.table] = totals.get(chunk.table, 0) + chunk.rows
+            with open(checkpoint + '.tmp', 'w') as c:
+                json.dump({'offset': chunk.offset}, c)
+            os.replace(checkpoint + '.tmp', checkpoint)
+            _print_chunk('imported', chunk)
+    _reset_sequences(engine)
+    if os.path.exists(checkpoint):
+        os.unlink(checkpoint)
+    print('imported %s' % ', '.join(
+        '%d %s' % (rows, table) for table, rows in totals.items()))
+
+    count = rebuild_token_filter_from_config(engine, settings)
+    if count is not None:
+        print('rebuilt the token filter with %d tokens' % count)
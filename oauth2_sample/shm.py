@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import mmap
+
+import time
+
+import fcntl
+
+import struct
+
+import threading
+
+__all__ = (
+    'SharedTable',
+    )
+
+_MAGIC = b'O2SHM001'
+
+# magic, slots, value size.
+_HEADER = struct.Struct('<8sII')
+_HEADER_SIZE = 64
+
+# sequence, padding, key, deadline.
+_SLOT_HEADER = struct.Struct('<II16sd')
+
+_SEQ = struct.Struct('<I')
+
+_EMPTY_KEY = b'\0' * 16
+
+# States of the slot returned by SharedTable._find().
+_FOUND, _FREE, _EVICT = range(3)
+
+
+class SharedTable(object):
+    """A fixed-size hash table in a memory-mapped file, shared by every
+    process that maps the same ``path``.
+
+    Keys are 16 byte digests, values are ``value_size`` bytes and every
+    entry has a deadline after which it is ignored. The table uses open
+    addressing: an entry lives in one of the ``probes`` slots following
+    its home slot. When all of them are in use, the entry closest to its
+    deadline is evicted.
+
+    Reads are lock-free. Every slot carries a sequence number that a
+    writer makes odd while it updates the slot, and a reader retries when
+    the sequence number is odd or changed while it read the slot. Writers
+    are serialized by an exclusive ``flock`` on the file.
+    """
+
+    def __init__(self, path, slots, value_size, probes=8, clock=time.time):
+        self.path = path
+        self.slots = slots
+        self.value_size = value_size
+        self.probes = min(probes, slots)
+        self.slot_size = (_SLOT_HEADER.size + value_size + 7) & ~7
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        size = _HEADER_SIZE + self.slots * self.slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, _HEADER.pack(
+                    _MAGIC, self.slots, self.value_size), 0)
+            magic, slots, value_size = _HEADER.unpack(
+                os.pread(self._fd, _HEADER.size, 0))
+            if (magic, slots, value_size) != \
+                    (_MAGIC, self.slots, self.value_size):
+                raise ValueError(
+                    '%s was created with a different layout, remove it to '
+                    'recreate the table' % path)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _offsets(self, key):
+        home = int.from_bytes(key[:8], 'little') % self.slots
+        for i in range(self.probes):
+            yield _HEADER_SIZE + ((home + i) % self.slots) * self.slot_size
+
+    def _read(self, offset):
+        """Return a consistent ``(key, deadline, value)`` of a slot, or
+        ``None`` if a writer kept it busy.
+        """
+        buf = self._map
+        for attempt in range(4):
+            seq, _, key, deadline = _SLOT_HEADER.unpack_from(buf, offset)
+            if seq & 1:
+                continue
+            start = offset + _SLOT_HEADER.size
+            value = buf[start:start + self.value_size]
+            if _SEQ.unpack_from(buf, offset)[0] == seq:
+                return key, deadline, value
+        return None
+
+    def _write(self, offset, key, deadline, value):
+        buf = self._map
+        seq = _SEQ.unpack_from(buf, offset)[0]
+        _SEQ.pack_into(buf, offset, (seq + 1) & 0xffffffff)
+        _SLOT_HEADER.pack_into(
+            buf, offset, (seq + 1) & 0xffffffff, 0, key, deadline)
+        start = offset + _SLOT_HEADER.size
+        buf[start:start + len(value)] = value
+        _SEQ.pack_into(buf, offset, (seq + 2) & 0xffffffff)
+
+    def _locked(self):
+        return _FileLock(self._lock, self._fd)
+
+    def get(self, key):
+        """Return the value of ``key``, or ``None`` if it is missing or
+        past its deadline.
+        """
+        now = self._clock()
+        for offset in self._offsets(key):
+            slot = self._read(offset)
+            if slot is not None and slot[0] == key:
+                return slot[2] if slot[1] > now else None
+        return None
+
+    def _find(self, key, now):
+        """Return the offset of the slot of ``key``, or of the slot to
+        store it in, and whether that slot holds ``key``, is free, or holds
+        a live entry to evict. Must be called with the lock held.
+        """
+        target = None
+        oldest = None
+        oldest_deadline = None
+        for offset in self._offsets(key):
+            slot_key, slot_deadline = _SLOT_HEADER.unpack_from(
+                self._map, offset)[2:]
+            if slot_key == key:
+                return offset, _FOUND
+            if slot_key == _EMPTY_KEY or slot_deadline <= now:
+                if target is None:
+                    target = offset
+            elif oldest is None or slot_deadline < oldest_deadline:
+                oldest, oldest_deadline = offset, slot_deadline
+        if target is not None:
+            return target, _FREE
+        return oldest, _EVICT
+
+    def set(self, key, value, deadline):
+        """Store ``value`` under ``key`` until ``deadline``. Returns
+        ``True`` if a live entry was evicted to make room.
+        """
+        value = value.ljust(self.value_size, b'\0')
+        now = self._clock()
+        with self._locked():
+            offset, state = self._find(key, now)
+            self._write(offset, key, deadline, value)
+        return state == _EVICT
+
+    def update(self, key, function):
+        """Atomically replace the value of ``key`` with the ``(value,
+        deadline)`` returned by ``function(value)``, where ``value`` is
+        ``None`` if ``key`` is missing or past its deadline.
+
+        :return: The new value
+        """
+        now = self._clock()
+        with self._locked():
+            offset, state = self._find(key, now)
+            current = None
+            if state == _FOUND and \
+                    _SLOT_HEADER.unpack_from(self._map, offset)[3] > now:
+                start = offset + _SLOT_HEADER.size
+                current = self._map[start:start + self.value_size]
+            value, deadline = function(current)
+            self._write(
+                offset, key, deadline, value.ljust(self.value_size, b'\0'))
+        return value
+
+    def delete(self, key):
+        with self._locked():
+            for offset in self._offsets(key):
+                if _SLOT_HEADER.unpack_from(self._map, offset)[2] == key:
+                    self._write(offset, _EMPTY_KEY, 0.0, b'')
+
+    def clear(self):
+        with self._locked():
+            for i in range(self.slots):
+                offset = _HEADER_SIZE + i * self.slot_size
+                if _SLOT_HEADER.unpack_from(self._map, offset)[2] != \
+                        _EMPTY_KEY:
+                    self._write(offset, _EMPTY_KEY, 0.0, b'')
+
+    def evict_expired(self):
+        """Empty every slot past its deadline, returns how many."""
+        now = self._clock()
+        evicted = 0
+        with self._locked():
+            for i in range(self.slots):
+                offset = _HEADER_SIZE + i * self.slot_size
+                key, deadline = _SLOT_HEADER.unpack_from(
+                    self._map, offset)[2:]
+                if key != _EMPTY_KEY and deadline <= now:
+                    self._write(offset, _EMPTY_KEY, 0.0, b'')
+                    evicted += 1
+        return evicted
+
+    def __len__(self):
+        now = self._clock()
+        count = 0
+        for i in range(self.slots):
+            key, deadline = _SLOT_HEADER.unpack_from(
+                self._map, _HEADER_SIZE + i * self.slot_size)[2:]
+            if key != _EMPTY_KEY and deadline > now:
+                count += 1
+        return count
+
+
+class _FileLock(object):
+
+    def __init__(self, lock, fd):
+        self._lock = lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
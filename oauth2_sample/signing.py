@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+
+import json
+
+import time
+
+import base64
+
+import hashlib
+
+from collections import OrderedDict
+
+from datetime import datetime
+
+from zope.interface import implementer
+
+from pyramid.exceptions import ConfigurationError
+
+from pyramid.settings import aslist
+
+from .cache import CachedToken
+
+from .interfaces import ITokenSigner
+
+__all__ = (
+    'TokenSigner',
+    'token_signer_from_config',
+    )
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+@implementer(ITokenSigner)
+class TokenSigner(object):
+    """Issue and verify HMAC-SHA256 signed access tokens.
+
+    A signed token looks like ``<key id>.<claims>.<signature>``, where the
+    claims are base64url encoded JSON holding the scopes, the expiry and
+    the client and user ids. The first key of ``keyring`` signs new
+    tokens, every key of ``keyring`` is accepted when verifying, so keys
+    can be rotated by prepending a new one and dropping the oldest once
+    its tokens have expired.
+    """
+
+    def __init__(self, keyring, clock=time.time):
+        if not keyring:
+            raise ValueError('A keyring requires at least one key')
+        self.keyring = OrderedDict(
+            (kid, secret.encode('utf-8')
+             if not isinstance(secret, bytes) else secret)
+            for kid, secret in keyring)
+        self.active_kid = next(iter(self.keyring))
+        self._clock = clock
+
+    def _signature(self, secret, signing_input):
+        return hmac.new(secret, signing_input, hashlib.sha256).digest()
+
+    def sign(self, scopes, expires, client_id, user_id):
+        claims = {
+            's': sorted(scopes or ()),
+            'e': int((expires - _EPOCH).total_seconds()),
+            'c': client_id,
+            'u': user_id,
+            }
+        payload = _b64encode(
+            json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        signing_input = '%s.%s' % (self.active_kid, payload)
+        signature = self._signature(
+            self.keyring[self.active_kid], signing_input.encode('ascii'))
+        return '%s.%s' % (signing_input, _b64encode(signature))
+
+    def is_signed(self, token):
+        return token.count('.') == 2
+
+    def verify(self, token):
+        try:
+            kid, payload, signature = token.split('.')
+        except ValueError:
+            return None
+        secret = self.keyring.get(kid)
+        if secret is None:
+            return None
+        try:
+            signing_input = ('%s.%s' % (kid, payload)).encode('ascii')
+            signature = _b64decode(signature)
+        except (UnicodeError, ValueError):
+            return None
+        if not hmac.compare_digest(
+                self._signature(secret, signing_input), signature):
+            return None
+        claims = json.loads(_b64decode(payload).decode('utf-8'))
+        if claims['e'] <= self._clock():
+            return None
+        return CachedToken(
+            tuple(claims['s']), datetime.utcfromtimestamp(claims['e']),
+            claims['u'], claims['c'])
+
+
+def token_signer_from_config(settings, prefix='oauth2.signing.'):
+    """Create a :class:`TokenSigner` from ``settings``.
+
+    The keyring is a list of ``<key id>:<secret>`` pairs, the first of
+    which signs new tokens::
+
+        oauth2.token_format = signed
+        oauth2.signing.keys =
+            2016-02:new-secret
+            2016-01:old-secret
+    """
+    keyring = []
+    for item in aslist(settings.get(prefix + 'keys', '')):
+        kid, sep, secret = item.partition(':')
+        if not sep or not kid or not secret or '.' in kid:
+            raise ConfigurationError(
+                'Invalid signing key %r in %skeys' % (kid, prefix))
+        keyring.append((kid, secret))
+    if not keyring:
+        raise ConfigurationError('%skeys is required' % prefix)
+    return TokenSigner(keyring)
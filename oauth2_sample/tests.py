@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 import unittest
 
 from unittest.mock import MagicMock
@@ -7,9 +9,20 @@ from unittest.mock import MagicMock
 
 class DummyClient(object):
 
-    def __init__(self, client_id=None, client_secret=None):
+    def __init__(self, client_id=None, client_secret=None,
+                 grant_type='client_credentials'):
         self.client_id = client_id
         self.client_secret = client_secret
+        self.grant_type = grant_type
+
+    def verify_client_secret(self, raw_secret):
+        return self.client_secret == raw_secret
+
+
+def _slow_equal(a, b):
+    import time
+    time.sleep(0.5)
+    return a == b
 
 
 class StringSetTestCase(unittest.TestCase):
@@ -54,6 +67,8 @@ class OAuth2TokenSchemaTestCase(unittest.TestCase):
                 'grant_type': Client.GRANT_TYPE_CLIENT_CREDENTIALS,
                 'refresh_token': None,
                 'scope': {'view', 'write'},
+                'username': None,
+                'password': None,
                 },
             schema.deserialize({
                 'client_id': 'client_id',
@@ -79,6 +94,8 @@ class OAuth2TokenSchemaTestCase(unittest.TestCase):
                 'grant_type': 'refresh_token',
                 'refresh_token': 'refresh_token',
                 'scope': None,
+                'username': None,
+                'password': None,
                 },
             schema.deserialize({
                 'client_id': 'client_id',
@@ -87,3 +104,2091 @@ class OAuth2TokenSchemaTestCase(unittest.TestCase):
                 'refresh_token': 'refresh_token',
                 })
             )
+
+
+class TokenRequestParserTestCase(unittest.TestCase):
+    """The parser must agree with :class:`OAuth2TokenSchema`."""
+
+    clients = {
+        'client_id': DummyClient('client_id', 'client_secret'),
+        'password_client': DummyClient(
+            'password_client', 'client_secret', 'password'),
+        }
+
+    users = {
+        'foo': MagicMock(is_active=True),
+        'inactive': MagicMock(is_active=False),
+        }
+
+    def make_schema(self):
+        from oauth2_sample.schemas import OAuth2TokenSchema
+
+        schema = OAuth2TokenSchema()
+        schema._get_client = self.clients.get
+        schema._get_refresh_token = {'refresh_token': 'token'}.get
+        schema._get_user = self.users.get
+        return schema
+
+    def assertAgrees(self, params):
+        import colander
+        from oauth2_sample.schemas import TokenRequestParser
+        from oauth2_sample.views import _serialze_colandar_invalid
+
+        schema = self.make_schema()
+        try:
+            expected = (schema.deserialize(params), schema.client,
+                        schema.token, schema.user)
+        except colander.Invalid as e:
+            expected = _serialze_colandar_invalid(e)
+        try:
+            result = TokenRequestParser(self.make_schema()).parse(params)
+        except colander.Invalid as e:
+            result = _serialze_colandar_invalid(e)
+        self.assertEqual(expected, result, params)
+
+    def test_parameters(self):
+        import itertools
+
+        values = {
+            'client_id': ('', 'client_id', 'unknown', None, 1,
+                          ['client_id']),
+            'client_secret': ('', 'client_secret', 'wrong', 0, {'a': 1}),
+            'grant_type': ('', 'client_credentials', 'refresh_token', 5),
+            'scope': ('', 'api1  api2', ['api1'], None, 1, b'api1'),
+            'refresh_token': ('', 'refresh_token', 'wrong', 2),
+            }
+        names = sorted(values)
+        absent = object()
+        for combination in itertools.product(
+                *((absent,) + values[name] for name in names)):
+            self.assertAgrees(dict(
+                (name, value) for name, value in zip(names, combination)
+                if value is not absent))
+
+    def test_password_grant(self):
+        import itertools
+
+        values = {
+            'client_id': ('client_id', 'password_client'),
+            'grant_type': ('password', 'client_credentials'),
+            'username': ('', 'foo', 'inactive', 'unknown', 1),
+            'password': ('', 'password', ['password']),
+            }
+        names = sorted(values)
+        absent = object()
+        for combination in itertools.product(
+                *((absent,) + values[name] for name in names)):
+            params = dict(
+                (name, value) for name, value in zip(names, combination)
+                if value is not absent)
+            params['client_secret'] = 'client_secret'
+            self.assertAgrees(params)
+
+    def test_multidict(self):
+        from webob.multidict import MultiDict, NestedMultiDict
+
+        params = MultiDict([
+            ('client_id', 'unknown'), ('client_id', 'client_id'),
+            ('client_secret', 'client_secret'), ('scope', 'api1'),
+            ('grant_type', 'client_credentials'), ('scope', 'api2')])
+        self.assertAgrees(params)
+        self.assertAgrees(NestedMultiDict(
+            MultiDict(grant_type='refresh_token'), params))
+
+    def test_not_a_mapping(self):
+        for params in ([], 'client_id', None, 1, [('client_id', 'x')]):
+            self.assertAgrees(params)
+
+    def test_unhashable_scope(self):
+        import colander
+        from oauth2_sample.schemas import TokenRequestParser
+
+        params = {'client_id': 'client_id', 'client_secret': 'client_secret',
+                  'grant_type': 'client_credentials', 'scope': [['api1']]}
+        with self.assertRaises(colander.Invalid) as cm:
+            TokenRequestParser(self.make_schema()).parse(params)
+        self.assertEqual(['scope'], list(cm.exception.asdict()))
+        self.assertAgrees(params)
+
+
+class DummyClock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def _make_entry(self, expires=None):
+        from datetime import datetime, timedelta
+        from oauth2_sample.cache import CachedToken
+        if expires is None:
+            expires = datetime.utcnow() + timedelta(hours=1)
+        return CachedToken(('api1',), expires, 1, 'client_id')
+
+    def test_hit_and_miss(self):
+        from oauth2_sample.cache import TokenCache
+
+        cache = TokenCache(max_size=10, ttl=60)
+        entry = self._make_entry()
+
+        self.assertIsNone(cache.get('token'))
+        cache.set('token', entry)
+        self.assertEqual(entry, cache.get('token'))
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1},
+            cache.stats())
+
+    def test_evict_least_recently_used(self):
+        from oauth2_sample.cache import TokenCache
+
+        cache = TokenCache(max_size=2, ttl=60)
+        entry = self._make_entry()
+
+        cache.set('a', entry)
+        cache.set('b', entry)
+        cache.get('a')
+        cache.set('c', entry)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(entry, cache.get('a'))
+        self.assertEqual(entry, cache.get('c'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_ttl_is_capped_by_token_expires(self):
+        from datetime import datetime
+        from oauth2_sample.cache import TokenCache
+
+        clock = DummyClock(1000.0)
+        cache = TokenCache(max_size=10, ttl=60, clock=clock)
+        # The token expires 10 seconds from now.
+        cache.set('token', self._make_entry(datetime.utcfromtimestamp(1010)))
+
+        clock.now = 1009.0
+        self.assertIsNotNone(cache.get('token'))
+        clock.now = 1010.0
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+        # An already expired token is not cached at all.
+        cache.set('token', self._make_entry(datetime.utcfromtimestamp(900)))
+        self.assertEqual(0, len(cache))
+
+    def test_invalidate(self):
+        from oauth2_sample.cache import TokenCache
+
+        cache = TokenCache(max_size=10, ttl=60)
+        cache.set('token', self._make_entry())
+        cache.invalidate('token')
+        self.assertIsNone(cache.get('token'))
+
+
+class OAuth2AuthenticationPolicyTestCase(unittest.TestCase):
+
+    def test_callback_uses_token_cache(self):
+        from datetime import datetime, timedelta
+        from unittest.mock import patch
+        from oauth2_sample.authentication import OAuth2AuthenticationPolicy
+        from oauth2_sample.cache import TokenCache
+        from oauth2_sample.scopes import ScopeRegistry
+        from oauth2_sample.tokens import ACCESS_TOKEN, generate_token
+
+        token = MagicMock(
+            scopes=['api1', 'api2'], user_id=1, client_id='client_id',
+            expires=datetime.utcnow() + timedelta(hours=1), scope_mask=None)
+        request = MagicMock(context=object())
+        policy = OAuth2AuthenticationPolicy(
+            token_cache=TokenCache(max_size=10, ttl=60),
+            scope_registry=ScopeRegistry(['api1', 'api2']))
+
+        access_token = generate_token(ACCESS_TOKEN)
+
+        with patch('oauth2_sample.authentication.OAuth2Token') as model:
+            model.query.get_by_access_token.return_value = token
+            self.assertEqual(
+                ['s:api1', 's:api2'],
+                list(policy.callback(access_token, request)))
+            self.assertEqual(
+                ['s:api1', 's:api2'],
+                list(policy.callback(access_token, request)))
+            self.assertEqual(1, model.query.get_by_access_token.call_count)
+
+    def test_callback_with_unregistered_scopes(self):
+        from datetime import datetime, timedelta
+        from unittest.mock import patch
+        from oauth2_sample.authentication import OAuth2AuthenticationPolicy
+        from oauth2_sample.scopes import ScopeRegistry
+        from oauth2_sample.tokens import ACCESS_TOKEN, generate_token
+
+        token = MagicMock(
+            scopes=['api1', 'other'], user_id=1, client_id='client_id',
+            expires=datetime.utcnow() + timedelta(hours=1), scope_mask=None)
+        context = MagicMock()
+        context.group_finder.return_value = ['g:staff']
+        policy = OAuth2AuthenticationPolicy(
+            scope_registry=ScopeRegistry(['api1']))
+
+        with patch('oauth2_sample.authentication.OAuth2Token') as model:
+            model.query.get_by_access_token.return_value = token
+            self.assertEqual(
+                ['s:api1', 's:other', 'g:staff'],
+                policy.callback(generate_token(ACCESS_TOKEN),
+                                MagicMock(context=context)))
+
+    def test_callback_rejects_invalid_tokens_without_lookup(self):
+        from unittest.mock import patch
+        from oauth2_sample.authentication import OAuth2AuthenticationPolicy
+        from oauth2_sample.metrics import Metrics
+        from oauth2_sample.tokens import (
+            ACCESS_TOKEN, REFRESH_TOKEN, generate_token)
+
+        metrics = Metrics()
+        request = MagicMock(context=object())
+        request.registry.queryUtility.return_value = metrics
+        policy = OAuth2AuthenticationPolicy()
+        access_token = generate_token(ACCESS_TOKEN)
+
+        with patch('oauth2_sample.authentication.OAuth2Token') as model:
+            for token in ('garbage', access_token[:-1] + '_',
+                          access_token[:-6] + 'aaaaaa',
+                          generate_token(REFRESH_TOKEN)):
+                self.assertEqual((), policy.callback(token, request))
+            self.assertEqual(0, model.query.get_by_access_token.call_count)
+        self.assertEqual(
+            2, metrics.counter('rejected_tokens_total', reason='malformed'))
+        self.assertEqual(
+            1, metrics.counter('rejected_tokens_total', reason='checksum'))
+        self.assertEqual(
+            1, metrics.counter('rejected_tokens_total', reason='wrong_type'))
+
+
+class TokenTypeTestCase(unittest.TestCase):
+
+    def test_token_type(self):
+        from oauth2_sample.tokens import (
+            ACCESS_TOKEN, REFRESH_TOKEN, InvalidToken, generate_token,
+            token_issued_at, token_type)
+
+        self.assertEqual(
+            ACCESS_TOKEN, token_type(generate_token(ACCESS_TOKEN)))
+        self.assertEqual(
+            REFRESH_TOKEN, token_type(generate_token(REFRESH_TOKEN)))
+        # Tokens issued by earlier versions.
+        self.assertIsNone(token_type('a' * 30))
+        self.assertEqual(1455000000, token_issued_at(
+            generate_token(ACCESS_TOKEN, now=1455000000.5)))
+        self.assertIsNone(token_issued_at('a' * 30))
+
+        token = generate_token(ACCESS_TOKEN)
+        for garbage, reason in (
+                ('', 'malformed'),
+                ('xx_' + token[3:], 'malformed'),
+                ('a' * 29 + '!', 'malformed'),
+                ('rt_' + token[3:], 'checksum'),
+                (token[:10] + ('b' if token[10] == 'a' else 'a') +
+                 token[11:], 'checksum')):
+            with self.assertRaises(InvalidToken) as cm:
+                token_type(garbage)
+            self.assertEqual(reason, cm.exception.reason)
+
+
+class ScopeRegistryTestCase(unittest.TestCase):
+
+    def test_mask(self):
+        from oauth2_sample.scopes import ScopeRegistry
+
+        registry = ScopeRegistry(['api1', 'api2', 'api3'])
+
+        self.assertEqual(0, registry.mask(None))
+        self.assertEqual(0b101, registry.mask(['api3', 'api1']))
+        self.assertEqual(0b011, registry.mask({'api1', 'api2'}))
+        self.assertIsNone(registry.mask(['api1', 'other']))
+        self.assertEqual(('api1', 'api3'), registry.scopes(0b101))
+        self.assertEqual(('s:api1', 's:api3'), registry.principals(0b101))
+        self.assertIs(registry.principals(0b101), registry.principals(0b101))
+
+        # Registering a scope forgets masks memoized as unknown.
+        registry.register('other')
+        self.assertEqual(0b1001, registry.mask(['api1', 'other']))
+
+    def test_is_subset(self):
+        from oauth2_sample.scopes import ScopeRegistry
+
+        self.assertTrue(ScopeRegistry.is_subset(0b001, 0b011))
+        self.assertTrue(ScopeRegistry.is_subset(0, 0b011))
+        self.assertFalse(ScopeRegistry.is_subset(0b101, 0b011))
+
+    def test_models_is_allowed_scopes(self):
+        from oauth2_sample.models import Client, OAuth2Token
+        from oauth2_sample.scopes import scope_registry
+
+        for scope in ('api1', 'api2', 'api3'):
+            scope_registry.register(scope)
+        client = Client(default_scopes=['api1', 'api2'])
+        token = OAuth2Token(
+            scopes=['api1', 'api2'],
+            scope_mask=scope_registry.mask(['api1', 'api2']))
+
+        for obj in (client, token):
+            self.assertTrue(obj.is_allowed_scopes({'api1'}))
+            self.assertFalse(obj.is_allowed_scopes(['api1', 'api3']))
+            self.assertFalse(obj.is_allowed_scopes(['unknown']))
+        self.assertFalse(client.is_allowed_scopes([]))
+        self.assertTrue(token.is_allowed_scopes([]))
+
+
+class TokenSignerTestCase(unittest.TestCase):
+
+    def _make_signer(self, keyring, now=1000.0):
+        from oauth2_sample.signing import TokenSigner
+        return TokenSigner(keyring, clock=DummyClock(now))
+
+    def test_sign_and_verify(self):
+        from datetime import datetime
+
+        signer = self._make_signer([('k1', 'secret')])
+        expires = datetime.utcfromtimestamp(2000)
+        token = signer.sign({'api2', 'api1'}, expires, 'client_id', 1)
+
+        self.assertTrue(signer.is_signed(token))
+        self.assertTrue(token.startswith('k1.'))
+        entry = signer.verify(token)
+        self.assertEqual(('api1', 'api2'), entry.scopes)
+        self.assertEqual(expires, entry.expires)
+        self.assertEqual(1, entry.user_id)
+        self.assertEqual('client_id', entry.client_id)
+
+    def test_verify_rejects_tampered_and_expired_tokens(self):
+        from datetime import datetime
+
+        signer = self._make_signer([('k1', 'secret')])
+        token = signer.sign(
+            ['api1'], datetime.utcfromtimestamp(2000), 'client_id', 1)
+        kid, payload, signature = token.split('.')
+        forged = self._make_signer([('k1', 'other')]).sign(
+            ['api1', 'api2', 'api3'], datetime.utcfromtimestamp(2000),
+            'client_id', 1)
+
+        self.assertIsNone(signer.verify(
+            '%s.%s.%s' % (kid, forged.split('.')[1], signature)))
+        self.assertIsNone(signer.verify('k2.%s.%s' % (payload, signature)))
+        self.assertIsNone(signer.verify('%s.%s.!' % (kid, payload)))
+        self.assertIsNone(
+            self._make_signer([('k1', 'secret')], now=2000.0).verify(token))
+
+    def test_key_rotation(self):
+        from datetime import datetime
+
+        expires = datetime.utcfromtimestamp(2000)
+        old_signer = self._make_signer([('k1', 'old')])
+        signer = self._make_signer([('k2', 'new'), ('k1', 'old')])
+
+        self.assertTrue(signer.sign([], expires, 'c', 1).startswith('k2.'))
+        self.assertIsNotNone(
+            signer.verify(old_signer.sign([], expires, 'c', 1)))
+
+    def test_token_signer_from_config(self):
+        from pyramid.exceptions import ConfigurationError
+        from oauth2_sample.signing import token_signer_from_config
+
+        signer = token_signer_from_config(
+            {'oauth2.signing.keys': '\nk2:new\nk1:old:with:colons'})
+        self.assertEqual(['k2', 'k1'], list(signer.keyring))
+        self.assertEqual(b'old:with:colons', signer.keyring['k1'])
+        self.assertRaises(
+            ConfigurationError, token_signer_from_config, {})
+        self.assertRaises(
+            ConfigurationError, token_signer_from_config,
+            {'oauth2.signing.keys': 'k.1:secret'})
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from oauth2_sample.models import Base
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+
+    def _insert_tokens(self, *expires, **kw):
+        from oauth2_sample.models import User, Client, OAuth2Token
+        with self.engine.begin() as conn:
+            conn.execute(User.__table__.insert(), id=1, username='foo',
+                         password='x', is_superuser=False, is_staff=False,
+                         is_active=True, created='2016-01-01',
+                         updated='2016-01-01')
+            conn.execute(Client.__table__.insert(), client_id='c',
+                         client_secret='s', client_type='confidential',
+                         grant_type='client_credentials')
+            if expires:
+                refresh_lifetime = kw.get('refresh_lifetime')
+                conn.execute(OAuth2Token.__table__.insert(), [
+                    {'user_id': 1, 'client_id': 'c', 'expires': x,
+                     'refresh_expires': x + refresh_lifetime
+                     if refresh_lifetime is not None else None}
+                    for x in expires])
+
+
+class ReapExpiredTokensTestCase(DatabaseTestCase):
+
+    def test_reap_in_batches(self):
+        from datetime import datetime, timedelta
+        from oauth2_sample.models import OAuth2Token
+        from oauth2_sample.reaper import reap_expired_tokens
+
+        now = datetime(2016, 1, 1)
+        expired = now - timedelta(seconds=1)
+        self._insert_tokens(
+            expired, expired, expired, now + timedelta(hours=1),
+            refresh_lifetime=timedelta(0))
+
+        batches = list(reap_expired_tokens(self.engine, 2, now=now))
+
+        self.assertEqual([2, 1], [batch.rows for batch in batches])
+        self.assertEqual(1, self.engine.execute(
+            OAuth2Token.__table__.count()).scalar())
+
+    def test_reap_with_grace(self):
+        from datetime import datetime, timedelta
+        from oauth2_sample.reaper import reap_expired_tokens
+
+        now = datetime(2016, 1, 1)
+        self._insert_tokens(
+            now - timedelta(seconds=10), refresh_lifetime=timedelta(0))
+
+        self.assertEqual([], list(
+            reap_expired_tokens(self.engine, 2, grace=60, now=now)))
+        self.assertEqual([1], [batch.rows for batch in reap_expired_tokens(
+            self.engine, 2, grace=5, now=now)])
+
+    def test_keep_valid_refresh_tokens(self):
+        from datetime import datetime, timedelta
+        from oauth2_sample.models import OAuth2Token, REFRESH_TOKEN_LIFETIME
+        from oauth2_sample.reaper import reap_expired_tokens
+
+        now = datetime(2016, 1, 1)
+        expired = now - timedelta(hours=1)
+        # The access tokens expired, the refresh tokens have not.
+        self._insert_tokens(expired)
+        self.engine.execute(
+            OAuth2Token.__table__.insert(), user_id=1, client_id='c',
+            expires=expired, refresh_expires=now + timedelta(days=1))
+        self.assertEqual([], list(reap_expired_tokens(self.engine, now=now)))
+
+        # Without refresh_expires, the refresh token expires
+        # REFRESH_TOKEN_LIFETIME after the access token.
+        later = now + REFRESH_TOKEN_LIFETIME
+        self.assertEqual([2], [batch.rows for batch in reap_expired_tokens(
+            self.engine, now=later)])
+
+    def test_reaper_evicts_expired_cache_entries(self):
+        from datetime import datetime, timedelta
+        from oauth2_sample.reaper import TokenReaper
+
+        self._insert_tokens(
+            datetime(2016, 1, 1), refresh_lifetime=timedelta(0))
+        token_cache = MagicMock(evict_expired=MagicMock(return_value=3))
+        reaper = TokenReaper(self.engine, token_cache=token_cache)
+
+        self.assertEqual(1, reaper.reap())
+        token_cache.evict_expired.assert_called_once_with()
+        # A cache without evict_expired is left to its own expiry.
+        self.assertEqual(0, TokenReaper(
+            self.engine, token_cache=object()).reap())
+
+
+class CheckScopeBitsTestCase(DatabaseTestCase):
+
+    def test_check_scope_bits(self):
+        from pyramid.exceptions import ConfigurationError
+        from oauth2_sample.scopes import ScopeRegistry, check_scope_bits
+
+        check_scope_bits(self.engine, ScopeRegistry(['api1', 'api2']))
+        # Appended scopes are recorded.
+        check_scope_bits(self.engine, ScopeRegistry(['api1', 'api2', 'api3']))
+        check_scope_bits(self.engine, ScopeRegistry(['api1', 'api2', 'api3']))
+        for scopes in (['api2', 'api1', 'api3'], ['api1', 'api2'],
+                       ['api1', 'api3', 'api4']):
+            self.assertRaises(
+                ConfigurationError, check_scope_bits, self.engine,
+                ScopeRegistry(scopes))
+
+
+class SeedTestCase(DatabaseTestCase):
+
+    def test_seed(self):
+        import random
+        from datetime import datetime
+        from sqlalchemy import func, select
+        from oauth2_sample.credentials import client_secret_hasher
+        from oauth2_sample.models import User, Client, OAuth2Token
+        from oauth2_sample.scopes import scope_registry
+        from oauth2_sample.scripts.seed import CLIENT_SECRET, seed
+
+        for scope in ('api1', 'api2', 'api3'):
+            scope_registry.register(scope)
+        self._insert_tokens()
+        now = datetime(2016, 1, 1)
+
+        batches = list(seed(
+            self.engine, 10, 3, 200, '!', chunk_size=64, expired_ratio=0.5,
+            scopes=['api1', 'api2', 'api3'], rng=random.Random(1), now=now))
+
+        self.assertEqual(
+            [('users', 10), ('clients', 3), ('oauth2_tokens', 64),
+             ('oauth2_tokens', 64), ('oauth2_tokens', 64),
+             ('oauth2_tokens', 8)],
+            [(batch.table, batch.rows) for batch in batches])
+        users = self.engine.execute(
+            select([User.__table__]).where(User.id > 1)).fetchall()
+        self.assertEqual(list(range(2, 12)), [user.id for user in users])
+        self.assertEqual({'!'}, set(user.password for user in users))
+        clients = dict(
+            (row.client_id, row) for row in self.engine.execute(
+                select([Client.__table__]).where(Client.client_id != 'c')))
+        for client in clients.values():
+            self.assertTrue(client_secret_hasher.verify(
+                client.client_id, CLIENT_SECRET, client.client_secret))
+        tokens = self.engine.execute(
+            select([OAuth2Token.__table__])).fetchall()
+        expired = sum(token.expires < now for token in tokens)
+        self.assertTrue(60 < expired < 140, expired)
+        for token in tokens:
+            self.assertTrue(set(token.scopes).issubset(
+                clients[token.client_id].default_scopes))
+            self.assertEqual(
+                scope_registry.mask(token.scopes), token.scope_mask)
+        self.assertEqual(200, self.engine.execute(select([func.count(
+            OAuth2Token.access_token_hash.distinct())])).scalar())
+
+
+class TransferTestCase(DatabaseTestCase):
+
+    def test_export_and_import(self):
+        import io
+        import gzip
+        from datetime import datetime, timedelta
+        from sqlalchemy import create_engine, select
+        from oauth2_sample.models import Base, User, Client, OAuth2Token
+        from oauth2_sample.scripts.transfer import (
+            export_tables, import_tables)
+
+        now = datetime(2016, 1, 1)
+        expires = [now + timedelta(seconds=i) for i in range(-2, 5)]
+        self._insert_tokens(*expires, refresh_lifetime=timedelta(0))
+        token_table = OAuth2Token.__table__
+        self.engine.execute(
+            token_table.update().where(OAuth2Token.id == 7).values(
+                access_token_hash=b'\0' * 32, scopes=['api1', 'api2'],
+                scope_mask=3))
+        # The access tokens expired, the refresh tokens can still be used.
+        self.engine.execute(
+            token_table.update().where(OAuth2Token.id == 1).values(
+                refresh_expires=now + timedelta(days=1)))
+        self.engine.execute(
+            token_table.update().where(OAuth2Token.id == 2).values(
+                refresh_expires=None))
+        f = io.BytesIO()
+
+        chunks = list(export_tables(self.engine, f, chunk_size=2, now=now))
+
+        self.assertEqual(
+            [('users', 1), ('clients', 1), ('oauth2_tokens', 2),
+             ('oauth2_tokens', 2), ('oauth2_tokens', 2)],
+            [(chunk.table, chunk.rows) for chunk in chunks])
+        self.assertEqual(f.tell(), chunks[-1].offset)
+        lines = gzip.decompress(f.getvalue()).splitlines()
+        self.assertEqual(13, len(lines))
+
+        target = create_engine('sqlite://')
+        Base.metadata.create_all(target)
+        # An import that stopped after the token chunk at chunks[1].offset
+        # was committed, but before it was recorded.
+        imported = import_tables(target, f)
+        self.assertEqual(
+            [chunks[0].offset, chunks[1].offset, chunks[2].offset],
+            [next(imported).offset for i in range(3)])
+        imported.close()
+        self.assertEqual(
+            [chunks[3].offset, chunks[4].offset],
+            [chunk.offset for chunk in import_tables(
+                target, f, chunks[1].offset)])
+
+        for table in (User.__table__, Client.__table__):
+            self.assertEqual(
+                self.engine.execute(select([table])).fetchall(),
+                target.execute(select([table])).fetchall())
+        # Only the token that expired with its refresh token is skipped.
+        self.assertEqual(
+            self.engine.execute(select([token_table]).where(
+                token_table.c.id != 3)).fetchall(),
+            target.execute(select([token_table])).fetchall())
+
+
+class FunctionalTestCase(unittest.TestCase):
+
+    settings = {}
+
+    def setUp(self):
+        import transaction
+        from webtest import TestApp
+        from oauth2_sample import main
+        from oauth2_sample.models import DBSession, Base, User, Client
+
+        settings = {
+            'sqlalchemy.url': 'sqlite://',
+            'pyramid.includes': 'pyramid_tm',
+            }
+        settings.update(self.settings)
+        self.testapp = TestApp(main({}, **settings))
+        self.engine = Base.metadata.bind
+        Base.metadata.create_all(self.engine)
+
+        with transaction.manager:
+            user = User(username='foo', email='foo@example.com', password='x')
+            client = Client(
+                client_type=Client.CLIENT_TYPE_CONFIDENTIAL,
+                grant_type=Client.GRANT_TYPE_CLIENT_CREDENTIALS,
+                default_scopes=['api1', 'api2'],
+                user=user,
+                )
+            self.client_secret = client.set_client_secret()
+            DBSession.add(client)
+            DBSession.flush()
+            self.client_id = client.client_id
+
+    def tearDown(self):
+        from oauth2_sample.models import DBSession, Base
+        DBSession.remove()
+        Base.metadata.drop_all(self.engine)
+
+    def count_statements(self):
+        from sqlalchemy import event
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        self.addCleanup(event.remove, self.engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        return statements
+
+    def request_token(self, grant_type='client_credentials', status=200,
+                      **params):
+        params.setdefault('client_id', self.client_id)
+        params.setdefault('client_secret', self.client_secret)
+        params['grant_type'] = grant_type
+        return self.testapp.post('/oauth2/token', params, status=status)
+
+
+class OAuth2ViewTestCase(FunctionalTestCase):
+
+    def test_client_credentials_statement_count(self):
+        statements = self.count_statements()
+        res = self.request_token(scope='api1')
+
+        self.assertEqual('Bearer', res.json['token_type'])
+        # SELECT clients JOIN users, INSERT oauth2_tokens.
+        self.assertEqual(2, len(statements), statements)
+
+    def test_refresh_token_statement_count(self):
+        refresh_token = self.request_token(scope='api1').json['refresh_token']
+
+        statements = self.count_statements()
+        res = self.request_token('refresh_token', refresh_token=refresh_token)
+
+        self.assertNotEqual(refresh_token, res.json['refresh_token'])
+        # SELECT clients JOIN users, SELECT oauth2_tokens,
+        # DELETE oauth2_tokens, INSERT oauth2_tokens.
+        self.assertEqual(4, len(statements), statements)
+
+    def test_refresh_token_is_single_use(self):
+        refresh_token = self.request_token(scope='api1').json['refresh_token']
+        self.request_token('refresh_token', refresh_token=refresh_token)
+        self.request_token(
+            'refresh_token', refresh_token=refresh_token, status=400)
+
+    def test_unsupported_grant_type(self):
+        res = self.request_token('authorization_code', status=400)
+        self.assertEqual('grant_type', res.json['errors'][0]['property'])
+
+    def test_nested_scope(self):
+        res = self.testapp.post_json('/oauth2/token', {
+            'client_id': self.client_id, 'client_secret': self.client_secret,
+            'grant_type': 'client_credentials', 'scope': [['api1']],
+            }, status=400)
+        self.assertEqual('invalid_parameter', res.json['code'])
+        self.assertEqual('scope', res.json['errors'][0]['property'])
+
+    def test_refresh_after_reap(self):
+        from datetime import datetime, timedelta
+        from oauth2_sample.models import OAuth2Token
+        from oauth2_sample.reaper import reap_expired_tokens
+
+        refresh_token = self.request_token(scope='api1').json['refresh_token']
+        table = OAuth2Token.__table__
+        self.engine.execute(table.update().values(
+            expires=datetime.utcnow() - timedelta(seconds=1)))
+        self.assertEqual([], list(reap_expired_tokens(self.engine)))
+
+        refresh_token = self.request_token(
+            'refresh_token', refresh_token=refresh_token).json['refresh_token']
+
+        # A refresh token is refused, and reaped, once it expires.
+        self.engine.execute(table.update().values(
+            refresh_expires=datetime.utcnow() - timedelta(seconds=1)))
+        self.request_token(
+            'refresh_token', refresh_token=refresh_token, status=400)
+        self.assertEqual([1], [batch.rows for batch in reap_expired_tokens(
+            self.engine)])
+
+    def test_expired_access_token(self):
+        from datetime import datetime, timedelta
+        from oauth2_sample.models import OAuth2Token
+
+        access_token = self.request_token(scope='api1').json['access_token']
+        headers = {'Authorization': 'Bearer ' + access_token}
+        self.testapp.get('/api/api1', headers=headers)
+        self.engine.execute(OAuth2Token.__table__.update().values(
+            expires=datetime.utcnow() - timedelta(hours=2)))
+        self.testapp.get('/api/api1', headers=headers, status=403)
+
+    def test_only_token_digests_are_stored(self):
+        from oauth2_sample.models import OAuth2Token, token_digest
+
+        res = self.request_token(scope='api1')
+        token = OAuth2Token.query.get_by_access_token(res.json['access_token'])
+        self.assertEqual(
+            token_digest(res.json['access_token']), token.access_token_hash)
+        self.assertEqual(
+            token_digest(res.json['refresh_token']), token.refresh_token_hash)
+        self.assertIs(token, OAuth2Token.query.get_by_refresh_token(
+            res.json['refresh_token']))
+
+
+class OAuth2IntrospectViewTestCase(FunctionalTestCase):
+
+    def introspect(self, status=200, **params):
+        params.setdefault('client_id', self.client_id)
+        params.setdefault('client_secret', self.client_secret)
+        return self.testapp.post(
+            '/oauth2/introspect', params, status=status)
+
+    def test_introspect(self):
+        from datetime import datetime, timedelta
+        from oauth2_sample.models import OAuth2Token
+
+        token = self.request_token(scope='api1 api2').json
+
+        res = self.introspect(token=token['access_token'])
+
+        self.assertTrue(res.json['active'])
+        self.assertEqual('api1 api2', res.json['scope'])
+        self.assertEqual(self.client_id, res.json['client_id'])
+        self.assertEqual('foo', res.json['username'])
+        self.assertEqual('no-store', res.headers['Cache-Control'])
+        self.assertEqual(
+            {'active': False}, self.introspect(token='unknown').json)
+        self.assertTrue(self.introspect(
+            token=token['refresh_token'],
+            token_type_hint='refresh_token').json['active'])
+        # The prefix of a token takes precedence over the hint.
+        self.assertTrue(self.introspect(
+            token=token['refresh_token']).json['active'])
+
+        # A refresh token is judged by its own expiry.
+        self.engine.execute(OAuth2Token.__table__.update().values(
+            expires=datetime.utcnow() - timedelta(seconds=1)))
+        self.assertEqual({'active': False}, self.introspect(
+            token=token['access_token']).json)
+        res = self.introspect(token=token['refresh_token'])
+        self.assertTrue(res.json['active'])
+        self.assertGreater(
+            res.json['exp'],
+            (datetime.utcnow() + timedelta(days=29) -
+             datetime(1970, 1, 1)).total_seconds())
+        self.engine.execute(OAuth2Token.__table__.update().values(
+            refresh_expires=datetime.utcnow() - timedelta(seconds=1)))
+        self.assertEqual({'active': False}, self.introspect(
+            token=token['refresh_token']).json)
+
+    def test_introspect_batch_with_one_query(self):
+        access_tokens = [
+            self.request_token(scope='api1').json['access_token']
+            for x in range(3)]
+
+        statements = self.count_statements()
+        res = self.testapp.post('/oauth2/introspect', [
+            ('client_id', self.client_id),
+            ('client_secret', self.client_secret),
+            ] + [('tokens', x) for x in access_tokens + ['unknown']])
+
+        self.assertEqual(
+            [True, True, True, False],
+            [x['active'] for x in res.json['tokens']])
+        # SELECT clients JOIN users, SELECT oauth2_tokens JOIN users.
+        self.assertEqual(2, len(statements), statements)
+
+    def test_introspect_requires_client_authentication(self):
+        self.introspect(token='unknown', client_secret='invalid', status=400)
+        self.introspect(status=400)
+
+
+class TemporaryPathTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+        self.addCleanup(
+            lambda: os.path.exists(self.path) and os.unlink(self.path))
+
+
+class SharedTableTestCase(TemporaryPathTestCase):
+
+    def _make_table(self, slots=16, clock=None, **kw):
+        from oauth2_sample.shm import SharedTable
+        table = SharedTable(
+            self.path, slots, 8, clock=clock or DummyClock(1000.0), **kw)
+        self.addCleanup(table.close)
+        return table
+
+    def test_shared_between_mappings(self):
+        table = self._make_table()
+        other = self._make_table()
+
+        table.set(b'k' * 16, b'value', 2000.0)
+        self.assertEqual(b'value\0\0\0', other.get(b'k' * 16))
+        other.delete(b'k' * 16)
+        self.assertIsNone(table.get(b'k' * 16))
+
+    def test_deadline_and_evict_expired(self):
+        clock = DummyClock(1000.0)
+        table = self._make_table(clock=clock)
+
+        table.set(b'a' * 16, b'a', 1010.0)
+        table.set(b'b' * 16, b'b', 2000.0)
+        clock.now = 1010.0
+
+        self.assertIsNone(table.get(b'a' * 16))
+        self.assertEqual(1, len(table))
+        self.assertEqual(1, table.evict_expired())
+        self.assertEqual(b'b', table.get(b'b' * 16)[:1])
+
+    def test_evict_closest_deadline_when_full(self):
+        table = self._make_table(slots=2)
+
+        self.assertFalse(table.set(b'a' * 16, b'a', 3000.0))
+        self.assertFalse(table.set(b'b' * 16, b'b', 2000.0))
+        self.assertTrue(table.set(b'c' * 16, b'c', 4000.0))
+
+        self.assertIsNone(table.get(b'b' * 16))
+        self.assertIsNotNone(table.get(b'a' * 16))
+        self.assertIsNotNone(table.get(b'c' * 16))
+
+    def test_layout_mismatch(self):
+        from oauth2_sample.shm import SharedTable
+        self._make_table(slots=16)
+        self.assertRaises(ValueError, SharedTable, self.path, 32, 8)
+
+
+class SharedTokenCacheTestCase(TemporaryPathTestCase):
+
+    def test_token_cache(self):
+        from datetime import datetime
+        from oauth2_sample.cache import CachedToken, SharedTokenCache
+        from oauth2_sample.scopes import ScopeRegistry
+
+        registry = ScopeRegistry(['api1', 'api2'])
+        clock = DummyClock(1000.0)
+        cache = SharedTokenCache(
+            self.path, slots=16, clock=clock, scope_registry=registry)
+        other = SharedTokenCache(
+            self.path, slots=16, clock=clock, scope_registry=registry)
+        entry = CachedToken(
+            ('api2',), datetime.utcfromtimestamp(1100), 1, 'client_id', 0b10)
+
+        cache.set('token', entry)
+        self.assertEqual(entry, other.get('token'))
+        # Tokens with unregistered scopes are not cached.
+        cache.set('other', entry._replace(scope_mask=None))
+        self.assertIsNone(other.get('other'))
+
+        other.invalidate('token')
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 0},
+            other.stats())
+
+
+class BenchmarkTestCase(TemporaryPathTestCase):
+
+    def test_percentile(self):
+        from oauth2_sample.scripts.benchmark import _percentile
+
+        values = list(range(1, 101))
+        self.assertEqual(50, _percentile(values, 50))
+        self.assertEqual(99, _percentile(values, 99))
+        self.assertEqual(1, _percentile([1], 99))
+        self.assertIsNone(_percentile([], 50))
+
+    def test_run(self):
+        from oauth2_sample.models import DBSession
+        from oauth2_sample.scripts.benchmark import (
+            EXPECTED_STATUS, SCENARIOS, Benchmark)
+
+        benchmark = Benchmark({}, self.path)
+        self.addCleanup(DBSession.remove)
+
+        for name, scenario in SCENARIOS.items():
+            result = benchmark.run(
+                name, scenario(benchmark, 4), 2, EXPECTED_STATUS.get(name))
+            self.assertEqual(4, result['requests'])
+            self.assertEqual(0, result['errors'])
+            self.assertGreater(result['statements_per_request'], 0)
+
+
+class PreforkServerTestCase(TemporaryPathTestCase):
+
+    def test_count_requests(self):
+        from webob import Request
+        from pyramid.response import Response
+        from oauth2_sample.scripts.prefork import WorkerStats, count_requests
+
+        stats = WorkerStats(2)
+        app = count_requests(Response('ok'), stats, 1)
+        for i in range(3):
+            Request.blank('/').get_response(app)
+        self.assertEqual([0, 3], [stats.get(0), stats.get(1)])
+
+    def test_reload_twice(self):
+        from oauth2_sample.scripts.prefork import PreforkServer, _Worker
+
+        server = PreforkServer('config.ini', '127.0.0.1', 0, workers=2,
+                               graceful_timeout=0.1)
+        pids = iter(range(100, 200))
+        killed = []
+
+        def spawn(slot):
+            pid = next(pids)
+            server._children[pid] = _Worker(slot, 0, None)
+            return pid
+
+        def reap():
+            # The workers stopped by a reload exit once they are killed.
+            for pid in killed:
+                server._children.pop(pid, None)
+
+        server.spawn = spawn
+        server._reap = lambda: None
+        server._wait_ready = lambda pid, timeout: True
+        server._kill = lambda pid, signum: killed.append(pid)
+        for i in range(2):
+            server.spawn(i)
+
+        # The workers of the first reload are still stopping.
+        self.assertTrue(server.reload())
+        self.assertEqual(4, len(server._children))
+        server._reap = reap
+        self.assertTrue(server.reload())
+        self.assertEqual([(104, 0), (105, 1)], sorted(
+            (pid, w.slot) for pid, w in server._children.items()
+            if not w.retiring))
+
+    def post(self, port):
+        import urllib.error
+        import urllib.request
+        try:
+            urllib.request.urlopen(
+                'http://127.0.0.1:%d/oauth2/token' % port, b'', timeout=5)
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_serve(self):
+        import sys
+        import time
+        import signal
+        import socket
+        import subprocess
+        from sqlalchemy import create_engine
+        from oauth2_sample.models import Base
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        Base.metadata.create_all(create_engine('sqlite:///' + self.path))
+        config_uri = self.path + '.ini'
+        with open(config_uri, 'w') as f:
+            f.write('[app:main]\n'
+                    'use = call:oauth2_sample:main\n'
+                    'sqlalchemy.url = sqlite:///%s\n'
+                    'oauth2.client_secret.key = key\n' % self.path)
+        self.addCleanup(os.unlink, config_uri)
+
+        process = subprocess.Popen(
+            [sys.executable, '-c',
+             'from oauth2_sample.scripts.prefork import main; main()',
+             config_uri, '--workers', '2', '--port', str(port),
+             '--host', '127.0.0.1'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        deadline = time.time() + 10
+        while True:
+            try:
+                self.assertEqual(400, self.post(port))
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.assertEqual(400, self.post(port))
+
+        process.send_signal(signal.SIGHUP)
+        process.send_signal(signal.SIGTERM)
+        out, _ = process.communicate(timeout=30)
+        self.assertEqual(0, process.returncode)
+        self.assertEqual(
+            'total: 2 requests, 0 workers, 0 restarts',
+            out.decode('utf-8').splitlines()[-1].rsplit(',', 1)[0])
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_render(self):
+        from oauth2_sample.metrics import Metrics
+
+        metrics = Metrics()
+        metrics.describe('oauth2_sample_requests_total', 'Requests.')
+        metrics.incr('requests_total', view='a/b', status=200)
+        metrics.incr('requests_total', view='a/b', status=200)
+        metrics.observe('duration_seconds', 0.003, buckets=(0.001, 0.01))
+        metrics.observe('duration_seconds', 5, buckets=(0.001, 0.01))
+
+        self.assertEqual(
+            '# HELP oauth2_sample_requests_total Requests.\n'
+            '# TYPE oauth2_sample_requests_total counter\n'
+            'oauth2_sample_requests_total{status="200",view="a/b"} 2\n'
+            '# TYPE oauth2_sample_duration_seconds histogram\n'
+            'oauth2_sample_duration_seconds_bucket{le="0.001"} 0\n'
+            'oauth2_sample_duration_seconds_bucket{le="0.01"} 1\n'
+            'oauth2_sample_duration_seconds_bucket{le="+Inf"} 2\n'
+            'oauth2_sample_duration_seconds_sum 5.003\n'
+            'oauth2_sample_duration_seconds_count 2\n'
+            '# TYPE oauth2_sample_size gauge\n'
+            'oauth2_sample_size 3\n',
+            metrics.render([('size', {}, 3)]))
+
+
+class TokenFilterTestCase(TemporaryPathTestCase):
+
+    def _make_filter(self, **kw):
+        from oauth2_sample.bloom import TokenFilter
+        token_filter = TokenFilter(capacity=1000, error_rate=0.01, **kw)
+        self.addCleanup(token_filter.close)
+        return token_filter
+
+    def _digests(self, *tokens):
+        from oauth2_sample.models import token_digest
+        return [token_digest(str(x)) for x in tokens]
+
+    def test_rebuild(self):
+        token_filter = self._make_filter(clock=DummyClock(1000.0))
+        known = self._digests(*range(500))
+        unknown = self._digests(*range(500, 1500))
+
+        # Nothing is rejected before the first rebuild.
+        self.assertTrue(token_filter.might_contain(unknown[0]))
+        self.assertIsNone(token_filter.rebuilt_at)
+
+        self.assertEqual(500, token_filter.rebuild(known))
+        self.assertEqual(1000.0, token_filter.rebuilt_at)
+        self.assertTrue(all(token_filter.might_contain(x) for x in known))
+        false_positives = sum(token_filter.might_contain(x) for x in unknown)
+        self.assertLess(false_positives, 50)
+
+        token_filter.rebuild(unknown[:10])
+        self.assertTrue(all(
+            token_filter.might_contain(x) for x in unknown[:10]))
+        self.assertLess(sum(token_filter.might_contain(x) for x in known), 50)
+
+    def test_tokens_added_during_rebuild_are_kept(self):
+        token_filter = self._make_filter()
+        added = self._digests('added')[0]
+
+        def digests():
+            yield self._digests('loaded')[0]
+            token_filter.add(added)
+
+        for x in range(2):
+            token_filter.rebuild(digests())
+            self.assertTrue(token_filter.might_contain(added))
+
+    def test_shared_between_mappings(self):
+        token_filter = self._make_filter(path=self.path)
+        other = self._make_filter(path=self.path)
+        digest = self._digests('token')[0]
+
+        token_filter.rebuild([])
+        self.assertFalse(other.might_contain(digest))
+        token_filter.add(digest)
+        self.assertTrue(other.might_contain(digest))
+
+        from oauth2_sample.bloom import TokenFilter
+        self.assertRaises(ValueError, TokenFilter, 10, path=self.path)
+
+
+class TokenFilterViewTestCase(TemporaryPathTestCase, FunctionalTestCase):
+
+    def setUp(self):
+        TemporaryPathTestCase.setUp(self)
+        self.settings = {
+            'oauth2.token_filter.enabled': 'true',
+            'oauth2.token_filter.path': self.path,
+            'oauth2.token_filter.rebuild_interval': '3600',
+            }
+        FunctionalTestCase.setUp(self)
+
+    def test_token_filter_from_config(self):
+        from pyramid.exceptions import ConfigurationError
+        from oauth2_sample.bloom import token_filter_from_config
+
+        self.assertIsNone(token_filter_from_config({}))
+        self.assertRaises(
+            ConfigurationError, token_filter_from_config,
+            {'oauth2.token_filter.enabled': 'true'})
+
+    def test_unknown_tokens_skip_the_database(self):
+        from oauth2_sample.bloom import load_access_token_digests
+        from oauth2_sample.interfaces import ITokenFilter
+        from oauth2_sample.tokens import ACCESS_TOKEN, generate_token
+
+        issued = self.request_token(scope='api1').json['access_token']
+        token_filter = self.testapp.app.registry.getUtility(ITokenFilter)
+        token_filter.rebuild(load_access_token_digests(self.engine))
+        access_token = self.request_token(scope='api1').json['access_token']
+
+        for token in (issued, access_token):
+            self.testapp.get(
+                '/api/api1', headers={'Authorization': 'Bearer ' + token})
+        statements = self.count_statements()
+        self.testapp.get('/api/api1', status=403, headers={
+            'Authorization': 'Bearer ' + generate_token(ACCESS_TOKEN)})
+        self.assertEqual([], statements)
+
+    def test_rebuild_token_filter_from_config(self):
+        from oauth2_sample.bloom import rebuild_token_filter_from_config
+        from oauth2_sample.interfaces import ITokenFilter
+
+        self.assertIsNone(rebuild_token_filter_from_config(self.engine, {}))
+
+        # A token the filter does not know, like one written by a command.
+        access_token = self.request_token(scope='api1').json['access_token']
+        token_filter = self.testapp.app.registry.getUtility(ITokenFilter)
+        token_filter.rebuild([])
+        headers = {'Authorization': 'Bearer ' + access_token}
+        self.testapp.get('/api/api1', status=403, headers=headers)
+
+        self.assertEqual(1, rebuild_token_filter_from_config(
+            self.engine, self.settings))
+        self.testapp.get('/api/api1', headers=headers)
+
+
+class RateLimiterTestCase(TemporaryPathTestCase):
+
+    def _assert_token_bucket(self, limiter, clock):
+        # A full bucket of 3 tokens, refilled with one every 2 seconds.
+        self.assertEqual([0, 0, 0, 2.0], [
+            limiter.acquire('c', 0.5, 3) for x in range(4)])
+        clock.now += 1
+        self.assertEqual(1.0, limiter.acquire('c', 0.5, 3))
+        clock.now += 1
+        self.assertEqual(0, limiter.acquire('c', 0.5, 3))
+        # Other clients have their own buckets, with the defaults.
+        self.assertEqual(0, limiter.acquire('other'))
+        self.assertEqual(1.0, limiter.acquire('other'))
+        clock.now += 1000
+        self.assertEqual([0, 0, 0, 2.0], [
+            limiter.acquire('c', 0.5, 3) for x in range(4)])
+
+    def test_rate_limiter(self):
+        from oauth2_sample.ratelimit import RateLimiter
+
+        clock = DummyClock(1000.0)
+        limiter = RateLimiter(rate=1.0, burst=1, max_size=2, clock=clock)
+        self._assert_token_bucket(limiter, clock)
+        limiter.acquire('third')
+        self.assertEqual(2, len(limiter))
+
+    def test_shared_rate_limiter(self):
+        from oauth2_sample.ratelimit import SharedRateLimiter
+
+        clock = DummyClock(1000.0)
+        limiters = [
+            SharedRateLimiter(self.path, 16, rate=1.0, burst=1, clock=clock)
+            for x in range(2)]
+        for limiter in limiters:
+            self.addCleanup(limiter.close)
+        self._assert_token_bucket(limiters[0], clock)
+        clock.now += 1000
+        limiters[0].acquire('c', 0.5, 1)
+        self.assertEqual(2.0, limiters[1].acquire('c', 0.5, 1))
+
+    def test_rate_limiter_from_config(self):
+        from pyramid.exceptions import ConfigurationError
+        from oauth2_sample.ratelimit import rate_limiter_from_config
+
+        self.assertIsNone(rate_limiter_from_config({}))
+        limiter = rate_limiter_from_config({
+            'oauth2.rate_limit.enabled': 'true',
+            'oauth2.rate_limit.rate': '5',
+            'oauth2.rate_limit.burst': '20',
+            })
+        self.assertEqual((5.0, 20.0), (limiter.rate, limiter.burst))
+        self.assertRaises(ConfigurationError, rate_limiter_from_config, {
+            'oauth2.rate_limit.enabled': 'true',
+            'oauth2.rate_limit.rate': '0',
+            })
+
+
+class RateLimitViewTestCase(FunctionalTestCase):
+
+    settings = {
+        'oauth2.rate_limit.enabled': 'true',
+        'oauth2.rate_limit.rate': '0.001',
+        'oauth2.rate_limit.burst': '2',
+        }
+
+    def test_rate_limited(self):
+        import transaction
+        from oauth2_sample.models import DBSession, Client, OAuth2Token
+
+        self.request_token(scope='api1')
+        self.request_token(scope='api1')
+        res = self.request_token(scope='api1', status=429)
+
+        self.assertEqual('rate_limited', res.json['code'])
+        self.assertTrue(0 < int(res.headers['Retry-After']) <= 1000)
+        self.assertEqual(2, OAuth2Token.query.count())
+        # Invalid credentials do not take tokens of the client.
+        self.request_token(client_secret='wrong', status=400)
+
+        with transaction.manager:
+            client = Client.query.get(self.client_id)
+            client.rate_limit = 1e9
+            client.rate_burst = 5
+        DBSession.remove()
+        self.request_token(scope='api1')
+
+
+class PasswordVerifierTestCase(unittest.TestCase):
+
+    def make_verifier(self, function, **kw):
+        import operator
+        from oauth2_sample.metrics import Metrics
+        from oauth2_sample.passwords import PasswordVerifier
+
+        verifier = PasswordVerifier(
+            processes=1, metrics=Metrics(), function=function or operator.eq,
+            **kw)
+        self.addCleanup(verifier.close)
+        return verifier
+
+    def test_verify(self):
+        verifier = self.make_verifier(None)
+        self.assertTrue(verifier.verify('secret', 'secret'))
+        self.assertFalse(verifier.verify('secret', 'wrong'))
+        self.assertEqual(
+            {'processes': 1, 'pending': 0, 'max_pending': 2},
+            verifier.stats())
+        self.assertEqual(2, verifier.metrics.histogram(
+            'password_verification_seconds').count)
+
+    def test_overloaded(self):
+        import threading
+        from oauth2_sample.passwords import PasswordVerifierOverloaded
+
+        verifier = self.make_verifier(_slow_equal, max_pending=1)
+        thread = threading.Thread(target=verifier.verify, args=('a', 'a'))
+        thread.start()
+        self.addCleanup(thread.join)
+        while not verifier.stats()['pending']:
+            pass
+        self.assertRaises(
+            PasswordVerifierOverloaded, verifier.verify, 'a', 'a')
+        self.assertEqual(1, verifier.metrics.counter(
+            'password_verifications_shed_total'))
+
+    def test_timeout(self):
+        from oauth2_sample.passwords import PasswordVerifierOverloaded
+
+        verifier = self.make_verifier(_slow_equal, timeout=0.01)
+        self.assertRaises(
+            PasswordVerifierOverloaded, verifier.verify, 'a', 'a')
+        # The verification is pending until it finishes.
+        self.assertEqual(1, verifier.stats()['pending'])
+
+
+class PasswordGrantViewTestCase(FunctionalTestCase):
+
+    def setUp(self):
+        import transaction
+        from oauth2_sample.models import DBSession, User, Client
+
+        super(PasswordGrantViewTestCase, self).setUp()
+        with transaction.manager:
+            user = User(username='bar', email='bar@example.com',
+                        password='secret')
+            client = Client(
+                client_type=Client.CLIENT_TYPE_CONFIDENTIAL,
+                grant_type=Client.GRANT_TYPE_PASSWORD)
+            self.password_client_secret = client.set_client_secret()
+            DBSession.add_all([user, client])
+            DBSession.flush()
+            self.password_client_id = client.client_id
+            self.user_id = user.id
+
+    def register_verifier(self, verifier):
+        from oauth2_sample.interfaces import IPasswordVerifier
+        self.testapp.app.registry.registerUtility(verifier, IPasswordVerifier)
+
+    def request_password_token(self, status=200, **params):
+        params.setdefault('client_id', self.password_client_id)
+        params.setdefault('client_secret', self.password_client_secret)
+        params.setdefault('username', 'bar')
+        return self.request_token('password', status, **params)
+
+    def test_password_grant(self):
+        import operator
+        from oauth2_sample.models import OAuth2Token
+        from oauth2_sample.passwords import PasswordVerifier
+
+        verifier = PasswordVerifier(processes=1, function=operator.eq)
+        self.addCleanup(verifier.close)
+        self.register_verifier(verifier)
+
+        res = self.request_password_token(password='secret', scope='api1')
+        token = OAuth2Token.query.get_by_access_token(res.json['access_token'])
+        self.assertEqual(self.user_id, token.user_id)
+        # The token of a refresh token keeps its user.
+        res = self.request_token(
+            client_id=self.password_client_id,
+            client_secret=self.password_client_secret,
+            grant_type='refresh_token',
+            refresh_token=res.json['refresh_token'])
+        token = OAuth2Token.query.get_by_access_token(res.json['access_token'])
+        self.assertEqual(self.user_id, token.user_id)
+
+        for params in ({'password': 'wrong'}, {'username': 'foo'},
+                       {'client_id': self.client_id,
+                        'client_secret': self.client_secret}):
+            res = self.request_password_token(status=400, **params)
+            self.assertEqual('', res.json['errors'][0]['property'])
+
+    def test_unknown_user(self):
+        from oauth2_sample.passwords import DUMMY_PASSWORD
+
+        verifier = MagicMock(verify=MagicMock(return_value=True))
+        self.register_verifier(verifier)
+        res = self.request_password_token(
+            username='unknown', password='secret', status=400)
+        self.assertEqual('A username or password is invalid',
+                         res.json['errors'][0]['message'])
+        # The password is verified, as long as for a known user.
+        verifier.verify.assert_called_once_with('secret', DUMMY_PASSWORD)
+
+    def test_overloaded(self):
+        from oauth2_sample.passwords import PasswordVerifierOverloaded
+
+        self.register_verifier(MagicMock(
+            verify=MagicMock(side_effect=PasswordVerifierOverloaded)))
+        res = self.request_password_token(password='secret', status=503)
+        self.assertEqual('temporarily_unavailable', res.json['code'])
+        self.assertEqual('1', res.headers['Retry-After'])
+
+
+class TokenBatchWriterTestCase(DatabaseTestCase):
+
+    def _write(self, *writes):
+        from datetime import datetime
+        from oauth2_sample.batching import _Write, TokenBatchWriter
+
+        writer = TokenBatchWriter(self.engine)
+        batch = [_Write({
+            'user_id': 1, 'client_id': 'c', 'expires': datetime(2016, 1, 1),
+            'access_token_hash': b'a' * 31 + token,
+            'refresh_token_hash': b'r' * 31 + token,
+            'scopes': ['api1'], 'scope_mask': 1,
+            }, delete_id) for token, delete_id in writes]
+        writer.write(batch)
+        return [write.future.exception() for write in batch]
+
+    def test_write_batches(self):
+        from sqlalchemy import event
+        from oauth2_sample.batching import TokenAlreadyUsed
+        from oauth2_sample.models import OAuth2Token
+
+        self._insert_tokens()
+        statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+
+        self.assertEqual([None] * 3, self._write(
+            (b'1', None), (b'2', None), (b'3', None)))
+        self.assertEqual(1, len(statements))
+        ids = [row.id for row in self.engine.execute(
+            OAuth2Token.__table__.select().order_by('id'))]
+
+        # The second refresh of a token in a batch, or of a token deleted
+        # by an earlier batch, fails and inserts nothing.
+        del statements[:]
+        errors = self._write(
+            (b'4', ids[0]), (b'5', ids[0]), (b'6', ids[1]), (b'7', None))
+        self.assertEqual(
+            [None, TokenAlreadyUsed, None, None],
+            [type(e) if e else None for e in errors])
+        # A DELETE per replaced row, one INSERT.
+        self.assertEqual(4, len(statements))
+        self.assertEqual(
+            [TokenAlreadyUsed], [type(e) for e in self._write((b'8', ids[1]))])
+        self.assertEqual(
+            [b'3', b'4', b'6', b'7'],
+            [row.access_token_hash[-1:] for row in self.engine.execute(
+                OAuth2Token.__table__.select().order_by('id'))])
+
+    def test_skip_cancelled_writes(self):
+        from datetime import datetime
+        from oauth2_sample.batching import _Write, TokenBatchWriter
+        from oauth2_sample.models import OAuth2Token
+
+        self._insert_tokens(datetime(2016, 1, 1))
+        write = _Write({'user_id': 1, 'client_id': 'c'}, 1)
+        self.assertTrue(write.future.cancel())
+        TokenBatchWriter(self.engine).write([write])
+        # The replaced row is kept, nothing is inserted.
+        self.assertEqual([1], [row.id for row in self.engine.execute(
+            OAuth2Token.__table__.select())])
+
+
+class TokenBatchWriterViewTestCase(TemporaryPathTestCase, FunctionalTestCase):
+
+    def setUp(self):
+        TemporaryPathTestCase.setUp(self)
+        self.settings = {
+            'sqlalchemy.url': 'sqlite:///' + self.path,
+            'oauth2.token_writer.enabled': 'true',
+            }
+        FunctionalTestCase.setUp(self)
+
+    def test_refresh_token_is_single_use(self):
+        from oauth2_sample.interfaces import ITokenWriter
+
+        self.addCleanup(
+            self.testapp.app.registry.getUtility(ITokenWriter).stop)
+        token = self.request_token(scope='api1').json
+        self.testapp.get('/api/api1', headers={
+            'Authorization': 'Bearer ' + token['access_token']})
+        self.request_token(
+            'refresh_token', refresh_token=token['refresh_token'])
+        self.request_token(
+            'refresh_token', refresh_token=token['refresh_token'],
+            status=400)
+
+
+class TokenWriterFailureTestCase(FunctionalTestCase):
+
+    def register_writer(self, future):
+        from oauth2_sample.interfaces import ITokenWriter
+        writer = MagicMock(timeout=0.01, submit=MagicMock(return_value=future))
+        self.testapp.app.registry.registerUtility(writer, ITokenWriter)
+
+    def test_timeout(self):
+        from concurrent.futures import Future
+
+        future = Future()
+        self.register_writer(future)
+        res = self.request_token(scope='api1', status=503)
+        self.assertEqual('temporarily_unavailable', res.json['code'])
+        # The write is not made once the client got the error.
+        self.assertTrue(future.cancelled())
+
+    def test_failed_batch(self):
+        from concurrent.futures import Future
+
+        future = Future()
+        future.set_exception(RuntimeError('database is gone'))
+        self.register_writer(future)
+        res = self.request_token(scope='api1', status=503)
+        self.assertEqual('temporarily_unavailable', res.json['code'])
+
+
+class AuditLogTestCase(TemporaryPathTestCase):
+
+    def _read(self, path=None):
+        import json
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_ring_buffer(self):
+        from oauth2_sample.audit import AuditLog
+
+        audit_log = AuditLog(self.path, capacity=4, clock=lambda: 1.5)
+
+        for i in range(3):
+            self.assertTrue(audit_log.record('e', i=i, digest=b'\x01'))
+        self.assertEqual(3, audit_log.flush())
+        # The next records wrap around the end of the buffer.
+        for i in range(3, 8):
+            audit_log.record('e', i=i, digest=b'\x01')
+        self.assertEqual(4, audit_log.flush())
+        self.assertEqual(0, audit_log.flush())
+
+        records = self._read()
+        self.assertEqual(
+            {'time': 1.5, 'event': 'e', 'i': 0, 'digest': '01'}, records[0])
+        self.assertEqual([0, 1, 2, 3, 4, 5, 6], [r['i'] for r in records])
+        self.assertEqual(
+            {'capacity': 4, 'pending': 0, 'recorded': 7, 'dropped': 1,
+             'written': 7, 'blocked_seconds': 0.0},
+            audit_log.stats())
+
+    def test_block_when_full(self):
+        from oauth2_sample.audit import AuditLog
+
+        audit_log = AuditLog(self.path, capacity=2, when_full='block',
+                             block_timeout=0.01, flush_interval=10)
+        audit_log.record('e')
+        audit_log.record('e')
+        # Nothing drains the buffer, the record is dropped after waiting.
+        self.assertFalse(audit_log.record('e'))
+        self.assertGreater(audit_log.blocked_seconds, 0)
+
+        audit_log.block_timeout = 10
+        audit_log.start()
+        for i in range(100):
+            self.assertTrue(audit_log.record('e', i=i))
+        audit_log.stop()
+        audit_log.join()
+        self.assertEqual(list(range(100)),
+                         [r['i'] for r in self._read() if 'i' in r])
+        self.assertRaises(ValueError, AuditLog, self.path, when_full='wait')
+
+    def test_rotate(self):
+        from oauth2_sample.audit import AuditLog
+
+        audit_log = AuditLog(self.path, max_bytes=100, backups=2)
+        self.addCleanup(lambda: [
+            os.unlink(self.path + suffix) for suffix in ('.1', '.2')
+            if os.path.exists(self.path + suffix)])
+        for i in range(4):
+            audit_log.record('e', data='x' * 60, i=i)
+            audit_log.flush()
+
+        self.assertEqual([3], [r['i'] for r in self._read()])
+        self.assertEqual([2], [r['i'] for r in self._read(self.path + '.1')])
+        self.assertEqual([1], [r['i'] for r in self._read(self.path + '.2')])
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+
+class AuditLogViewTestCase(TemporaryPathTestCase, FunctionalTestCase):
+
+    def setUp(self):
+        TemporaryPathTestCase.setUp(self)
+        self.settings = {
+            'oauth2.audit.enabled': 'true',
+            'oauth2.audit.path': self.path,
+            # Written by the test only.
+            'oauth2.audit.flush_interval': '60',
+            }
+        FunctionalTestCase.setUp(self)
+
+    def test_audit(self):
+        import json
+        from oauth2_sample.interfaces import IAuditLog
+        from oauth2_sample.models import OAuth2Token
+
+        audit_log = self.testapp.app.registry.getUtility(IAuditLog)
+        self.addCleanup(audit_log.stop)
+        token = self.request_token(scope='api1').json
+        self.testapp.get('/api/api1', headers={
+            'Authorization': 'Bearer ' + token['access_token']})
+        self.testapp.get('/api/api1', status=403, headers={
+            'Authorization': 'Bearer unknown'})
+        audit_log.flush()
+
+        with open(self.path) as f:
+            records = [json.loads(line) for line in f]
+        issued, valid, invalid = records
+        refresh_token_hash = OAuth2Token.query.get_by_access_token(
+            token['access_token']).refresh_token_hash
+        self.assertEqual(
+            ('token_issued', self.client_id, 'client_credentials', ['api1'],
+             refresh_token_hash.hex(), None),
+            (issued['event'], issued['client_id'], issued['grant_type'],
+             issued['scopes'], issued['refresh_token_hash'],
+             issued['replaced_id']))
+        self.assertEqual(
+            ('token_validated', '/api/api1', True, self.client_id, 1),
+            (valid['event'], valid['path'], valid['valid'],
+             valid['client_id'], valid['scope_mask']))
+        self.assertEqual(
+            ('token_validated', '/api/api1', False, None),
+            (invalid['event'], invalid['path'], invalid['valid'],
+             invalid.get('client_id')))
+
+
+class ClientRegistryTestCase(DatabaseTestCase):
+
+    def test_get(self):
+        from oauth2_sample.clients import ClientRegistry
+
+        self._insert_tokens()
+        registry = ClientRegistry(self.engine)
+        client = registry.get('c')
+        self.assertEqual(('c', 's', 'confidential', 'client_credentials'),
+                         client[:4])
+        self.assertIsNone(registry.get('unknown'))
+
+        statements = FunctionalTestCase.count_statements(self)
+        self.assertIs(client, registry.get('c'))
+        self.assertEqual([], statements)
+
+    def test_refresh(self):
+        from oauth2_sample.clients import ClientRegistry
+        from oauth2_sample.models import Client
+
+        self._insert_tokens()
+        table = Client.__table__
+        clock = DummyClock()
+        registry = ClientRegistry(self.engine, max_age=600, clock=clock)
+        self.assertTrue(registry.refresh())
+        self.assertEqual(1, len(registry))
+        self.assertFalse(registry.refresh())
+
+        # An update changes clients.updated.
+        with self.engine.begin() as conn:
+            conn.execute(table.update().values(client_secret='t'))
+        self.assertTrue(registry.refresh())
+        self.assertEqual('t', registry.get('c').client_secret)
+
+        # So does a delete the number of clients.
+        with self.engine.begin() as conn:
+            conn.execute(table.delete())
+        self.assertTrue(registry.refresh())
+        self.assertIsNone(registry.get('c'))
+
+        clock.now += 600
+        self.assertTrue(registry.refresh())
+
+    def test_unknown_clients(self):
+        from oauth2_sample.clients import ClientRegistry
+
+        registry = ClientRegistry(self.engine, miss_cache_size=2)
+        statements = FunctionalTestCase.count_statements(self)
+        self.assertIsNone(registry.get('a'))
+        self.assertIsNone(registry.get('b'))
+        self.assertIsNone(registry.get('a'))
+        self.assertEqual(2, len(statements), statements)
+
+        # The oldest miss is dropped once the cache is full.
+        self.assertIsNone(registry.get('c'))
+        self.assertIsNone(registry.get('a'))
+        self.assertEqual(4, len(statements), statements)
+
+        # A client added since is found after the next refresh.
+        self._insert_tokens()
+        self.assertIsNone(registry.get('c'))
+        registry.refresh()
+        self.assertEqual('c', registry.get('c').client_id)
+
+
+class ClientRegistryViewTestCase(FunctionalTestCase):
+
+    settings = {
+        'oauth2.client_registry.enabled': 'true',
+        }
+
+    def test_token_requests_skip_the_clients(self):
+        from oauth2_sample.interfaces import IClientRegistry
+
+        client_registry = self.testapp.app.registry.getUtility(
+            IClientRegistry)
+        self.addCleanup(client_registry.stop)
+        refresh_token = self.request_token(scope='api1').json['refresh_token']
+
+        statements = self.count_statements()
+        self.request_token(scope='api1')
+        self.request_token('refresh_token', refresh_token=refresh_token)
+        self.request_token(client_secret='wrong', status=400)
+        self.assertFalse(
+            [x for x in statements if 'FROM clients' in x], statements)
+
+
+class WarmUpTestCase(TemporaryPathTestCase):
+
+    def test_prime_pool(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import QueuePool
+        from oauth2_sample.warmup import prime_pool
+
+        engine = create_engine(
+            'sqlite:///' + self.path, poolclass=QueuePool, pool_size=3)
+        self.assertEqual(3, prime_pool(engine))
+        self.assertEqual(3, engine.pool.checkedin())
+        self.assertEqual(1, prime_pool(create_engine('sqlite://')))
+
+    def test_main(self):
+        from sqlalchemy import create_engine
+        from oauth2_sample import main
+        from oauth2_sample.models import DBSession, Base
+
+        Base.metadata.create_all(create_engine('sqlite:///' + self.path))
+        self.addCleanup(DBSession.remove)
+        with self.assertLogs('oauth2_sample', 'INFO') as logs:
+            main({}, **{
+                'sqlalchemy.url': 'sqlite:///' + self.path,
+                'pyramid.includes': 'pyramid_tm',
+                'oauth2.client_secret.key': 'key',
+                'oauth2.warmup.enabled': 'true',
+                'oauth2.warmup.synthetic_requests': 'true',
+                })
+        self.assertEqual(
+            ['INFO'] * 2, [record.levelname for record in logs.records])
+        self.assertIn('Warmed up in', logs.output[0])
+        self.assertIn('Ready in', logs.output[1])
+
+
+class APIFastPathTestCase(FunctionalTestCase):
+
+    settings = {
+        'oauth2.api_fastpath.enabled': 'true',
+        'oauth2.metrics.enabled': 'true',
+        }
+
+    def test_same_results_as_traversal(self):
+        import itertools
+        from oauth2_sample.interfaces import IMetrics
+
+        tokens = [None, 'garbage'] + [
+            self.request_token(scope=' '.join(scopes)).json['access_token']
+            for n in (1, 2) for scopes in itertools.combinations(
+                ['api1', 'api2'], n)]
+        metrics = self.testapp.app.registry.getUtility(IMetrics)
+
+        for token, view in itertools.product(
+                tokens, ['api1', 'api2', 'api3']):
+            headers = {'Authorization': 'Bearer ' + token} if token else {}
+            # Trailing slashes are not in the table, they are traversed.
+            statements = self.count_statements()
+            expected = self.testapp.get(
+                '/api/%s/' % view, headers=headers, expect_errors=True)
+            traversed = len(statements)
+            del statements[:]
+            res = self.testapp.get(
+                '/api/' + view, headers=headers, expect_errors=True)
+            self.assertEqual(
+                (expected.status, expected.text), (res.status, res.text))
+            self.assertEqual(traversed, len(statements))
+
+        # Both paths are labelled alike.
+        self.assertEqual(2 * len(tokens), metrics.counter(
+            'requests_total', view='api/api3', status=403))
+
+    def test_unregistered_scope_is_looked_up_once(self):
+        import transaction
+        from datetime import datetime, timedelta
+        from pyramid.interfaces import IAuthenticationPolicy
+        from oauth2_sample.models import DBSession, OAuth2Token, token_digest
+        from oauth2_sample.tokens import (
+            ACCESS_TOKEN, REFRESH_TOKEN, generate_token)
+
+        access_token = generate_token(ACCESS_TOKEN)
+        with transaction.manager:
+            DBSession.add(OAuth2Token(
+                client_id=self.client_id, user_id=1,
+                access_token_hash=token_digest(access_token),
+                refresh_token_hash=token_digest(
+                    generate_token(REFRESH_TOKEN)),
+                expires=datetime.utcnow() + timedelta(hours=1),
+                scopes=['api1', 'legacy']))
+        policy = self.testapp.app.registry.getUtility(IAuthenticationPolicy)
+        policy.audit_log = MagicMock()
+
+        statements = self.count_statements()
+        self.testapp.get('/api/api1', headers={
+            'Authorization': 'Bearer ' + access_token})
+        self.assertEqual(1, len([
+            x for x in statements if 'FROM oauth2_tokens' in x]))
+        self.assertEqual(1, policy.audit_log.record.call_count)
+
+    def test_compile_permission_table(self):
+        from pyramid.security import Allow, Deny, Everyone
+        from oauth2_sample.fastpath import compile_permission_table
+        from oauth2_sample.scopes import ScopeRegistry
+        from oauth2_sample.views import APIContext
+
+        registry = self.testapp.app.registry
+        scopes = ScopeRegistry(['api1', 'api2', 'api3'])
+        table = compile_permission_table(
+            registry, APIContext, '/api/', scope_registry=scopes)
+        self.assertEqual(['/api/api1', '/api/api2', '/api/api3'],
+                         sorted(table))
+        self.assertEqual(scopes.mask(['api2']), table['/api/api2'].scope_mask)
+
+        class Context(APIContext):
+            __acl__ = [(Allow, 's:api1', 'api1'), (Deny, Everyone, 'api1')]
+
+        self.assertEqual({}, compile_permission_table(
+            registry, APIContext, '/api/', lineage=(Context,),
+            scope_registry=scopes))
+
+
+class MetricsViewTestCase(FunctionalTestCase):
+
+    settings = {
+        'oauth2.metrics.enabled': 'true',
+        'oauth2.token_cache.enabled': 'true',
+        }
+
+    def test_metrics(self):
+        from oauth2_sample.interfaces import IMetrics
+
+        access_token = self.request_token(scope='api1').json['access_token']
+        self.testapp.get(
+            '/api/api1', headers={'Authorization': 'Bearer ' + access_token})
+        self.testapp.get('/unknown', status=404)
+
+        res = self.testapp.get('/metrics')
+
+        self.assertEqual(
+            'text/plain; version=0.0.4; charset=utf-8',
+            res.headers['Content-Type'])
+        self.assertIn(
+            'oauth2_sample_requests_total{status="200",view="api/api1"} 1',
+            res.text)
+        self.assertIn(
+            'oauth2_sample_requests_total{status="404",view="notfound"} 1',
+            res.text)
+        self.assertIn('oauth2_sample_token_cache_misses 1', res.text)
+        metrics = self.testapp.app.registry.getUtility(IMetrics)
+        histogram = metrics.histogram(
+            'sql_statements_per_request', view='oauth2/token')
+        self.assertEqual(2.0, histogram.sum)
+
+
+class MetricsSamplingTestCase(FunctionalTestCase):
+
+    settings = {
+        'oauth2.metrics.enabled': 'true',
+        'oauth2.metrics.sample_rate': '0',
+        }
+
+    def test_sample_nothing(self):
+        self.request_token(scope='api1')
+        self.assertNotIn('requests_total', self.testapp.get('/metrics').text)
+
+
+class ClientSecretHasherTestCase(unittest.TestCase):
+
+    def test_hash_and_verify(self):
+        from oauth2_sample.credentials import ClientSecretHasher
+
+        hasher = ClientSecretHasher(b'key')
+        digest = hasher.hash('secret')
+
+        self.assertTrue(digest.startswith('hmac-sha256$'))
+        self.assertNotIn('secret', digest[len('hmac-sha256$'):])
+        self.assertNotEqual(
+            digest, ClientSecretHasher(b'other').hash('secret'))
+        self.assertTrue(hasher.verify('c', 'secret', digest))
+        self.assertFalse(hasher.verify('c', 'invalid', digest))
+        self.assertFalse(hasher.verify('c', None, digest))
+        # Plain text secrets are accepted until they are migrated.
+        self.assertTrue(hasher.verify('c', 'secret', 'secret'))
+        self.assertFalse(hasher.verify('c', 'invalid', 'secret'))
+
+
+class HashClientSecretsTestCase(DatabaseTestCase):
+
+    def test_hash_client_secrets(self):
+        from oauth2_sample.credentials import ClientSecretHasher
+        from oauth2_sample.models import Client
+        from oauth2_sample.scripts.hashclientsecrets import (
+            hash_client_secrets)
+
+        self._insert_tokens()
+        hasher = ClientSecretHasher(b'key')
+
+        self.assertEqual(1, hash_client_secrets(self.engine, hasher, 1))
+        self.assertEqual(0, hash_client_secrets(self.engine, hasher, 1))
+        secret = self.engine.execute(
+            Client.__table__.select()).first().client_secret
+        self.assertTrue(hasher.verify('c', 's', secret))
+        self.assertNotEqual('s', secret)
+
+
+class RehashTokensTestCase(unittest.TestCase):
+
+    def test_rehash_legacy_tokens(self):
+        from sqlalchemy import create_engine, inspect
+        from oauth2_sample.models import OAuth2Token, token_digest
+        from oauth2_sample.scripts.rehashtokens import (
+            ensure_token_digest_columns, rehash_tokens)
+
+        engine = create_engine('sqlite://')
+        engine.execute(
+            'CREATE TABLE oauth2_tokens (id INTEGER PRIMARY KEY, '
+            'user_id INTEGER NOT NULL, client_id VARCHAR(40) NOT NULL, '
+            'access_token VARCHAR(255) UNIQUE, '
+            'refresh_token VARCHAR(255) UNIQUE, expires DATETIME, '
+            'scopes TEXT, scope_mask BIGINT)')
+        engine.execute(
+            "INSERT INTO oauth2_tokens (user_id, client_id, access_token, "
+            "refresh_token) VALUES (1, 'c', 'a1', 'r1'), (1, 'c', NULL, 'r2'),"
+            " (1, 'c', 'a3', 'r3')")
+
+        self.assertEqual(
+            ['access_token_hash', 'refresh_token_hash'],
+            ensure_token_digest_columns(engine))
+        self.assertEqual([], ensure_token_digest_columns(engine))
+        self.assertIn(
+            'ix_oauth2_tokens_access_token_hash',
+            [i['name'] for i in inspect(engine).get_indexes('oauth2_tokens')])
+        self.assertEqual(3, rehash_tokens(engine, batch_size=2))
+        self.assertEqual(0, rehash_tokens(engine, batch_size=2))
+
+        rows = engine.execute(
+            'SELECT access_token, refresh_token, access_token_hash, '
+            'refresh_token_hash FROM oauth2_tokens ORDER BY id').fetchall()
+        self.assertEqual([
+            (None, None, token_digest('a1'), token_digest('r1')),
+            (None, None, None, token_digest('r2')),
+            (None, None, token_digest('a3'), token_digest('r3')),
+            ], [tuple(row) for row in rows])
+        self.assertEqual(3, engine.execute(
+            OAuth2Token.__table__.count()).scalar())
+
+
+class RoutingSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from oauth2_sample.models import Base, User
+        from oauth2_sample.routing import ReplicaSet, RoutingSession
+
+        self.primary = create_engine('sqlite://')
+        self.replica = create_engine('sqlite://')
+        for engine, username in ((self.primary, 'primary'),
+                                 (self.replica, 'replica')):
+            Base.metadata.create_all(engine)
+            engine.execute(User.__table__.insert(), id=1, username=username,
+                           password='x', is_superuser=False, is_staff=False,
+                           is_active=True, created='2016-01-01',
+                           updated='2016-01-01')
+        self.replicas = ReplicaSet([self.replica])
+        self.session = sessionmaker(class_=RoutingSession)(
+            bind=self.primary, replicas=self.replicas)
+        self.addCleanup(self.session.close)
+
+    def _username(self, user_id=1):
+        from oauth2_sample.models import User
+        user = self.session.query(User).filter_by(id=user_id).first()
+        return user.username if user else None
+
+    def test_replica_reads(self):
+        from oauth2_sample.routing import replica_reads
+
+        scoped = lambda: self.session  # noqa: E731
+        self.assertEqual('primary', self._username())
+        self.session.expunge_all()
+        with replica_reads(scoped):
+            self.assertEqual('replica', self._username())
+        self.session.expunge_all()
+        self.assertEqual('primary', self._username())
+
+    def test_read_own_writes(self):
+        from oauth2_sample.models import User
+        from oauth2_sample.routing import replica_reads
+
+        scoped = lambda: self.session  # noqa: E731
+        self.session.add(User(id=2, username='new', password='x'))
+        self.session.flush()
+        with replica_reads(scoped):
+            self.assertEqual('new', self._username(2))
+        self.session.close()
+        with replica_reads(scoped):
+            self.assertIsNone(self._username(2))
+
+    def test_replica_then_primary(self):
+        import time
+        from oauth2_sample.models import User
+        from oauth2_sample.routing import replica_then_primary
+
+        self.primary.execute(
+            User.__table__.insert(), id=2, username='lagging', password='x',
+            is_superuser=False, is_staff=False, is_active=True,
+            created='2016-01-01', updated='2016-01-01')
+        self.assertEqual('lagging', replica_then_primary(
+            lambda: self.session, self._username, 2, created=time.time()))
+        # A miss of an older, or unknown, row is not read again.
+        self.assertIsNone(replica_then_primary(
+            lambda: self.session, self._username, 2,
+            created=time.time() - 60))
+        self.assertIsNone(replica_then_primary(
+            lambda: self.session, self._username, 2))
+
+    def test_replica_then_primary_when_the_replica_fails(self):
+        from oauth2_sample.models import User
+        from oauth2_sample.routing import replica_then_primary
+
+        # The replica has lost its tables.
+        User.__table__.drop(self.replica)
+        self.assertEqual('primary', replica_then_primary(
+            lambda: self.session, self._username))
+        self.assertIsNone(self.replicas.next())
+        self.session.add(User(id=2, username='new', password='x'))
+        self.session.commit()
+
+    def test_replica_set_skips_replicas_that_are_down(self):
+        from sqlalchemy import create_engine
+        from oauth2_sample.routing import ReplicaSet
+
+        engines = [create_engine('sqlite://') for x in range(3)]
+        replicas = ReplicaSet(engines)
+        self.assertEqual(engines, [replicas.next() for x in range(3)])
+        replicas.mark_down(engines[1])
+        self.assertEqual(
+            [engines[0], engines[2], engines[0]],
+            [replicas.next() for x in range(3)])
+        replicas.check()
+        self.assertEqual(3, len(set(replicas.next() for x in range(3))))
+        for engine in engines:
+            replicas.mark_down(engine)
+        self.assertIsNone(replicas.next())
+
+    def test_replica_set_from_config(self):
+        from oauth2_sample.routing import (
+            primary_engine_from_config, replica_set_from_config)
+
+        settings = {
+            'sqlalchemy.url': 'sqlite://',
+            'sqlalchemy.replicas.check_interval': '5',
+            'sqlalchemy.replicas.r1.url': 'sqlite://',
+            'sqlalchemy.replicas.r2.url': 'sqlite://',
+            }
+        replicas = replica_set_from_config(settings)
+        self.assertEqual(2, len(replicas))
+        self.assertEqual(5.0, replicas.check_interval)
+        self.assertEqual(5.0, replicas.max_lag)
+        self.assertEqual(
+            'sqlite://', str(primary_engine_from_config(settings).url))
+        self.assertIsNone(replica_set_from_config({}))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import zlib
+
+import random
+
+__all__ = (
+    'ACCESS_TOKEN',
+    'REFRESH_TOKEN',
+    'InvalidToken',
+    'generate_token',
+    'token_issued_at',
+    'token_type',
+    )
+
+ACCESS_TOKEN = 'access_token'
+REFRESH_TOKEN = 'refresh_token'
+
+_PREFIXES = {
+    ACCESS_TOKEN: 'at_',
+    REFRESH_TOKEN: 'rt_',
+    }
+_TYPES = dict((prefix, type_) for type_, prefix in _PREFIXES.items())
+
+_CHARSET = r'abcdefghijklmnopqrstuvwxyz' \
+    r'ABCDEFGHIJKLMNOPQRSTUVWXYZ' \
+    r'0123456789'
+_CHARSET_SET = frozenset(_CHARSET)
+
+_PREFIX_LENGTH = 3
+_BODY_LENGTH = 30
+_TIMESTAMP_LENGTH = 6  # 62 ** 6 seconds, until the year 3770
+_CHECKSUM_LENGTH = 6  # 62 ** 6 > 2 ** 32
+_TOKEN_LENGTH = _PREFIX_LENGTH + _BODY_LENGTH + _CHECKSUM_LENGTH
+
+
+class InvalidToken(ValueError):
+    """Raised by :func:`token_type` for a token that was not issued here.
+
+    :attr:`reason` is ``'malformed'`` or ``'checksum'``.
+    """
+
+    def __init__(self, reason):
+        super(InvalidToken, self).__init__(reason)
+        self.reason = reason
+
+
+def _checksum(data):
+    return _encode(
+        zlib.crc32(data.encode('ascii')) & 0xffffffff, _CHECKSUM_LENGTH)
+
+
+def _encode(value, length):
+    chars = []
+    for x in range(length):
+        value, index = divmod(value, len(_CHARSET))
+        chars.append(_CHARSET[index])
+    return ''.join(chars)
+
+
+def _decode(chars):
+    value = 0
+    for char in reversed(chars):
+        value = value * len(_CHARSET) + _CHARSET.index(char)
+    return value
+
+
+def generate_token(type_, now=None):
+    """Generate a token of ``type_``, :data:`ACCESS_TOKEN` or
+    :data:`REFRESH_TOKEN`.
+
+    The token is a type prefix, the second it was issued in 6 characters,
+    24 random characters and a CRC-32 checksum of them, so a token that
+    was not issued here can be told apart without a database lookup::
+
+        >>> generate_token(ACCESS_TOKEN)[:3]
+        'at_'
+        >>> token_type(generate_token(REFRESH_TOKEN))
+        'refresh_token'
+    """
+    rand = random.SystemRandom()
+    data = _PREFIXES[type_] + _encode(
+        int(time.time() if now is None else now), _TIMESTAMP_LENGTH) + \
+        ''.join(rand.choice(_CHARSET)
+                for x in range(_BODY_LENGTH - _TIMESTAMP_LENGTH))
+    return data + _checksum(data)
+
+
+def token_issued_at(token):
+    """Return the POSIX time a well formed token was issued at, as told
+    by the token itself, or ``None`` for an unprefixed token.
+
+    The prefixed tokens issued before the time was part of them tell a
+    random time, mostly far in the future.
+    """
+    if len(token) != _TOKEN_LENGTH:
+        return None
+    return _decode(
+        token[_PREFIX_LENGTH:_PREFIX_LENGTH + _TIMESTAMP_LENGTH])
+
+
+def token_type(token):
+    """Return the type of ``token`` without a database lookup.
+
+    Returns ``None`` for the unprefixed tokens issued by earlier versions,
+    whose type is unknown, and raises :class:`InvalidToken` for anything
+    else that is not a well formed token with a valid checksum.
+    """
+    if len(token) == _TOKEN_LENGTH:
+        type_ = _TYPES.get(token[:_PREFIX_LENGTH])
+        if type_ is None or not _CHARSET_SET.issuperset(
+                token[_PREFIX_LENGTH:]):
+            raise InvalidToken('malformed')
+        data = token[:-_CHECKSUM_LENGTH]
+        if token[-_CHECKSUM_LENGTH:] != _checksum(data):
+            raise InvalidToken('checksum')
+        return type_
+    if len(token) == _BODY_LENGTH and _CHARSET_SET.issuperset(token):
+        return None
+    raise InvalidToken('malformed')
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timedelta
+import math
+
+import logging
 
-import random
+from concurrent import futures
+
+from datetime import datetime, timedelta
 
 from pyramid.view import view_defaults, view_config
 
@@ -14,13 +18,51 @@ from pyramid.security import (
 
 import colander
 
+from passlib.hash import bcrypt
+
+import transaction
+
+from sqlalchemy.orm import joinedload
+
 from .models import (
     DBSession,
     Client,
     OAuth2Token,
+    REFRESH_TOKEN_LIFETIME,
+    token_digest,
+    )
+
+from .schemas import TokenRequestParser, OAuth2IntrospectSchema
+
+from .interfaces import (
+    IAuditLog,
+    IMetrics,
+    IPasswordVerifier,
+    IRateLimiter,
+    ITokenCache,
+    ITokenFilter,
+    ITokenSigner,
+    ITokenWriter,
     )
 
-from .schemas import OAuth2TokenSchema
+from .scopes import scope_registry
+
+from .batching import TokenAlreadyUsed
+
+from .passwords import DUMMY_PASSWORD, PasswordVerifierOverloaded
+
+from .tokens import (
+    ACCESS_TOKEN,
+    REFRESH_TOKEN,
+    InvalidToken,
+    generate_token,
+    token_type,
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+# Validates the token requests, compiled from OAuth2TokenSchema once.
+_token_request_parser = TokenRequestParser()
 
 
 def _is_json_request(request):
@@ -32,12 +74,31 @@ def _serialze_colandar_invalid(exc):
             for prop, error in exc.asdict().items()]
 
 
-def _generate_token():
-    charset = r'abcdefghijklmnopqrstuvwxyz' \
-        r'ABCDEFGHIJKLMNOPQRSTUVWXYZ' \
-        r'0123456789'
-    rand = random.SystemRandom()
-    return ''.join(rand.choice(charset) for x in range(30))
+def _introspection(scopes, expires, client_id, user_id, username=None):
+    """Build the RFC 7662 introspection response for a token."""
+    if expires is None or expires <= datetime.utcnow():
+        return {'active': False}
+    result = {
+        'active': True,
+        'scope': ' '.join(sorted(scopes or ())),
+        'client_id': client_id,
+        'token_type': 'Bearer',
+        'exp': int((expires - datetime(1970, 1, 1)).total_seconds()),
+        'sub': str(user_id),
+        }
+    if username is not None:
+        result['username'] = username
+    return result
+
+
+def _add_to_token_filter(committed, token_filter, digest):
+    if committed:
+        token_filter.add(digest)
+
+
+def _record_token_issued(committed, audit_log, fields):
+    if committed:
+        audit_log.record('token_issued', **fields)
 
 
 class OAuth2Context(object):
@@ -99,6 +160,14 @@ class OAuth2View(object):
             --data-urlencode "grant_type=refresh_token"
             --data-urlencode "refresh_token=YOUR_REFRESH_TOKEN"
 
+        Get an access token by using the password of a user::
+
+            curl http://localhost/oauth2/token \
+            --data-urlencode "client_id=YOUR_CLIENT_ID" \
+            --data-urlencode "client_secret=YOUR_CLIENT_SECRET" \
+            --data-urlencode "grant_type=password" \
+            --data-urlencode "username=USERNAME" \
+            --data-urlencode "password=PASSWORD"
 
         Success response example::
             {
@@ -114,13 +183,12 @@ class OAuth2View(object):
                 "error_description": "grant_type not found"
             }
         """
-        schema = OAuth2TokenSchema()
-
         reqparams = self.request.json_body if _is_json_request(self.request) \
             else self.request.params
 
         try:
-            cstruct = schema.deserialize(reqparams)
+            cstruct, client, old_token, user = _token_request_parser.parse(
+                reqparams)
         except colander.Invalid as e:
             self.request.response.status_int = 400
             return {
@@ -129,33 +197,278 @@ class OAuth2View(object):
                 'errors': _serialze_colandar_invalid(e),
                 }
 
-        client = DBSession.query(Client).get(cstruct['client_id'])
+        # Limit the token requests of every client, after it authenticated.
+        rate_limiter = self.request.registry.queryUtility(IRateLimiter)
+        if rate_limiter is not None:
+            retry_after = rate_limiter.acquire(
+                client.client_id, client.rate_limit, client.rate_burst)
+            if retry_after:
+                return self._rate_limited(retry_after)
+
+        # Verify the password of a password grant once the client passed
+        # the rate limit.
+        if cstruct['grant_type'] == Client.GRANT_TYPE_PASSWORD:
+            try:
+                verified = self._verify_password(user, cstruct['password'])
+            except PasswordVerifierOverloaded:
+                return self._overloaded()
+            if not verified:
+                self.request.response.status_int = 400
+                return {
+                    'status': 400,
+                    'code': 'invalid_parameter',
+                    'errors': [{
+                        'property': '',
+                        'message': 'A username or password is invalid',
+                        }],
+                    }
+            user_id = user.id
+        elif old_token is not None:
+            user_id = old_token.user_id
+        else:
+            user_id = client.user_id
+
+        # Create token. Only the digests of the tokens are stored.
+        expires_in = 3600
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=expires_in)
+        access_token = generate_token(ACCESS_TOKEN)
+        refresh_token = generate_token(REFRESH_TOKEN)
+        values = {
+            'client_id': client.client_id,
+            'user_id': user_id,
+            'access_token_hash': token_digest(access_token),
+            'refresh_token_hash': token_digest(refresh_token),
+            'expires': expires,
+            'refresh_expires': now + REFRESH_TOKEN_LIFETIME,
+            'scopes': cstruct['scope'],
+            'scope_mask': scope_registry.mask(cstruct['scope']),
+            }
+
+        # Signed access tokens are verified without the database, only the
+        # refresh token is stored.
+        token_signer = self.request.registry.queryUtility(ITokenSigner)
+        if token_signer is not None:
+            access_token = token_signer.sign(
+                values['scopes'], expires, client.client_id, user_id)
+            values['access_token_hash'] = None
+
+        # Audit the tokens once they are committed. The refresh token
+        # digest identifies the token, the access token may be signed.
+        audit_log = self.request.registry.queryUtility(IAuditLog)
+        if audit_log is not None:
+            audited = {
+                'client_id': client.client_id,
+                'user_id': user_id,
+                'grant_type': cstruct['grant_type'],
+                'scopes': values['scopes'],
+                'refresh_token_hash': values['refresh_token_hash'],
+                'replaced_id': old_token.id if old_token else None,
+                }
 
-        if cstruct['grant_type'] == 'refresh_token':
-            old_token = OAuth2Token.query\
-                .get_by_refresh_token(cstruct['refresh_token'])
+        token_filter = self.request.registry.queryUtility(ITokenFilter)
+        token_writer = self.request.registry.queryUtility(ITokenWriter)
+        if token_writer is not None:
+            # Respond once the batch of the token is committed.
+            future = token_writer.submit(
+                values, old_token.id if old_token else None)
+            try:
+                future.result(token_writer.timeout)
+            except futures.TimeoutError:
+                # Unless the write is cancelled its batch is being written,
+                # and the token may be committed, unknown to the client, and
+                # its refresh token replaced.
+                if not future.cancel():
+                    logger.warning(
+                        'Timed out waiting for a token batch in progress')
+                return self._unavailable('Timed out storing the token')
+            except TokenAlreadyUsed:
+                self.request.response.status_int = 400
+                return {
+                    'status': 400,
+                    'code': 'invalid_parameter',
+                    'errors': [{
+                        'property': '',
+                        'message': 'A refresh token is invalid',
+                        }],
+                    }
+            except Exception:
+                # The batch was rolled back, logged by the writer.
+                return self._unavailable('The token could not be stored')
+            if token_filter is not None and values['access_token_hash']:
+                token_filter.add(values['access_token_hash'])
+            if audit_log is not None:
+                audit_log.record('token_issued', **audited)
+        else:
             if old_token:
                 DBSession.delete(old_token)
-
-        # Create token.
-        expires_in = 3600
-        expires = datetime.utcnow() + timedelta(seconds=expires_in)
-        token = OAuth2Token(
-            client=client,
-            user=client.user,
-            access_token=_generate_token(),
-            refresh_token=_generate_token(),
-            expires=expires,
-            scopes=cstruct['scope'],
-            )
-        DBSession.add(token)
+            DBSession.add(OAuth2Token(**values))
+            # Add the token to the filter once it is visible to a rebuild.
+            if token_filter is not None and values['access_token_hash']:
+                transaction.get().addAfterCommitHook(
+                    _add_to_token_filter,
+                    args=(token_filter, values['access_token_hash']))
+            if audit_log is not None:
+                transaction.get().addAfterCommitHook(
+                    _record_token_issued, args=(audit_log, audited))
+
+        if old_token and old_token.access_token_hash:
+            token_cache = self.request.registry.queryUtility(ITokenCache)
+            if token_cache is not None:
+                token_cache.invalidate(old_token.access_token_hash)
 
         return {
-            'access_token': token.access_token,
+            'access_token': access_token,
             'token_type': 'Bearer',
             'expires_in': expires_in,
-            'refresh_token': token.refresh_token,
+            'refresh_token': refresh_token,
+            }
+
+    def _verify_password(self, user, raw_password):
+        if not raw_password:
+            return False
+        # An unknown user takes as long as a wrong password, the time of the
+        # response does not tell which usernames exist.
+        password = DUMMY_PASSWORD if user is None else user.password
+        verifier = self.request.registry.queryUtility(IPasswordVerifier)
+        if verifier is None:
+            verified = bcrypt.verify(raw_password, password)
+        else:
+            verified = verifier.verify(raw_password, password)
+        return verified and user is not None
+
+    def _overloaded(self):
+        return self._unavailable('Too many password verifications')
+
+    def _unavailable(self, message):
+        response = self.request.response
+        response.status_int = 503
+        response.headers['Retry-After'] = '1'
+        return {
+            'status': 503,
+            'code': 'temporarily_unavailable',
+            'errors': [{
+                'property': '',
+                'message': message,
+                }],
+            }
+
+    def _rate_limited(self, retry_after):
+        metrics = self.request.registry.queryUtility(IMetrics)
+        if metrics is not None:
+            metrics.incr('rate_limited_total')
+        response = self.request.response
+        response.status_int = 429
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return {
+            'status': 429,
+            'code': 'rate_limited',
+            'errors': [{
+                'property': 'client_id',
+                'message': 'Too many token requests',
+                }],
+            }
+
+    @view_config(name='introspect', request_method='POST', renderer='json')
+    def introspect(self):
+        """Introspect a token (RFC 7662).
+
+        Introspect a token::
+
+            curl http://localhost/oauth2/introspect \
+            --data-urlencode "client_id=YOUR_CLIENT_ID" \
+            --data-urlencode "client_secret=YOUR_CLIENT_SECRET" \
+            --data-urlencode "token=A_TOKEN"
+
+        Introspect up to 100 tokens in one request, with one query::
+
+            curl http://localhost/oauth2/introspect \
+            --data-urlencode "client_id=YOUR_CLIENT_ID" \
+            --data-urlencode "client_secret=YOUR_CLIENT_SECRET" \
+            --data-urlencode "tokens=A_TOKEN" \
+            --data-urlencode "tokens=ANOTHER_TOKEN"
+
+        Success response example::
+            {
+                "active": true,
+                "scope": "api1 api2",
+                "client_id": "CLIENT_ID",
+                "token_type": "Bearer",
+                "exp": 1455000000,
+                "sub": "1",
+                "username": "foo"
+            }
+
+        Batch success response example, in the order of the request::
+            {
+                "tokens": [
+                    {"active": true, ...},
+                    {"active": false}
+                ]
             }
+        """
+        schema = OAuth2IntrospectSchema()
+
+        reqparams = self.request.json_body if _is_json_request(self.request) \
+            else self.request.params.mixed()
+
+        try:
+            cstruct = schema.deserialize(reqparams)
+        except colander.Invalid as e:
+            self.request.response.status_int = 400
+            return {
+                'status': 400,
+                'code': 'invalid_parameter',
+                'errors': _serialze_colandar_invalid(e),
+                }
+
+        self.request.response.cache_control = 'no-store'
+
+        if cstruct['tokens'] is None:
+            return self._introspect_tokens(
+                [cstruct['token']], cstruct['token_type_hint'])[0]
+        return {
+            'tokens': self._introspect_tokens(
+                cstruct['tokens'], cstruct['token_type_hint']),
+            }
+
+    def _introspect_tokens(self, tokens, token_type_hint):
+        results = {}
+
+        lookup = {ACCESS_TOKEN: [], REFRESH_TOKEN: []}
+        token_signer = self.request.registry.queryUtility(ITokenSigner)
+        for token in tokens:
+            if token_signer is not None and token_signer.is_signed(token):
+                claims = token_signer.verify(token)
+                if claims is not None:
+                    results[token] = _introspection(
+                        claims.scopes, claims.expires, claims.client_id,
+                        claims.user_id)
+                continue
+            # The prefix of a token tells its type, the hint is only used
+            # for the tokens issued without one.
+            try:
+                type_ = token_type(token) or token_type_hint or ACCESS_TOKEN
+            except InvalidToken:
+                continue
+            lookup[type_].append(token)
+
+        # A refresh token outlives the access token of its row.
+        for type_, attr, expires_attr, get_by_tokens in (
+                (ACCESS_TOKEN, 'access_token_hash', 'expires',
+                 OAuth2Token.query.get_by_access_tokens),
+                (REFRESH_TOKEN, 'refresh_token_hash', 'refresh_token_expires',
+                 OAuth2Token.query.get_by_refresh_tokens)):
+            if not lookup[type_]:
+                continue
+            digests = dict((token_digest(x), x) for x in lookup[type_])
+            query = get_by_tokens(lookup[type_])
+            for token in query.options(joinedload(OAuth2Token.user)):
+                results[digests[getattr(token, attr)]] = _introspection(
+                    token.scopes, getattr(token, expires_attr),
+                    token.client_id, token.user_id, token.user.username)
+
+        return [results.get(token, {'active': False}) for token in tokens]
 
 
 @view_defaults(context=APIContext)
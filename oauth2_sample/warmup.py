@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import logging
+
+import transaction
+
+from pyramid.request import Request
+
+from pyramid.settings import asbool
+
+from sqlalchemy.orm import joinedload
+
+from .interfaces import IClientRegistry
+
+from .models import DBSession, Client, OAuth2Token
+
+from .tokens import ACCESS_TOKEN, REFRESH_TOKEN, generate_token
+
+__all__ = (
+    'compile_queries',
+    'prime_pool',
+    'send_synthetic_requests',
+    'warm_up',
+    )
+
+logger = logging.getLogger('oauth2_sample')
+
+# A client id that is never generated, client ids have 40 characters.
+_UNKNOWN_CLIENT_ID = 'warmup'
+
+
+def prime_pool(engine, connections=None):
+    """Open ``connections`` connections of the pool of ``engine`` at once
+    and return them to the pool.
+
+    ``connections`` defaults to the size of a ``QueuePool``, and to one
+    connection for the other pools.
+
+    :return: The number of connections opened
+    """
+    if connections is None:
+        size = getattr(engine.pool, 'size', None)
+        connections = size() if callable(size) else 1
+    opened = []
+    try:
+        for i in range(connections):
+            opened.append(engine.connect())
+    finally:
+        for conn in opened:
+            conn.close()
+    return len(opened)
+
+
+def compile_queries(session=DBSession):
+    """Run the client and token lookups of the requests once, with keys
+    that match nothing, to configure the mappers and their loaders before
+    the first request.
+    """
+    access_token = generate_token(ACCESS_TOKEN)
+    try:
+        Client.query.options(joinedload(Client.user)).get(
+            _UNKNOWN_CLIENT_ID)
+        OAuth2Token.query.get_by_access_token(access_token)
+        OAuth2Token.query.get_by_refresh_token(generate_token(REFRESH_TOKEN))
+        OAuth2Token.query.get_by_access_tokens([access_token])\
+            .options(joinedload(OAuth2Token.user)).all()
+    finally:
+        transaction.abort()
+        session.remove()
+
+
+def send_synthetic_requests(app):
+    """Send a token request of an unknown client and an API request with an
+    unknown access token through ``app``.
+
+    :return: ``True`` if both were refused as expected
+    """
+    requests = (
+        (Request.blank('/oauth2/token', POST={
+            'client_id': _UNKNOWN_CLIENT_ID,
+            'client_secret': _UNKNOWN_CLIENT_ID,
+            'grant_type': Client.GRANT_TYPE_CLIENT_CREDENTIALS,
+            }), 400),
+        (Request.blank('/api/api1', headers={
+            'Authorization': 'Bearer ' + generate_token(ACCESS_TOKEN),
+            }), 403),
+        )
+    ok = True
+    for request, status in requests:
+        response = request.get_response(app)
+        if response.status_int != status:
+            logger.warning('Warm-up %s %s answered %s, expected %d',
+                           request.method, request.path, response.status,
+                           status)
+            ok = False
+    return ok
+
+
+def warm_up(app, engine, settings, replicas=None, prefix='oauth2.warmup.'):
+    """Warm up ``app`` before it serves its first request.
+
+    Does nothing unless ``<prefix>enabled`` is true::
+
+        oauth2.warmup.enabled = true
+        # Connections to open in every pool, defaults to the pool size.
+        oauth2.warmup.connections = 5
+        oauth2.warmup.synthetic_requests = true
+
+    The pools of ``engine`` and ``replicas`` are filled, the lookups are
+    compiled by :func:`compile_queries`, the client registry is loaded
+    and, optionally, the requests of :func:`send_synthetic_requests` are
+    sent. A replica that cannot be
+    reached is marked down; an error of the primary database is raised, so
+    a worker that cannot reach it does not start.
+    """
+    if not asbool(settings.get(prefix + 'enabled', False)):
+        return
+    connections = settings.get(prefix + 'connections')
+    connections = int(connections) if connections else None
+
+    started = time.perf_counter()
+    opened = prime_pool(engine, connections)
+    if replicas is not None:
+        for replica in replicas.engines:
+            try:
+                opened += prime_pool(replica, connections)
+            except Exception:
+                replicas.mark_down(replica)
+            else:
+                replicas.mark_up(replica)
+    compile_queries()
+    client_registry = app.registry.queryUtility(IClientRegistry)
+    if client_registry is not None:
+        client_registry.refresh()
+    if asbool(settings.get(prefix + 'synthetic_requests', False)):
+        send_synthetic_requests(app)
+    logger.info('Warmed up in %.3fs, %d connections opened',
+                time.perf_counter() - started, opened)
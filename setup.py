@@ -15,6 +15,7 @@ test_requires = [
     'pytest',
     'pytest-flake8',
     'pytest-cov',
+    'WebTest',
     ]
 
 development_requires = [
@@ -71,5 +72,14 @@ setup(
     main = oauth2_sample:main
     [console_scripts]
     initialize_oauth2_sample_db = oauth2_sample.scripts.initializedb:main
+    reap_oauth2_sample_tokens = oauth2_sample.scripts.reaptokens:main
+    benchmark_oauth2_sample = oauth2_sample.scripts.benchmark:main
+    hash_oauth2_sample_client_secrets = \
+        oauth2_sample.scripts.hashclientsecrets:main
+    rehash_oauth2_sample_tokens = oauth2_sample.scripts.rehashtokens:main
+    serve_oauth2_sample = oauth2_sample.scripts.prefork:main
+    seed_oauth2_sample_db = oauth2_sample.scripts.seed:main
+    export_oauth2_sample_db = oauth2_sample.scripts.transfer:export_main
+    import_oauth2_sample_db = oauth2_sample.scripts.transfer:import_main
     """,
     )